@@ -1,7 +1,15 @@
 from datetime import datetime
+import hashlib
+import json
+from typing import Any, Dict, List
 
 from discord.ext import commands
-from utils.shared_functions import get_extensions
+from discord.utils import MISSING
+from utils.audit_index import AuditIndex
+from utils.message_pipeline import MessagePipeline
+from utils.paths import COMMAND_TREE_FILE
+from utils.shared_functions import get_extensions, update_json_file
+from utils.work_queue import WorkQueue
 
 class AFLBot(commands.Bot):
     """Istanza del bot. Rispetto a commands.Bot ha le seguenti
@@ -9,13 +17,67 @@ class AFLBot(commands.Bot):
 
     - version: str           tiene traccia della versione
     - start_time: datetime   timestamp di avvio del bot
+    - pipeline: MessagePipeline  elaborazione dei messaggi, le cog vi
+      registrano le proprie fasi al posto di un listener on_message
+    - work_queue: WorkQueue  esegue le azioni verso discord generate dai
+      messaggi con un numero limitato di worker
+
+    Gli slash command vanno sincronizzati tramite sync_commands, che
+    contatta discord solo se l'albero dei comandi è cambiato.
     """
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.version: str
         self.start_time: datetime
+        self.pipeline: MessagePipeline = MessagePipeline(self)
+        self.work_queue: WorkQueue = WorkQueue()
 
     # carico i moduli dei comandi
     async def setup_hook(self) -> None:
+        self.work_queue.start()
+        self.add_listener(self.pipeline.process, 'on_message')
+        self.add_listener(self.pipeline.process_edit, 'on_message_edit')
         for ext in get_extensions():
             await self.load_extension(ext)
+
+    async def close(self) -> None:
+        self.work_queue.stop()
+        await super().close()
+        if AuditIndex._instance is not MISSING:
+            await AuditIndex._instance.close()
+
+    def _command_tree_hash(self) -> str:
+        """Calcola l'hash sha256 della rappresentazione degli slash command
+        che verrebbe inviata a discord con tree.sync().
+        """
+        payload: List[Dict[str, Any]] = []
+        for command in self.tree.get_commands():
+            try:
+                payload.append(command.to_dict(self.tree))
+            except TypeError:
+                # versioni di discord.py in cui to_dict non riceve l'albero
+                payload.append(command.to_dict())  # type: ignore
+        payload.sort(key=lambda c: (c.get('type', 1), c['name']))
+        serialized = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    async def sync_commands(self, force: bool = False) -> bool:
+        """Sincronizza gli slash command con discord solo se il loro hash
+        è diverso da quello dell'ultima sincronizzazione, salvato su file.
+
+        :param force: sincronizza in ogni caso
+
+        :returns: True se è stata effettuata la sincronizzazione
+        :rtype: bool
+        """
+        digest = self._command_tree_hash()
+        if not force:
+            try:
+                with open(COMMAND_TREE_FILE, 'r') as file:
+                    if json.load(file).get('hash') == digest:
+                        return False
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+        await self.tree.sync()
+        update_json_file({'hash': digest, 'synced_at': datetime.now().isoformat()}, COMMAND_TREE_FILE)
+        return True
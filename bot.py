@@ -41,8 +41,11 @@ intents.message_content = True
 intents.members = True
 
 # istanziare il bot (avvio in fondo al codice)
+# la cache dei messaggi serve solo per loggare il contenuto dei messaggi
+# eliminati, i contatori usano MessageLedger
 bot = AFLBot(
-    command_prefix=Config.get_config().current_prefix, intents=intents)
+    command_prefix=Config.get_config().current_prefix, intents=intents,
+    max_messages=500)
 
 # setup del logging nel canale dedicato
 logger = BotLogger.create_instance(bot)
@@ -6,12 +6,17 @@ from typing import Any, Dict, List
 import discord
 from discord.ext import commands
 
+from aflbot import AFLBot
 from utils import shared_functions
 from utils.archive import Archive
 from utils.banned_words import BannedWords
 from utils.bot_logger import BotLogger
+from utils.channel_registry import ChannelRegistry
 from utils.paths import BANNED_WORDS_FILE, CONFIG_FILE, EXTENSIONS_FILE
 from utils.config import Config
+from utils.dank_timer import DankTimer
+from utils.proposals import Proposals
+from utils.voters import EligibleVoters
 
 
 class ConfigCog(commands.Cog, name='Configurazione'):
@@ -31,10 +36,13 @@ class ConfigCog(commands.Cog, name='Configurazione'):
     - addexception      permette di escludere canali dal controllo parole bannate
     - removeexception   riattiva il controllo delle parole bannate nel canale
     - refresharchive    rilegge l'archivio dal file
+    - checkproposals    ricontrolla da capo il canale delle proposte
+    - perfstats         mostra i tempi della pipeline e della coda dei messaggi
+    - synccommands      forza la sincronizzazione degli slash command
     """
 
-    def __init__(self, bot: commands.Bot):
-        self.bot: commands.Bot = bot
+    def __init__(self, bot: AFLBot):
+        self.bot: AFLBot = bot
         self.logger: BotLogger = BotLogger.get_instance()
         self.config: Config = Config.get_config()
 
@@ -120,6 +128,8 @@ class ConfigCog(commands.Cog, name='Configurazione'):
         <updateconfig     # ricarica tutti i parametri dal file
         """
         if Config.get_config().load():
+            # i ruoli con diritto di voto potrebbero essere cambiati
+            EligibleVoters.get_instance().rebuild(self.config.guild.members)
             await self.logger.log('aggiornata configurazione')
             await ctx.send('Configurazione ricaricata correttamente')
         else:
@@ -168,7 +178,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
                 await ctx.message.delete(delay=5)
         if reloaded != '':
             # sync degli slash commands
-            await self.bot.tree.sync()
+            await self.bot.sync_commands()
             await self.logger.log(f'estensioni {reloaded} ricaricate correttamente.')
             await ctx.send(f'Estensioni {reloaded} ricaricate correttamente.')
 
@@ -215,7 +225,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
                 await self.logger.log(f'estensioni {added} aggiunte correttamente')
                 await ctx.send(f'Estensioni {added} aggiunte correttamente.')
                 # sync degli slash commands
-                await self.bot.tree.sync()
+                await self.bot.sync_commands()
             shared_functions.update_json_file(extensions, EXTENSIONS_FILE)
 
     @commands.command(brief='rimuove una o più cog dal bot e dal file extensions.json')
@@ -250,7 +260,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
                 await self.logger.log(f'estensioni {removed} rimosse correttamente')
                 await ctx.send(f'Estensioni {removed} rimosse correttamente.')
                 # sync degli slash commands
-                await self.bot.tree.sync()
+                await self.bot.sync_commands()
             shared_functions.update_json_file(extensions, EXTENSIONS_FILE)
 
     @commands.command(brief='lista delle estensioni caricate all\'avvio')
@@ -274,6 +284,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
         - ruoli oratore e cazzaro
         - cooldown setnick
         - giorni per reset violazioni
+        - lavori in coda oltre cui scartare le risposte non essenziali
 
         Sintassi: <setthreshold [parametro] [valore]
 
@@ -286,6 +297,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
         tw-cazzaro  7           giorni  finestra di tempo cazzaro
         setnick     30          giorni  cooldown setnick
         violazioni  7           giorni  reset violazioni
+        backlog     50          lavori  coda oltre cui scartare le risposte non essenziali
 
         Ogni comando può essere abbreviato con la prima lettera di ogni soglia.
         E.g.  '<setthreshold o 100' al posto di '<setthreshold oratore 100'
@@ -320,6 +332,9 @@ class ConfigCog(commands.Cog, name='Configurazione'):
         elif category.startswith('v'):
             self.config.violations_reset_days = int(value)
             msg = f'Giorni per il reset delle violazioni cambiati a {value}'
+        elif category.startswith('b'):
+            self.config.shed_backlog = int(value)
+            msg = f'Soglia della coda per le risposte non essenziali cambiata a {value} lavori'
         else:
             await ctx.send('Comando errato, controlla la sintassi')
             return
@@ -348,6 +363,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
             return
         if int_id not in self.config.exceptional_channels_id:
             self.config.exceptional_channels_id.append(int_id)
+            ChannelRegistry.get_instance().rebuild(self.config)
             await self.logger.log('canale <#' + id + '> aggiunto ai canali esclusi')
             await ctx.send('Canale <#' + id + '> aggiunto ai canali esclusi')
             self.config.save()
@@ -375,6 +391,7 @@ class ConfigCog(commands.Cog, name='Configurazione'):
             return
         if int_id in self.config.exceptional_channels_id:
             self.config.exceptional_channels_id.remove(int_id)
+            ChannelRegistry.get_instance().rebuild(self.config)
             await self.logger.log('canale <#' + id + '> rimosso dai canali esclusi')
             await ctx.send('Canale <#' + id + '> rimosso dai canali esclusi')
             self.config.save()
@@ -389,10 +406,66 @@ class ConfigCog(commands.Cog, name='Configurazione'):
         in 'afler.json.old'.
         """
         Archive.refresh()
+        DankTimer.get_instance().rebuild(Archive.get_instance())
         await ctx.send('Archivio ricaricato correttamente')
         await self.logger.log('Archivio ricaricato correttamente')
 
+    @commands.command(brief='ricontrolla da capo il canale delle proposte', aliases=['checkp'])
+    async def checkproposals(self, ctx: commands.Context) -> None:
+        """Esegue il controllo di integrità delle proposte rileggendo il
+        canale a partire dalla proposta aperta più vecchia, invece di
+        ripartire dall'ultimo messaggio esaminato come fa la task periodica.
+        Utile se si sospetta che voti o proposte non siano allineati.
 
-async def setup(bot: commands.Bot):
+        Sintassi:
+        <checkproposals     # scansione completa del canale proposte
+        alias: checkp
+        """
+        messages = await Proposals.get_instance().check_proposals_integrity(full=True)
+        await ctx.send(f'Controllo completato, {len(messages)} proposte aperte')
+        await self.logger.log('eseguito controllo completo delle proposte')
+
+    @commands.command(brief='mostra i tempi della pipeline e della coda dei messaggi', aliases=['perf'])
+    async def perfstats(self, ctx: commands.Context) -> None:
+        """Mostra per ogni fase della pipeline dei messaggi il numero di
+        esecuzioni e il tempo medio e massimo impiegato, dall'avvio del bot.
+        Mostra inoltre lo stato della coda dei lavori: lavori eseguiti,
+        falliti e scartati per sovraccarico, profondità e tempi di attesa.
+
+        Sintassi:
+        <perfstats      # mostra le statistiche
+        alias: perf
+        """
+        response = ''
+        for name, stats in self.bot.pipeline.stats().items():
+            response += (f'`{name}`: {stats["calls"]} esecuzioni, media '
+                         f'{stats["avg_ms"]:.2f} ms, max {stats["max_ms"]:.2f} ms\n')
+        if response == '':
+            response = 'Nessuna fase registrata\n'
+        queue = self.bot.work_queue.stats()
+        response += (
+            f'\n**Coda lavori**: {queue["done"]}/{queue["submitted"]} eseguiti, '
+            f'{queue["failed"]} falliti, {queue["shed"]} scartati\n'
+            f'in attesa {queue["depth"]} (max {queue["max_depth"]}), attesa media '
+            f'{queue["avg_wait_ms"]:.2f} ms, max {queue["max_wait_ms"]:.2f} ms'
+        )
+        await ctx.send(response)
+
+    @commands.command(brief='forza la sincronizzazione degli slash command', aliases=['sync'])
+    async def synccommands(self, ctx: commands.Context) -> None:
+        """Sincronizza gli slash command con discord anche se l'albero dei
+        comandi non risulta cambiato dall'ultima sincronizzazione. Da usare
+        se i comandi mostrati da discord non corrispondono a quelli del bot.
+
+        Sintassi:
+        <synccommands   # sincronizza i comandi
+        alias: sync
+        """
+        await self.bot.sync_commands(force=True)
+        await self.logger.log('slash command sincronizzati manualmente')
+        await ctx.send('Slash command sincronizzati.')
+
+
+async def setup(bot: AFLBot):
     """Entry point per il caricamento della cog"""
     await bot.add_cog(ConfigCog(bot))
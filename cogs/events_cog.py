@@ -6,9 +6,12 @@ Contiene anche due comandi:
 - presentation  per consentire ai nuovi membri di presentarsi
 """
 
+import asyncio
 import re
 from datetime import date, datetime, time as t, timedelta
 from enum import Enum
+from functools import partial
+import logging
 # tzset is not available on windows
 # this is not a fix, just a workaround to allow testing on windows
 # since the bot will run on a linux server
@@ -18,7 +21,8 @@ except ImportError:
     def tzset():
         ...
 
-from typing import Sequence, Tuple
+from time import perf_counter
+from typing import Awaitable, ClassVar, List, Optional, Sequence, Tuple
 
 import discord
 from discord.ext import commands, tasks
@@ -28,24 +32,41 @@ from aflbot import AFLBot
 from utils import shared_functions as sf
 from utils.afler import Afler
 from utils.archive import Archive
+from utils.audit_index import AuditIndex
 from utils.banned_words import BannedWords
 from utils.bot_logger import BotLogger
+from utils.channel_registry import ChannelRegistry, ChannelRole
 from utils.config import Config
+from utils.dm_dispatcher import DMDispatcher
+from utils.counters import Counters
+from utils.dank_timer import DankTimer
+from utils.evidence_store import EvidenceStore
+from utils.member_snapshot import MemberSnapshot
+from utils.message_ledger import MessageLedger
+from utils.message_pipeline import MessageContext
 from utils.proposals import Proposals
+from utils.voters import EligibleVoters
+
+_log = logging.getLogger(__name__)
 
 
 class EventCog(commands.Cog):
     """Gli eventi gestiti sono elencati qua sotto, raggruppati per categoria
     (nomi eventi autoesplicativi).
-    Messaggi:
-    - on_message
-    - on_message_delete
-    - on_message_edit
+    Messaggi (nuovi e modificati sono gestiti come fasi della pipeline
+    dei messaggi, vedi cog_load):
+    - on_raw_message_delete
+    - on_raw_bulk_message_delete
 
     Reazioni:
     - on_raw_reaction_add
     - on_raw_reaction_remove
 
+    Canali:
+    - on_guild_channel_create
+    - on_guild_channel_update
+    - on_guild_channel_delete
+
     Membri:
     - on_member_join
     - on_member_remove
@@ -59,6 +80,9 @@ class EventCog(commands.Cog):
     Inoltre è presente un comando per aggiornare lo status del bot
     """
 
+    coherency_concurrency: ClassVar[int] = 5
+    coherency_progress_step: ClassVar[int] = 50
+
     def __init__(self, bot: AFLBot):
         self.bot: AFLBot = bot
         self.bot.version = 'v2.4.6'
@@ -66,6 +90,15 @@ class EventCog(commands.Cog):
         self.logger: BotLogger = BotLogger.get_instance()
         self.config: Config = Config.get_config()
         self.proposals: Proposals = Proposals.get_instance()
+        self.voters: EligibleVoters = EligibleVoters.get_instance()
+        self.counters: Counters = Counters.get_instance()
+        self.channels: ChannelRegistry = ChannelRegistry.get_instance()
+        self.ledger: MessageLedger = MessageLedger.get_instance()
+        self.dank_timer: DankTimer = DankTimer.get_instance()
+        self.snapshot: MemberSnapshot = MemberSnapshot.get_instance()
+        self._coherency_lock = asyncio.Lock()
+        self._maintenance_task: Optional[asyncio.Task] = None
+        self._dank_task: Optional[asyncio.Task] = None
 
     @commands.command(brief='aggiorna lo stato del bot')
     async def updatestatus(self, ctx: commands.Context):
@@ -139,158 +172,254 @@ class EventCog(commands.Cog):
         await self.config.welcome_channel.send(embed=welcomeMessage)
         return
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        """Azioni da eseguire ad ogni messaggio. Ignora i messaggi provenienti da:
+    async def cog_load(self) -> None:
+        """Registra le fasi della pipeline dei messaggi gestite dalla cog.
+        Ignorano i messaggi provenienti da:
         - il bot stesso
         - altri bot
         - canali di chat privata
-        Il messaggio 'ping' ritorna l'intervallo di tempo tra un HEARTBEAT e il suo ack in ms.
-        Se il messaggio è nel canale di presentazione, ammette il membro automaticamente assegnandogli
-        il ruolo AFL.
         Per la parte di moderazione, vedere 'moderation_cog.py'.
+        Le fasi decidono subito come gestire il messaggio ma accodano le
+        chiamate a discord nella work_queue del bot, ordinate per canale.
         """
-        if not sf.relevant_message(message):
-            return
-        assert isinstance(message.author, discord.Member)
-        # Risposte dirette
-        if message.content.lower() == 'ping':
+        pipeline = self.bot.pipeline
+        pipeline.register('log modifiche', 5, self._edit_log_stage,
+                          on_message=False, on_edit=True)
+        pipeline.register('risposte', 20, self._replies_stage)
+        pipeline.register('presentazioni', 30, self._presentation_stage)
+        pipeline.register('proposte', 40, self._proposals_stage)
+        pipeline.register('contatori', 50, self._counters_stage)
+        pipeline.register('link', 60, self._links_stage)
+        self.counters_commit.start()
+
+    async def _edit_log_stage(self, ctx: MessageContext) -> bool:
+        """Registra le modifiche dei messaggi nel log."""
+        assert ctx.before is not None
+        assert isinstance(
+            ctx.message.channel, (discord.abc.GuildChannel, discord.Thread))
+        diff = sf.evaluate_diff(ctx.before.content, ctx.message.content)
+        msg = f'messaggio di {ctx.message.author.mention} modificato in {ctx.message.channel.mention}:\n{diff}'
+        AuditIndex.get_instance().record(
+            'modificato', f'{ctx.before.content}\n{ctx.message.content}',
+            member_id=ctx.message.author.id, channel_id=ctx.message.channel.id,
+            message_id=ctx.message.id)
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(self.logger.log, msg), name='log modifica')
+        return False
+
+    async def _replies_stage(self, ctx: MessageContext) -> bool:
+        """Il messaggio 'ping' ritorna l'intervallo di tempo tra un HEARTBEAT
+        e il suo ack in ms. Le risposte non sono essenziali e vengono
+        scartate se il bot è sovraccarico.
+        """
+        if ctx.content == 'ping':
             response = f'pong in {round(self.bot.latency * 1000)} ms'
-            await message.channel.send(response)
-            return
-        if re.match(r'^(420|69|\s)+$', message.content.lower()):
+        elif re.match(r'^(420|69|\s)+$', ctx.content):
             response = 'nice'
-            await message.channel.send(response)
-            return
-        # Gestione delle presentazioni
-        if message.channel == self.config.presentation_channel:
-            # non deve rispondere a eventuali messaggi di moderatori nel canale, solo a nuovi membri
-            if any(x in self.config.moderation_roles for x in message.author.roles):
-                return
-            # a tutti gli altri dice di presentarsi
-            reply = await message.reply('Presentati usando il comando `/presentation`')
-            await message.delete(delay=2)
-            await reply.delete(delay=3)
-            return
-        # Gestione delle proposte
-        if message.channel == self.config.poll_channel:
-            await self.proposals.add_proposal(message)
-            return
-        # Ignoro i comandi
-        if self.is_command(message):
-            return
-        # Eventuale incremento dei contatori
-        await self.increase_counter(message)
-        # Gestione dei link
+        else:
+            return False
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(ctx.message.channel.send, response),
+            name='risposta', essential=False)
+        return True
+
+    async def _presentation_stage(self, ctx: MessageContext) -> bool:
+        """Nel canale di presentazione invita i nuovi membri a usare il
+        comando /presentation.
+        """
+        message = ctx.message
+        if not ctx.channel_role & ChannelRole.PRESENTATION:
+            return False
+        assert isinstance(message.author, discord.Member)
+        # non deve rispondere a eventuali messaggi di moderatori nel canale, solo a nuovi membri
+        if any(x in self.config.moderation_roles for x in message.author.roles):
+            return True
+        # a tutti gli altri dice di presentarsi
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(self._ask_presentation, message),
+            name='invito presentazione')
+        return True
+
+    async def _ask_presentation(self, message: discord.Message) -> None:
+        reply = await message.reply('Presentati usando il comando `/presentation`')
+        await message.delete(delay=2)
+        await reply.delete(delay=3)
+
+    async def _proposals_stage(self, ctx: MessageContext) -> bool:
+        """Gestione delle proposte."""
+        if not ctx.channel_role & ChannelRole.POLL:
+            return False
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(self.proposals.add_proposal, ctx.message),
+            name='nuova proposta')
+        return True
+
+    async def _counters_stage(self, ctx: MessageContext) -> bool:
+        """Eventuale incremento dei contatori. Ignora i comandi."""
+        if ctx.is_command:
+            return True
+        await self.increase_counter(ctx.message, ctx.channel_role)
+        return False
+
+    async def _links_stage(self, ctx: MessageContext) -> bool:
+        """Gestione dei link: se il messaggio contiene link da ripulire lo
+        riposta con i link ripuliti ed elimina l'originale.
+        """
+        if not ctx.urls:
+            return False
+        message = ctx.message
         cleaned_message = sf.clean_links(message.content)
-        if cleaned_message != message.content:
-            # Il contributo va considerato anche qui per ovviare all'eventuale eliminazione
-            await self.increase_counter(message)
-            # Se ci sono allegati, vanno riportati
-            if len(message.attachments) > 0:
-                attachments = []
-                for a in message.attachments:
-                    try:
-                        attachments.append(await a.to_file(spoiler=a.is_spoiler()))
-                    except (discord.Forbidden, discord.HTTPException, discord.NotFound):
-                        # Skippa eventuali file non più raggiungibili, rip
-                        pass
-                await message.channel.send(
-                        f'Da {message.author.mention}:\n{cleaned_message}',
-                        files=attachments
-                )
-            else:
-                await message.channel.send(f'Da {message.author.mention}:\n{cleaned_message}')
-            # Messaggio eliminato solo alla fine per scaricare eventuali allegati correttamente
-            await message.delete()
+        if cleaned_message == message.content:
+            return False
+        # il contributo è già stato conteggiato, la cancellazione
+        # dell'originale non deve decrementarlo
+        self.ledger.pop(message.id)
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(self._repost, message, cleaned_message),
+            name='link')
+        return True
+
+    async def _repost(self, message: discord.Message, cleaned_message: str) -> None:
+        """Riposta il messaggio con i link ripuliti ed elimina l'originale."""
+        # Se ci sono allegati, vanno riportati
+        if len(message.attachments) > 0:
+            attachments = []
+            for a in message.attachments:
+                try:
+                    attachments.append(await a.to_file(spoiler=a.is_spoiler()))
+                except (discord.Forbidden, discord.HTTPException, discord.NotFound):
+                    # Skippa eventuali file non più raggiungibili, rip
+                    pass
+            await message.channel.send(
+                    f'Da {message.author.mention}:\n{cleaned_message}',
+                    files=attachments
+            )
+        else:
+            await message.channel.send(f'Da {message.author.mention}:\n{cleaned_message}')
+        # Messaggio eliminato solo alla fine per scaricare eventuali allegati correttamente
+        await message.delete()
 
-    async def increase_counter(self, message: discord.Message) -> None:
-        """Controlla la categoria del canale in cui è stato mandato il
-        messaggio ed incrementa il contatore corretto di conseguenza.
+    async def increase_counter(self, message: discord.Message, role: ChannelRole) -> None:
+        """Incrementa il contatore corrispondente al ruolo del canale in cui
+        è stato mandato il messaggio (vedi Counters.count). L'incremento è
+        riportato sull'archivio da counters_commit, tranne quando il
+        messaggio potrebbe far superare la soglia del ruolo cazzaro, che
+        deve essere assegnato subito.
 
         :param message: il messaggio mandato
+        :param role: il ruolo del canale del messaggio
         """
-        # Gestione contatori per i ruoli oratore e cazzaro
-        if self.valid_for_orator(message):
-            # incrementa il conteggio
-            afler = self.archive.get(message.author.id)
-            afler.increase_orator_buffer()
-            self.archive.save()
-        elif self.valid_for_dank(message):
-            if message.author.id in self.archive.keys():
-                afler = self.archive.get(message.author.id)
-            else:
-                afler = Afler.new_entry(message.author.display_name)
-                self.archive.add(message.author.id, afler)
-            # incrementa il conteggio
-            afler.increase_dank_counter()
-            if afler.is_eligible_for_dank():
-                await self.set_dank(afler, message.author.id)
-            elif afler.is_dank_expired():
-                await self.remove_dank_from_afler(afler, message.author.id)
-            self.archive.save()
+        if self.counters.count(message.id, message.author, role):
+            await self._submit_commit()
+
+    async def _submit_commit(self) -> None:
+        # commit periodici e per superamento della soglia passano dalla coda
+        # per non bloccare la pipeline; quelli diretti (cancellazioni,
+        # controllo giornaliero) sono serializzati dal lock in Counters.commit
+        await self.bot.work_queue.submit(
+            self.config.dank_category_id, self.counters.commit,
+            name='contatori')
+
+    @tasks.loop(seconds=10)
+    async def counters_commit(self):
+        """Task che riporta periodicamente sull'archivio i contatori
+        accumulati, avviata al caricamento della cog.
+        """
+        try:
+            await self._submit_commit()
+            if self.ledger.dirty:
+                self.ledger.save()
+        except Exception:
+            # un'eccezione non gestita fermerebbe la task
+            _log.exception('errore nel salvataggio dei contatori')
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
-        """Invocata alla cancellazione di un messaggio. Se era una proposta, questa viene rimossa.
-        Se tale messaggio proveniva da un canale conteggiato occorre decrementare
-        il contatore dell'utente corrispondente di uno.
-        Per cancellazioni in bulk vedi il comando delete nel cog di moderazione.
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """Invocata alla cancellazione di un messaggio, anche se non è più
+        nella cache. Se era una proposta, questa viene rimossa.
+        Se tale messaggio aveva incrementato un contatore (vedi MessageLedger)
+        occorre decrementare il contatore dell'utente corrispondente di uno.
+        Il contenuto viene loggato e aggiunto all'indice di moderazione solo
+        se il messaggio è ancora in cache.
         """
-        if not isinstance(
-                message.channel, (discord.abc.GuildChannel, discord.Thread)):
+        if payload.guild_id != self.config.guild_id:
             return
-        if message.channel == self.config.poll_channel:
-            if message.author.bot and message.embeds[0].color == discord.Color.orange():
-                await self.proposals.remove_proposal(message.id)
+        if payload.channel_id == self.config.poll_channel_id:
+            if self.proposals.get_proposal(payload.message_id) is not None:
+                await self.proposals.remove_proposal(payload.message_id)
             return
-        if not sf.relevant_message(message):
+        message = payload.cached_message
+        if message is not None and (
+                not sf.relevant_message(message)
+                or sf.is_command(message.content, self.config.current_prefix)):
+            # i comandi non sono conteggiati e sono eliminati dal bot stesso
             return
-        try:
-            item = self.archive.get(message.author.id)
-        except KeyError:
-            await self.logger.log(f'cancellato il messaggio di un membro non più presente nel server\n{message.author.mention}: {message.content}')
-            return
-        else:
-            counter = ''
-            if self.is_command(message):
-                # non devo decrementare nulla perchè i comandi non contano
-                return
-            elif self.valid_for_orator(message):
-                item.decrease_orator_buffer()
-                counter = f'decrementato contatore orator di {message.author.mention}'
-            elif self.valid_for_dank(message):
-                item.decrease_dank_counter()
-                counter = f'decrementato contatore dank di {message.author.mention}'
-            self.archive.save()
+        counter = await self.counters.uncount((payload.message_id,))
+        if message is not None:
+            assert isinstance(
+                message.channel, (discord.abc.GuildChannel, discord.Thread))
             msg = f'messaggio di {message.author.mention} cancellato in {message.channel.mention}\n    {message.content}'
-        await self.logger.log(f'{msg}\n\n{counter}', media=message.attachments)
+            AuditIndex.get_instance().record(
+                'eliminato', message.content, member_id=message.author.id,
+                channel_id=message.channel.id, message_id=message.id)
+            await self.logger.log_evidence(f'{msg}\n\n{counter}', message.attachments)
+        elif counter:
+            await self.logger.log(f'messaggio non più in cache cancellato in <#{payload.channel_id}>\n\n{counter}')
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        """Registra le modifiche dei messaggi nel log."""
-        if not sf.relevant_message(before):
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """Invocata alla cancellazione in blocco di più messaggi (es. comando
+        delete). Decrementa in un'unica volta i contatori dei messaggi
+        conteggiati, con un solo log riassuntivo, e rimuove le eventuali
+        proposte. Il contenuto dei messaggi è loggato dal comando delete nel
+        cog di moderazione, quelli ancora in cache sono aggiunti all'indice
+        di moderazione.
+        """
+        if payload.guild_id != self.config.guild_id:
             return
-        assert isinstance(
-            before.channel, (discord.abc.GuildChannel, discord.Thread))
-        # va esplicitato il controllo affinché si considerino solamente
-        # le modifiche effettive (ad esempio non l'aggiunta di un embed
-        # che essendo vista come una modifica triggererebbe il metodo)
-        if before.content != after.content:
-            diff = sf.evaluate_diff(before.content, after.content)
-            await self.logger.log(f'messaggio di {before.author.mention} modificato in {before.channel.mention}:\n{diff}')
+        if payload.channel_id == self.config.poll_channel_id:
+            for message_id in payload.message_ids:
+                if self.proposals.get_proposal(message_id) is not None:
+                    await self.proposals.remove_proposal(message_id)
+            return
+        index = AuditIndex.get_instance()
+        for message in payload.cached_messages:
+            if (sf.relevant_message(message)
+                    and not sf.is_command(message.content, self.config.current_prefix)):
+                index.record('eliminato', message.content, member_id=message.author.id,
+                             channel_id=message.channel.id, message_id=message.id)
+        counter = await self.counters.uncount(payload.message_ids)
+        if counter:
+            await self.logger.log(
+                f'{len(payload.message_ids)} messaggi cancellati in blocco in '
+                f'<#{payload.channel_id}>\n\n{counter}')
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        """Classifica il nuovo canale nel registro dei canali."""
+        self.channels.update(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        """Aggiorna il registro dei canali, ad esempio se il canale è stato
+        spostato in un'altra categoria.
+        """
+        self.channels.update(after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        """Rimuove il canale eliminato dal registro dei canali."""
+        self.channels.remove(channel.id)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         """Invia il messaggio di benvenuto all'utente entrato nel server."""
         if member.bot:
             return
+        self.voters.update(member)
         if member == self.config.guild.owner:
             return
-        # Ignora la cache per risolvere #68
-        new_user = await self.bot.fetch_user(member.id)
-        # Impone il nickname per semplificare i controlli di coerenza
-        await member.edit(nick=new_user.display_name)
+        await self._enforce_nick(member)
         # Manda il benvenuto nel canale del server
         await self.config.presentation_channel.send(
             f'Benvenuto su AFL, {member.mention}! Presentati usando il comando `/presentation`')
@@ -301,6 +430,8 @@ class EventCog(commands.Cog):
         """Rimuove, se presente, l'utente da aflers.json nel momento in cui lascia il server."""
         if member.bot:
             return
+        self.voters.discard(member.id)
+        self.snapshot.discard(member.id)
         await self.logger.log(f'membro {member.mention} ({member.name}) rimosso/uscito dal server')
         self.archive.remove(member.id)
         self.archive.save()
@@ -315,6 +446,8 @@ class EventCog(commands.Cog):
         """
         if before.bot:
             return
+        if before.roles != after.roles:
+            self.voters.update(after)
         if before == self.config.guild.owner:
             return
 
@@ -350,7 +483,9 @@ class EventCog(commands.Cog):
         report = self.check_new_nickname(new_nick, before.id)
         if not report[0]:
             # nickname non disponibile in ogni caso
-            await before.send(escape_markdown(
+            AuditIndex.get_instance().record(
+                'nickname', f'{before.nick} -> {new_nick} bloccato: {report[1]}', member_id=before.id)
+            DMDispatcher.get_instance().send(before, escape_markdown(
                 f'Modifica del nick in {new_nick} bloccata.\n'
                 f'Motivo: {report[1]}.'
             ))
@@ -375,6 +510,8 @@ class EventCog(commands.Cog):
             # aggiorno il nickname nell'archivio
             afler.nick = new_nick
             self.archive.save()
+            AuditIndex.get_instance().record(
+                'nickname', f'{before.nick} -> {new_nick} approvato', member_id=before.id)
             await self.logger.log(escape_markdown(
                 f'modifica del nickname di {before.mention} '
                 f'({before.nick} -> {new_nick}) approvata.'
@@ -383,8 +520,11 @@ class EventCog(commands.Cog):
             # avvisa membro quando potrà cambiare nick
             renewal = datetime.combine(afler.last_nick_change, t(0, 0))
             renewal = sf.next_datetime(renewal, self.config.nick_change_days)
+            AuditIndex.get_instance().record(
+                'nickname', f'{before.nick} -> {new_nick} bloccato: prossimo rinnovo il {renewal.date()}',
+                member_id=before.id)
             renewal = discord.utils.format_dt(renewal, 'D')
-            await before.send(escape_markdown(
+            DMDispatcher.get_instance().send(before, escape_markdown(
                 f'Modifica del nick in {new_nick} bloccata. '
                 f'Potrai cambiare nuovamente nickname su AFL il {renewal}.'
             ))
@@ -409,7 +549,8 @@ class EventCog(commands.Cog):
         assert payload.member is not None
         if payload.member.bot:
             return
-        message = await self.config.poll_channel.fetch_message(payload.message_id)
+        # per rimuovere le reaction basta il messaggio parziale, senza fetch
+        message = self.config.poll_channel.get_partial_message(payload.message_id)
         if not (payload.emoji.name in ('🟢', '🔴') and self._check_reaction_permissions(payload)):
             await message.remove_reaction(payload.emoji, payload.member)
             return
@@ -421,15 +562,17 @@ class EventCog(commands.Cog):
         author = self.config.guild.get_member(proposal.author)
         assert author is not None
         # rimuove l'eventuale voto opposto
-        try:
-            other_react = [
-                react for react in message.reactions if react.emoji != payload.emoji.name].pop()
-            await message.remove_reaction(other_react, payload.member)
+        other_vote = '🔴' if payload.emoji.name == '🟢' else '🟢'
+        if self.proposals.may_have_voted(payload.message_id, payload.user_id, other_vote):
+            try:
+                await message.remove_reaction(other_vote, payload.member)
+            except discord.NotFound:
+                pass
             # TODO impedire a on_raw_reaction_remove di loggare la rimozione
             # della proposta quando viene rimossa per questo motivo, per
             # evitare di loggare due volte un cambio.
             await self.logger.log(f'cambiato voto alla proposta di {author.mention}:\n{proposal.content}')
-        except (IndexError, discord.NotFound):
+        else:
             await self.logger.log(f'aggiunto voto alla proposta di {author.mention}:\n{proposal.content}')
         self.proposals.adjust_vote_count(payload, 1)
 
@@ -452,6 +595,23 @@ class EventCog(commands.Cog):
         self.proposals.adjust_vote_count(payload, -1)
         await self.logger.log(f'rimosso voto dalla proposta di {author.mention}:\n{proposal.content}')
 
+    async def cog_unload(self) -> None:
+        """Rimuove le fasi dalla pipeline dei messaggi e salva i contatori e
+        i voti in attesa di scrittura quando la cog viene scaricata (anche
+        allo spegnimento del bot).
+        """
+        for stage in ('log modifiche', 'risposte', 'presentazioni',
+                      'proposte', 'contatori', 'link'):
+            self.bot.pipeline.unregister(stage)
+        self.counters_commit.cancel()
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        if self._dank_task is not None:
+            self._dank_task.cancel()
+        self.counters.buffer.flush()
+        self.ledger.save()
+        self.proposals.flush()
+
     def _check_reaction_permissions(self, payload: discord.RawReactionActionEvent) -> bool:
         """Controlla se la reazione è stata messa nel canale proposte da un membro che
         ne ha diritto, ovvero se:
@@ -466,9 +626,8 @@ class EventCog(commands.Cog):
         :rtype: bool
         """
         assert payload.member is not None
-        return (payload.event_type == 'REACTION_ADD' and (
-            self.config.orator_role in payload.member.roles or
-            any(role in self.config.moderation_roles for role in payload.member.roles)))
+        return (payload.event_type == 'REACTION_ADD' and
+                self.voters.is_eligible(payload.member.id))
 
     def check_new_nickname(self, new_nick: str, afler_id: int) -> Tuple[bool, str]:
         """Controlla se il nuovo nickname di un afler sia valido.
@@ -555,7 +714,14 @@ class EventCog(commands.Cog):
             print('Errore nel caricamento dei parametri del bot:', e)
             await self.bot.close()
             exit()
-        await self.bot.tree.sync()
+        self.voters.rebuild(self.config.guild.members)
+        # timer di chiusura delle proposte aperte
+        self.proposals.start()
+        # timer di scadenza dei ruoli cazzaro
+        self.dank_timer.rebuild(self.archive)
+        if self._dank_task is None or self._dank_task.done():
+            self._dank_task = asyncio.create_task(self.expire_dank())
+        await self.bot.sync_commands()
         # salva il timestamp di avvio nel bot
         self.bot.start_time = datetime.now()
         botstat = discord.CustomActivity(name=f'{self.bot.version}')
@@ -580,7 +746,9 @@ class EventCog(commands.Cog):
     async def periodic_checks(self):
         """Task periodica per la gestione di:
             - controllo sulle proposte
-            - controllo su messaggi e violazioni
+            - controllo su messaggi e violazioni (avviato qui e distribuito
+              nell'ora successiva, vedi Counters.maintain)
+            - pulizia dell'archivio degli allegati eliminati
         Viene avviata tramite la on_ready quando il bot ha completato la
         fase di setup ed è programmata per essere eseguita ad ogni mezzanotte.
         """
@@ -597,42 +765,30 @@ class EventCog(commands.Cog):
         await self.logger.log('controllo proposte...')
         await self.proposals.handle_proposals()
         await self.logger.log('controllo proposte terminato')
-        await self.logger.log('controllo conteggio messaggi e violazioni...')
-        await self.archive.handle_counters()
-        await self.logger.log('controllo conteggio messaggi e violazioni terminato')
-        self.archive.save()
-
-    async def remove_dank_from_afler(self, afler: Afler, id: int) -> None:
-        """Rimuove il ruolo cazzaro dall'afler.
-
-        :param afler: l'istanza nell'archivio dell'afler a cui rimuovere il ruolo
-        :param id: l'id di discord dell'afler
+        self._start_maintenance()
+        purged = EvidenceStore.get_instance().purge()
+        if purged > 0:
+            await self.logger.log(f'rimossi {purged} allegati scaduti dall\'archivio')
+
+    def _start_maintenance(self) -> None:
+        """Avvia il controllo dei contatori del giorno, sostituendo un
+        eventuale controllo del giorno precedente ancora in corso.
         """
-        member = self.config.guild.get_member(id)
-        assert member is not None
-        await member.remove_roles(self.config.dank_role)
-        msg = f'{member.mention} non è più un {self.config.dank_role.mention}'
-        await self.logger.log(msg)
-        await self.config.main_channel.send(embed=discord.Embed(description=f'{msg} :)'))
-        afler.remove_dank()
-
-    async def set_dank(self, afler: Afler, id: int) -> None:
-        """Imposta il ruolo cazzaro dall'afler.
-
-        :param afler: l'istanza nell'archivio dell'afler a cui conferire il ruolo
-        :param id: l'id di discord dell'afler
+        if self._maintenance_task is not None and not self._maintenance_task.done():
+            self._maintenance_task.cancel()
+        self._maintenance_task = asyncio.create_task(self.counters.maintain())
+
+    async def expire_dank(self) -> None:
+        """Task in background che rimuove il ruolo cazzaro all'ora di
+        scadenza (vedi Counters.expire_dank), attendendo di volta in volta
+        la prima scadenza del DankTimer.
         """
-        member = self.config.guild.get_member(id)
-        assert member is not None
-        await member.add_roles(self.config.dank_role)
-        msg = ''
-        if afler.dank:
-            msg = f'{member.mention}: rinnovato ruolo {self.config.dank_role.mention}'
-        else:
-            msg = f'{member.mention} è diventato un {self.config.dank_role.mention}'
-        await self.logger.log(msg)
-        await self.config.main_channel.send(embed=discord.Embed(description=msg))
-        afler.set_dank()
+        while True:
+            try:
+                await self.counters.expire_dank()
+            except Exception:
+                _log.exception('errore nella rimozione dei ruoli cazzaro scaduti')
+            await self.dank_timer.wait()
 
     async def coherency_check(self, members: Sequence[discord.Member]) -> None:
         """Controlla la coerenza tra l'elenco membri del server e l'elenco
@@ -642,98 +798,163 @@ class EventCog(commands.Cog):
         In particolare si occupa di:
         - rimuovere membri usciti dal server
         - aggiungere membri non presenti
+        - re-invitare a presentarsi i nuovi membri
+        - ripristinare i nickname modificati mentre il bot era offline
+
+        Vengono esaminati solo i membri cambiati rispetto all'istantanea
+        salvata alla fine del controllo precedente (vedi MemberSnapshot),
+        più gli AFL mancanti dall'archivio.
+        Le modifiche all'archivio sono fatte subito, mentre le chiamate a
+        discord (nickname e dm) sono eseguite al più coherency_concurrency
+        alla volta. Al termine viene inviato un log riassuntivo, diviso in
+        più messaggi se troppo lungo; se il lavoro è molto viene segnalato
+        anche l'avanzamento.
 
         :param members: l'elenco dei membri del server
         """
-        archive_ids = set(self.archive.keys())
-        current_members = set(m for m in members if not m.bot)
-        ex_members = archive_ids.difference(set(m.id for m in current_members))
-        new_members = set(m for m in members if m.id not in archive_ids)
-        current_members = current_members.difference(new_members)
-        # rimuovere i membri usciti
-        for id in ex_members:
-            self.archive.remove(id)
-            # non posso usare member.mention perchè non è più membro
-            await self.logger.log(f"membro <@{id}> rimosso dall'archivio")
-        # aggiungere i nuovi membri entrati
-        for member in new_members:
-            if self.config.afl_role in member.roles:
-                # AFL non presente nell'archivio, aggiungi
-                self.archive.add(member.id, Afler.new_entry(member.display_name))
-            else:
-                # nuovo membro che non si è ancora presentato, re-invita a farlo
-                # TODO: salvare lista nuovi membri non presentati
-                await self.on_member_join(member)
-        # controllo che i nickname siano gli stessi settati nell'archivio
-        for member in current_members:
-            afler = self.archive.get(member.id)
-            if member.nick == afler.nick:
-                continue
-            if member == self.config.guild.owner:
-                afler.nick = member.display_name
-                continue
-            if member.nick is None:
-                await member.edit(nick=afler.nick)
-                continue
-            # nickname cambiato
-            report = self.check_new_nickname(member.nick, member.id)
-            if report[0] and afler.can_renew_nick():
-                await self.logger.log(f'nickname di {member.mention} modificato in {escape_markdown(member.nick)} (era {afler.escaped_nick})')
-                afler.nick = member.nick
-                continue
-            dm = member.dm_channel if member.dm_channel is not None else await member.create_dm()
-            if not report[0]:
-                # nickname non disponibile in ogni caso: invia motivo in dm
-                await dm.send(f'Cambio di nickname rifiutato. Motivo: {report[1]}')
-            else:
-                renewal = datetime.combine(afler.last_nick_change, t(0, 0))
-                renewal = sf.next_datetime(renewal, self.config.nick_change_days)
-                await dm.send(f'Potrai cambiare nickname nuovamente a partire dal {discord.utils.format_dt(renewal, "D")}')
-            await member.edit(nick=afler.nick)
-        self.archive.save()
-
-    def is_command(self, message: discord.Message) -> bool:
-        """Controlla se il messaggio è un comando testuale.
-        Serve per evitare di contare come messaggio inviato un comando.
-
-        :param message: il messaggio in questione
-
-        :returns: True se è un comando, altrimenti False
-        :rtype: bool
+        async with self._coherency_lock:
+            started = perf_counter()
+            afl_role = self.config.afl_role
+            archive_ids = set(self.archive.keys())
+            humans = [m for m in members if not m.bot]
+            ex_members = archive_ids.difference(m.id for m in humans)
+            self.snapshot.prune(m.id for m in humans)
+            examined = set(self.snapshot.changed(humans, afl_role))
+            examined.update(m for m in humans
+                            if m.id not in archive_ids and afl_role in m.roles)
+            new_members = set(m for m in examined if m.id not in archive_ids)
+            current_members = examined.difference(new_members)
+            # rimuovere i membri usciti
+            for id in ex_members:
+                self.archive.remove(id)
+            # aggiungere i nuovi membri entrati
+            added = 0
+            unpresented: List[discord.Member] = []
+            for member in new_members:
+                if afl_role in member.roles:
+                    # AFL non presente nell'archivio, aggiungi
+                    self.archive.add(member.id, Afler.new_entry(member.display_name))
+                    self.snapshot.record(member, afl_role)
+                    added += 1
+                else:
+                    # nuovo membro che non si è ancora presentato, re-invita a farlo
+                    # TODO: salvare lista nuovi membri non presentati
+                    self.voters.update(member)
+                    if member != self.config.guild.owner:
+                        unpresented.append(member)
+                    else:
+                        self.snapshot.record(member, afl_role)
+            # controllo che i nickname siano gli stessi settati nell'archivio
+            jobs: List[Awaitable[None]] = [self._enforce_nick(m) for m in unpresented]
+            renamed: List[str] = []
+            for member in current_members:
+                afler = self.archive.get(member.id)
+                if member.nick == afler.nick:
+                    self.snapshot.record(member, afl_role)
+                    continue
+                if member == self.config.guild.owner:
+                    afler.nick = member.display_name
+                    self.snapshot.record(member, afl_role)
+                    continue
+                if member.nick is None:
+                    jobs.append(self._restore_nick(member, afler.nick))
+                    continue
+                # nickname cambiato
+                report = self.check_new_nickname(member.nick, member.id)
+                if report[0] and afler.can_renew_nick():
+                    renamed.append(f'{member.mention}: {escape_markdown(member.nick)} (era {afler.escaped_nick})')
+                    afler.nick = member.nick
+                    self.snapshot.record(member, afl_role)
+                    continue
+                dms = DMDispatcher.get_instance()
+                if not report[0]:
+                    # nickname non disponibile in ogni caso: invia motivo in dm
+                    dms.send(member, f'Cambio di nickname rifiutato. Motivo: {report[1]}')
+                else:
+                    renewal = datetime.combine(afler.last_nick_change, t(0, 0))
+                    renewal = sf.next_datetime(renewal, self.config.nick_change_days)
+                    dms.send(member, f'Potrai cambiare nickname nuovamente a partire dal {discord.utils.format_dt(renewal, "D")}')
+                jobs.append(self._restore_nick(member, afler.nick))
+            self.archive.save()
+            failed = await self._run_coherency_jobs(jobs)
+            if unpresented:
+                await self._remind_presentation(unpresented)
+            self.snapshot.save()
+            elapsed = perf_counter() - started
+            summary = (f'controllo coerenza terminato in {elapsed:.1f}s, '
+                       f'{len(examined)} membri esaminati su {len(humans)}: '
+                       f'{len(ex_members)} rimossi, {added} aggiunti, '
+                       f'{len(unpresented)} da presentare, {len(renamed)} nickname aggiornati, '
+                       f'{len(jobs) - len(unpresented)} nickname ripristinati')
+            if failed:
+                summary += f', {failed} modifiche fallite'
+            lines = [summary]
+            if ex_members:
+                # non posso usare member.mention perchè non sono più membri
+                lines.append('rimossi dall\'archivio: ' + ' '.join(f'<@{id}>' for id in ex_members))
+            if renamed:
+                lines.append('nickname modificati:')
+                lines.extend(renamed)
+            # dopo un lungo downtime gli elenchi superano il limite di un embed
+            for chunk in sf.chunk_lines(lines):
+                await self.logger.log(chunk)
+
+    async def _run_coherency_jobs(self, jobs: List[Awaitable[None]]) -> int:
+        """Esegue le chiamate del controllo di coerenza al più
+        coherency_concurrency alla volta, segnalando l'avanzamento ogni
+        coherency_progress_step chiamate completate.
+
+        :param jobs: le chiamate da eseguire
+
+        :returns: il numero di chiamate fallite
+        :rtype: int
         """
-        # gestisce anche prefissi più lunghi
-        if message.content.startswith(self.config.current_prefix):
-            if not sf.discord_tag(message.content):
-                return True
-        return False
-
-    def valid_for_orator(self, message: discord.Message) -> bool:
-        """Verifica se il canale in cui è stato inviato il messaggio contribuisce
-        al ruolo oratore.
-
-        :param message: il messaggio inviato
-
-        :returns: True se il messaggio conta, False altrimenti
-        :rtype: bool
+        semaphore = asyncio.Semaphore(self.coherency_concurrency)
+        done = 0
+        failed = 0
+
+        async def run(job: Awaitable[None]) -> None:
+            nonlocal done, failed
+            async with semaphore:
+                try:
+                    await job
+                except discord.HTTPException:
+                    failed += 1
+                    _log.exception('errore nel controllo di coerenza')
+            done += 1
+            if done % self.coherency_progress_step == 0 and done < len(jobs):
+                await self.logger.log(f'controllo coerenza: {done}/{len(jobs)} modifiche eseguite')
+
+        await asyncio.gather(*(run(job) for job in jobs))
+        return failed
+
+    async def _enforce_nick(self, member: discord.Member) -> None:
+        """Impone come nickname il nome utente aggiornato del membro per
+        semplificare i controlli di coerenza.
         """
-        if isinstance(message.channel, (discord.abc.GuildChannel, discord.Thread)):
-            if message.channel.category_id == Config.get_config().orator_category_id:
-                return True
-        return False
-
-    def valid_for_dank(self, message: discord.Message) -> bool:
-        """Verifica se il canale in cui è stato inviato il messaggio contribuisce
-        al ruolo cazzaro.
+        # Ignora la cache per risolvere #68
+        new_user = await self.bot.fetch_user(member.id)
+        await member.edit(nick=new_user.display_name)
+        self.snapshot.record(member, self.config.afl_role, new_user.display_name)
 
-        :param message: il messaggio inviato
+    async def _restore_nick(self, member: discord.Member, nick: str) -> None:
+        """Reimposta il nickname salvato nell'archivio."""
+        await member.edit(nick=nick)
+        self.snapshot.record(member, self.config.afl_role, nick)
 
-        :returns: True se il messaggio conta, False altrimenti
-        :rtype: bool
+    async def _remind_presentation(self, members: Sequence[discord.Member]) -> None:
+        """Invita a presentarsi i membri non ancora presentati, con un solo
+        messaggio nel canale delle presentazioni (diviso se troppo lungo).
         """
-        if isinstance(message.channel, (discord.abc.GuildChannel, discord.Thread)):
-            if message.channel.category_id == Config.get_config().dank_category_id:
-                return True
-        return False
+        text = 'Benvenuto su AFL, {}! Presentati usando il comando `/presentation`'
+        mentions: List[str] = []
+        for member in members:
+            # margine per restare sotto il limite di 2000 caratteri
+            if len(text) + sum(len(m) + 1 for m in mentions) + len(member.mention) > 1900:
+                await self.config.presentation_channel.send(text.format(' '.join(mentions)))
+                mentions = []
+            mentions.append(member.mention)
+        await self.config.presentation_channel.send(text.format(' '.join(mentions)))
 
 
 async def setup(bot: AFLBot):
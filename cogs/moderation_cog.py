@@ -1,16 +1,26 @@
 """:class: ModerationCog contiene tutti i comandi per la moderazione."""
-from datetime import timedelta
-from typing import List, Optional, Union
+import asyncio
+import re
+from datetime import date, datetime, time, timedelta
+from functools import partial
+from typing import ClassVar, List, Optional, Union
+from time import perf_counter
 
 import discord
 from discord.ext import commands
 from discord.utils import MISSING
-from utils.shared_functions import relevant_message
+
+from aflbot import AFLBot
 from utils.afler import Afler
 from utils.archive import Archive
+from utils.audit_index import AuditIndex
 from utils.banned_words import BannedWords
 from utils.bot_logger import BotLogger
+from utils.channel_registry import ChannelRole
 from utils.config import Config
+from utils.dm_dispatcher import DMDispatcher
+from utils.message_pipeline import MessageContext
+from utils.role_scheduler import RoleScheduler
 
 
 class ModerationCog(commands.Cog, name='Moderazione'):
@@ -21,12 +31,17 @@ class ModerationCog(commands.Cog, name='Moderazione'):
     - unwarn     rimuove un warn all'utente citato
     - ban        banna l'utente citato
     - warncount  mostra i warn di tutti i membri
+    - audit      cerca nell'indice degli eventi di moderazione
     Inoltre effettua il controllo sul contenuto dei messaggi e elimina quelli dal contenuto inadatto.
     Questi comandi possono essere usati solo da coloro che possiedono un ruolo di moderazione.
     """
 
-    def __init__(self, bot: commands.Bot):
-        self.bot: commands.Bot = bot
+    delete_limit: ClassVar[int] = 1000
+    delete_concurrency: ClassVar[int] = 3
+    audit_results: ClassVar[int] = 15
+
+    def __init__(self, bot: AFLBot):
+        self.bot: AFLBot = bot
         self.archive: Archive = Archive.get_instance()
         self.logger: BotLogger = BotLogger.get_instance()
         self.config: Config = Config.get_config()
@@ -37,40 +52,41 @@ class ModerationCog(commands.Cog, name='Moderazione'):
             return False
         return ctx.author.top_role.id in self.config.moderation_roles_id
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
+    async def cog_load(self) -> None:
+        """Registra il filtro delle parole bannate nella pipeline dei
+        messaggi, sia per i nuovi messaggi che per quelli modificati così
+        da evitare tentativi di bypass della censura.
+        """
+        self.bot.pipeline.register(
+            'filtro', 10, self._filter_stage, on_message=True, on_edit=True)
+
+    async def cog_unload(self) -> None:
+        self.bot.pipeline.unregister('filtro')
+
+    async def _filter_stage(self, ctx: MessageContext) -> bool:
         """Elimina i messaggi inappropriati dai canali e aggiunge un
-        warn all'utente.
-        Ignora i messaggi da:
-        - il bot stesso
-        - altri bot
-        - canali di chat privata
-        - canali ignorati (vedi config.template)
+        warn all'utente. Ignora i canali esclusi (vedi config.template).
+        Se il messaggio viene eliminato le fasi successive non sono eseguite.
         """
-        if not relevant_message(message):
-            return
-        if not BannedWords.contains_banned_words(message.content):
-            return
-        if isinstance(message.channel, discord.Thread):
-            channel_id = message.channel.parent_id
-        else:
-            channel_id = message.channel.id
-        if channel_id in self.config.exceptional_channels_id:
-            return
+        if ctx.channel_role & ChannelRole.EXCEPTIONAL:
+            return False
+        if not BannedWords.contains_banned_words(ctx.message.content):
+            return False
+        # un nuovo messaggio filtrato non arriva ai contatori, quindi la
+        # sua cancellazione non ha nulla da decrementare
+        message = ctx.message
+        await self.bot.work_queue.submit(
+            ctx.channel_id, partial(self._punish, message), name='filtro')
+        return True
+
+    async def _punish(self, message: discord.Message) -> None:
+        """Elimina il messaggio filtrato e warna l'autore."""
         await message.delete()
         assert isinstance(message.author, discord.Member)
         await self.logger.log(f'aggiunto warn a {message.author.mention} per \
             linguaggio inappropriato:\n{message.content}')
         await self._add_warn(message.author, 'linguaggio inappropriato', 1)
 
-    @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        """Riesamina i messaggi dopo la modifica per evitare tentativi di
-        bypass della censura delle parole bannate.
-        """
-        if before.content != after.content:
-            await self.on_message(after)
-
     @commands.command(
         brief='elimina dei messaggi da un canale', aliases=['del', 'd']
     )
@@ -82,36 +98,91 @@ class ModerationCog(commands.Cog, name='Moderazione'):
         reason: Optional[str] = None,
     ):
         """Elimina una certa quantità di messaggi da un canale.
-        La quantità deve essere compresa tra 1 e 100
+        La quantità deve essere compresa tra 1 e 1000. Oltre i 100 messaggi
+        l'avanzamento viene mostrato nel canale.
 
         Sintassi:
         <delete amount          # elimina `amount` messaggi
         <delete amount reason   # allega un motivo al log della delete
         """
-        if amount is MISSING or amount <= 0 or amount > 100:
+        if amount is MISSING or amount <= 0 or amount > self.delete_limit:
             raise commands.CommandError
         assert isinstance(ctx.author, discord.Member)
         assert isinstance(
-            ctx.channel, (discord.abc.GuildChannel, discord.Thread)
+            ctx.channel, (discord.TextChannel, discord.VoiceChannel, discord.Thread)
         )
-        # prepara il log prima di eliminare i messaggi
+        # una sola lettura della cronologia, usata sia per il log che per
+        # l'eliminazione; il + 1 include il comando stesso
         messages = [m async for m in ctx.channel.history(limit=amount + 1)]
-        messages.pop(0)
+        command = messages.pop(0)
         messages.reverse()
         msg = (
-            f'{ctx.author.mention} ha eliminato {amount} messaggi in '
+            f'{ctx.author.mention} ha eliminato {len(messages)} messaggi in '
             + ctx.channel.mention
         )
         if reason is not None:
             msg += f'\n\n**Motivo**:\n{reason}'
         await self.logger.log(msg)
         await self._report_deleted(messages)
-        # senza il + 1 l'amount non considererebbe il comando
-        # eliminando un messaggio in meno rispetto alla quantità prevista
-        await ctx.channel.purge(limit=amount + 1, reason=reason)
+        await self._bulk_delete(ctx.channel, [command] + messages, reason)
+
+    async def _bulk_delete(
+        self,
+        channel: Union[discord.TextChannel, discord.VoiceChannel, discord.Thread],
+        messages: List[discord.Message],
+        reason: Optional[str],
+    ) -> None:
+        """Elimina i messaggi a blocchi di 100 con delete_messages. Quelli
+        più vecchi di 14 giorni, che discord non permette di eliminare in
+        blocco, sono eliminati singolarmente al più delete_concurrency alla
+        volta. Oltre i 100 messaggi l'avanzamento viene mostrato nel canale.
+        """
+        # margine di un minuto sul limite di discord
+        limit = discord.utils.utcnow() - timedelta(days=14, minutes=-1)
+        recent = [m for m in messages if m.created_at > limit]
+        old = [m for m in messages if m.created_at <= limit]
+        total = len(messages)
+        done = 0
+        progress: Optional[discord.Message] = None
+        if total > 100:
+            progress = await channel.send(f'Eliminazione in corso: 0/{total}')
+
+        async def update() -> None:
+            if progress is not None:
+                await progress.edit(content=f'Eliminazione in corso: {done}/{total}')
+
+        for i in range(0, len(recent), 100):
+            chunk = recent[i:i + 100]
+            await channel.delete_messages(chunk, reason=reason)
+            done += len(chunk)
+            await update()
+        if old:
+            semaphore = asyncio.Semaphore(self.delete_concurrency)
+
+            async def delete(message: discord.Message) -> None:
+                nonlocal done
+                async with semaphore:
+                    try:
+                        await message.delete()
+                    except discord.NotFound:
+                        pass
+                done += 1
+                if done % 25 == 0:
+                    await update()
+
+            await asyncio.gather(*(delete(m) for m in old))
+        if progress is not None:
+            await progress.edit(content=f'Eliminati {done} messaggi.', delete_after=5)
 
     async def _report_deleted(self, deleted: List[discord.Message]) -> None:
-        """Si occupa di loggare i messaggi eliminati dal comando delete."""
+        """Si occupa di loggare i messaggi eliminati dal comando delete
+        e di aggiungerli all'indice di moderazione.
+        """
+        index = AuditIndex.get_instance()
+        for message in deleted:
+            index.record('eliminato', message.content, member_id=message.author.id,
+                         channel_id=message.channel.id, message_id=message.id,
+                         at=message.created_at)
         today = discord.utils.utcnow()
         report = '**Messaggi eliminati:**\n\n'
         attachment_list = []
@@ -127,11 +198,13 @@ class ModerationCog(commands.Cog, name='Moderazione'):
             if (
                 len(report)
                 + len(discord.utils.escape_markdown(message.content))
-                + 13 * len(message.attachments)  # sarebbe " [allegato x]"
+                # sarebbe " [allegato x]" più l'eventuale riferimento al
+                # log che lo contiene già (vedi BotLogger.log_evidence)
+                + 120 * len(message.attachments)
                 > 4096
                 or len(attachment_list) + len(message.attachments) > 10
             ):
-                await self.logger.log(f'{report}', attachment_list)
+                await self.logger.log_evidence(f'{report}', attachment_list)
                 report = ''
                 attachment_list.clear()
                 prev_author = ''
@@ -149,7 +222,7 @@ class ModerationCog(commands.Cog, name='Moderazione'):
                 attachment_list.append(att)
                 report += f' [allegato {len(attachment_list)}]'
             report += '\n'
-        await self.logger.log(f'{report}', attachment_list)
+        await self.logger.log_evidence(f'{report}', attachment_list)
 
     @commands.command(brief='reimposta il nickname dell\'utente citato')
     async def resetnick(self, ctx: commands.Context, attempted_member: Union[str, discord.Member] = MISSING, *, name: str = MISSING):
@@ -254,7 +327,7 @@ class ModerationCog(commands.Cog, name='Moderazione'):
         if member.bot:   # or member == ctx.author:
             return
         assert isinstance(member, discord.Member)
-        await self._add_warn(member, reason, 1)
+        await self._add_warn(member, reason, 1, ctx.author.id)
         await self.logger.log(f'{member.mention} warnato. Motivo: {reason}')
         await ctx.send(f'{member.mention} warnato. Motivo: {reason}')
         await ctx.message.delete(delay=5)
@@ -269,7 +342,7 @@ class ModerationCog(commands.Cog, name='Moderazione'):
         if member.bot:
             return
         reason = 'buona condotta'
-        await self._add_warn(member, reason, -1)
+        await self._add_warn(member, reason, -1, ctx.author.id)
         await self.logger.log(f'rimosso warn a {member.mention}')
         await ctx.send(f'{member.mention} rimosso un warn.')
         await ctx.message.delete(delay=5)
@@ -330,37 +403,118 @@ class ModerationCog(commands.Cog, name='Moderazione'):
         await ctx.send(f'{user} bannato. Motivo: {reason}')
         await ctx.message.delete(delay=5)
         penalty = 'bannato dal server.'
-        channel = member.dm_channel if member.dm_channel is not None else await member.create_dm()
-        await channel.send(f'Sei stato {penalty} Motivo: {reason}.')
+        AuditIndex.get_instance().record('ban', reason, member_id=member.id, actor_id=ctx.author.id)
+        await self._notify_before_ban(member, f'Sei stato {penalty} Motivo: {reason}.')
         await member.ban(delete_message_days=0, reason=reason)
 
-    async def _add_warn(self, member: discord.Member, reason: str, number: int):
+    @commands.command(brief='cerca negli eventi di moderazione')
+    async def audit(self, ctx: commands.Context, *, query: str = ''):
+        """Cerca nell'indice locale i messaggi eliminati e modificati, i warn,
+        i ban e i cambi di nickname, mostrando i più recenti. Tutti i filtri
+        sono facoltativi e vanno combinati; il testo cerca parole intere.
+        Il membro va indicato con membro: seguito dalla menzione o dall'id,
+        così che una parola da cercare non venga scambiata per un nome utente.
+
+        Sintassi:
+        <audit membro:@someone               # eventi di 'someone'
+        <audit membro:123456789 insulto      # eventi del membro con quell'id che contengono 'insulto'
+        <audit spam link                     # eventi che contengono 'spam' e 'link'
+        <audit membro:@someone dal:2024-01-01 al:2024-01-31  # eventi di 'someone' nel periodo
+        """
+        member_id: Optional[int] = None
+        since: Optional[datetime] = None
+        until: Optional[datetime] = None
+        words: List[str] = []
+        try:
+            for word in query.split():
+                if word.startswith('membro:'):
+                    match = re.fullmatch(r'<@!?(\d+)>|(\d+)', word[7:])
+                    if match is None:
+                        raise ValueError(word)
+                    member_id = int(match.group(1) or match.group(2))
+                elif word.startswith('dal:'):
+                    since = datetime.combine(date.fromisoformat(word[4:]), time(0, 0)).astimezone()
+                elif word.startswith('al:'):
+                    until = datetime.combine(date.fromisoformat(word[3:]) + timedelta(days=1), time(0, 0)).astimezone()
+                else:
+                    words.append(word)
+        except ValueError:
+            await ctx.send('filtri non validi, usa membro:@someone (o l\'id) e le date nel formato '
+                           'dal:AAAA-MM-GG al:AAAA-MM-GG', delete_after=5)
+            return
+        start = perf_counter()
+        events = await AuditIndex.get_instance().search(
+            member_id, ' '.join(words), since, until, self.audit_results)
+        elapsed = (perf_counter() - start) * 1000
+        if not events:
+            await ctx.send(f'nessun evento trovato ({elapsed:.0f} ms)')
+            return
+        lines: List[str] = []
+        for event in events:
+            line = f'{discord.utils.format_dt(event.at, "f")} **{event.kind}**'
+            if event.member_id is not None:
+                line += f' <@{event.member_id}>'
+            if event.channel_id is not None:
+                line += f' in <#{event.channel_id}>'
+            if event.actor_id is not None:
+                line += f' da <@{event.actor_id}>'
+            content = discord.utils.escape_markdown(event.content)
+            if len(content) > 200:
+                content = content[:200] + '...'
+            lines.append(f'{line}\n{content}')
+        response = discord.Embed(
+            title='Eventi di moderazione',
+            description='\n'.join(lines)[:4096]
+        )
+        response.set_footer(text=f'{len(events)} risultati in {elapsed:.0f} ms')
+        await ctx.send(embed=response)
+
+    async def _notify_before_ban(self, member: discord.Member, text: str) -> None:
+        """Invia il dm di notifica del ban attendendone la consegna per al
+        più qualche secondo, dato che dopo il ban non sarebbe più possibile.
+        """
+        delivery = DMDispatcher.get_instance().send(member, text)
+        try:
+            await asyncio.wait_for(asyncio.shield(delivery), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _add_warn(self, member: discord.Member, reason: str, number: int, actor_id: Optional[int] = None):
         """Incrementa o decremente il numero di violazioni di numero e tiene traccia
         dell'ultima violazione commessa. Si occupa anche di inviare in dm la notifica
         dell'avvenuta violazione con la ragione che è stata specificata.
+        La modifica viene aggiunta all'indice di moderazione con l'autore, se
+        indicato (assente per i warn automatici del filtro), solo se ha
+        effettivamente cambiato il numero di violazioni.
         """
+        index = AuditIndex.get_instance()
+        kind = 'warn' if number > 0 else 'unwarn'
         penalty = 'warnato.'
         if self.archive.is_present(member.id):
             item = self.archive.get(member.id)
+            previous = item.violations_count
             item.modify_warn(number)
+            if item.violations_count != previous:
+                index.record(kind, reason, member_id=member.id, actor_id=actor_id)
             if number < 0:  # non deve controllare il ban se è un unwarn
                 self.archive.save()
                 return
             if item.warn_count() == 3:
-                await member.add_roles(Config.get_config().surveillance_role)
+                scheduler = RoleScheduler.get_instance()
+                scheduler.stage(
+                    member, add=[self.config.surveillance_role],
+                    on_commit=partial(self.logger.log, f'{member.mention} aggiunto a {self.config.surveillance_role.mention}'))
+                await scheduler.commit()
                 penalty = 'sottoposto a sorveglianza, il prossimo sarà un ban.'
-                channel = member.dm_channel if member.dm_channel is not None else await member.create_dm()
-                await channel.send(f'Sei stato {penalty} Motivo: {reason}.')
-                await self.logger.log(f'{member.mention} aggiunto a {Config.get_config().surveillance_role.mention}')
+                DMDispatcher.get_instance().send(member, f'Sei stato {penalty} Motivo: {reason}.')
             elif item.warn_count() >= 4:
                 penalty = 'bannato dal server.'
-                channel = member.dm_channel if member.dm_channel is not None else await member.create_dm()
-                await channel.send(f'Sei stato {penalty} Motivo: {reason}.')
+                await self._notify_before_ban(member, f'Sei stato {penalty} Motivo: {reason}.')
                 await member.ban(delete_message_days=0, reason=reason)
+                index.record('ban', f'superati i 3 warn, ultimo: {reason}', member_id=member.id, actor_id=actor_id)
                 await self.logger.log(f'{member.mention} bannato automaticamente per aver superato i 3 warn')
             else:
-                channel = member.dm_channel if member.dm_channel is not None else await member.create_dm()
-                await channel.send(f'Sei stato {penalty} Motivo: {reason}.')
+                DMDispatcher.get_instance().send(member, f'Sei stato {penalty} Motivo: {reason}.')
         else:
             # membro che non ha mai scritto nei canali conteggiati
             if number < 0:
@@ -368,9 +522,10 @@ class ModerationCog(commands.Cog, name='Moderazione'):
             afler = Afler.new_entry(member.display_name)
             afler.modify_warn(number)
             self.archive.add(member.id, afler)
+            index.record(kind, reason, member_id=member.id, actor_id=actor_id)
         self.archive.save()
 
 
-async def setup(bot: commands.Bot):
+async def setup(bot: AFLBot):
     """Entry point per il caricamento della cog"""
     await bot.add_cog(ModerationCog(bot))
@@ -5,6 +5,7 @@ gli aflers
 from datetime import date, datetime, timedelta
 from typing import Any, Dict, Optional
 
+from utils.clock import Clock
 from utils.config import Config
 from utils.shared_functions import next_datetime
 
@@ -114,7 +115,7 @@ class Afler():
         """
         return cls({
             'nickname': nickname,
-            'last_nick_change': date.today().isoformat(),
+            'last_nick_change': Clock.get_instance().today().isoformat(),
             'violations_count': 0,
             'last_violation_date': None,
             'bio': None,
@@ -170,11 +171,11 @@ class Afler():
         :param new_nick: nuovo nickname
         """
         self.nickname = new_nick
-        self.last_nick_change = date.today()
+        self.last_nick_change = Clock.get_instance().today()
 
     def can_renew_nick(self) -> bool:
         """Controlla se l'afler può rinnovare il nickname."""
-        return date.today() - self.last_nick_change >= timedelta(Config.get_config().nick_change_days)
+        return Clock.get_instance().today() - self.last_nick_change >= timedelta(Config.get_config().nick_change_days)
 
     @property
     def total_messages(self) -> int:
@@ -186,32 +187,51 @@ class Afler():
         """
         return self.orator_total_messages + self.dank_total_messages
 
-    def increase_orator_buffer(self) -> None:
-        """Aggiorna il buffer oratore."""
-        today = date.today()
+    def increase_orator_buffer(self, amount: int = 1, day: Optional[date] = None) -> None:
+        """Aggiorna il buffer oratore.
+
+        :param amount: numero di messaggi da aggiungere
+        :param day: giorno a cui attribuire i messaggi, se non specificato oggi
+        """
+        today = Clock.get_instance().today() if day is None else day
         if self.orator_last_message_timestamp == today:
             # messaggi dello stesso giorno, continuo a contare
-            self.orator_daily_buffer += 1
+            self.orator_daily_buffer += amount
         elif self.orator_last_message_timestamp is None:
             # primo messaggio della persona
-            self.orator_daily_buffer = 1
+            self.orator_daily_buffer = amount
             self.orator_last_message_timestamp = today
         else:
             # è finito il giorno, salva i messaggi di 'orator_daily_buffer' nel
             # giorno corrispondente e aggiorna data ultimo messaggio
             if self.orator_daily_buffer != 0:
-                day = self.orator_last_message_timestamp.weekday()
-                self.orator_weekly_buffer[day] = self.orator_daily_buffer
-            self.orator_daily_buffer = 1
+                weekday = self.orator_last_message_timestamp.weekday()
+                self.orator_weekly_buffer[weekday] = self.orator_daily_buffer
+            self.orator_daily_buffer = amount
             self.orator_last_message_timestamp = today
-        self.orator_total_messages += 1
+        self.orator_total_messages += amount
 
-    def decrease_orator_buffer(self, amount: int = 1) -> None:
+    def decrease_orator_buffer(self, amount: int = 1, day: Optional[date] = None) -> None:
         """Decrementa il buffer oratore
 
         :param amount: numero di messaggi da rimuovere
+        :param day: giorno di invio dei messaggi, se non specificato si
+        assume il giorno dell'ultimo messaggio. I messaggi sono tolti dal
+        buffer giornaliero solo se vi si trovano ancora, cioè se sono di oggi
+        o del giorno dell'ultimo messaggio non ancora consolidato da
+        clean_orator_buffer; altrimenti sono tolti dallo storico settimanale,
+        e se più vecchi di una settimana solo dal totale.
         """
-        self.orator_daily_buffer = max(0, self.orator_daily_buffer - amount)
+        today = Clock.get_instance().today()
+        if day is None:
+            day = self.orator_last_message_timestamp
+        if day is not None and day == self.orator_last_message_timestamp and (
+                day == today or self.orator_daily_buffer != 0):
+            self.orator_daily_buffer = max(0, self.orator_daily_buffer - amount)
+        elif day is not None and timedelta(0) < today - day < timedelta(days=7):
+            weekday = day.weekday()
+            self.orator_weekly_buffer[weekday] = max(
+                0, self.orator_weekly_buffer[weekday] - amount)
         self.orator_total_messages = max(
             0, self.orator_total_messages - amount)
 
@@ -223,7 +243,7 @@ class Afler():
         """
         self.orator = True
         days = Config.get_config().orator_duration
-        self.orator_expiration = date.today() + timedelta(days=days)
+        self.orator_expiration = Clock.get_instance().today() + timedelta(days=days)
         self.orator_weekly_buffer = [0] * 7
 
     def is_orator_expired(self) -> bool:
@@ -236,7 +256,7 @@ class Afler():
         if not self.orator:
             return False
         assert (self.orator_expiration is not None)
-        if self.orator_expiration <= date.today():
+        if self.orator_expiration <= Clock.get_instance().today():
             return True
         else:
             return False
@@ -257,18 +277,20 @@ class Afler():
         self.dank_messages_buffer = 0
         self.dank_first_message_timestamp = None
         expiration = next_datetime(
-            datetime.now(), Config.get_config().dank_duration)
+            Clock.get_instance().now(), Config.get_config().dank_duration)
         self.dank_expiration = expiration.replace(
             minute=0, second=0, microsecond=0)
 
-    def increase_dank_counter(self) -> None:
+    def increase_dank_counter(self, amount: int = 1) -> None:
         """Aumenta il contatore dei messaggi per il ruolo cazzaro.
         Se la finestra di tempo è scaduta (o se non è mai stato mandato
         un messaggio in precedenza), aggiorna il timestamp e imposta il
-        buffer a 1.
+        buffer ad amount.
+
+        :param amount: numero di messaggi da aggiungere
         """
         expired = True
-        now = datetime.now().astimezone().replace(
+        now = Clock.get_instance().now().astimezone().replace(
             minute=0, second=0, microsecond=0)
         if self.dank_first_message_timestamp is not None:
             old_timestamp = self.dank_first_message_timestamp
@@ -277,17 +299,22 @@ class Afler():
         # 'expired' sarà True se il timestamp è vecchio o se non ce n'è uno
         if expired:
             self.dank_first_message_timestamp = now
-            self.dank_messages_buffer = 1
+            self.dank_messages_buffer = amount
         else:
-            self.dank_messages_buffer += 1
-        self.dank_total_messages += 1
+            self.dank_messages_buffer += amount
+        self.dank_total_messages += amount
 
-    def decrease_dank_counter(self, amount: int = 1) -> None:
+    def decrease_dank_counter(self, amount: int = 1, sent_at: Optional[datetime] = None) -> None:
         """Rimuove una certa quantità di messaggi dal contatore cazzaro.
 
         :param amount: la quantità di messaggi da sottrarre dal contatore
+        :param sent_at: quando sono stati inviati i messaggi, se precedenti
+        alla finestra di tempo corrente vengono tolti solo dal totale
         """
-        self.dank_messages_buffer = max(0, self.dank_messages_buffer - amount)
+        if (sent_at is None
+                or (self.dank_first_message_timestamp is not None
+                    and sent_at >= self.dank_first_message_timestamp)):
+            self.dank_messages_buffer = max(0, self.dank_messages_buffer - amount)
         self.dank_total_messages = max(0, self.dank_total_messages - amount)
 
     def is_eligible_for_dank(self) -> bool:
@@ -307,7 +334,7 @@ class Afler():
         """
         if self.dank:
             assert (self.dank_expiration is not None)
-            if self.dank_expiration <= datetime.now().astimezone():
+            if self.dank_expiration <= Clock.get_instance().now().astimezone():
                 return True
         return False
 
@@ -330,7 +357,7 @@ class Afler():
         self.violations_count = max(0, self.violations_count + count)
         if count > 0:
             # modifica la data solo se sono aggiunti
-            self.last_violation_date = date.today()
+            self.last_violation_date = Clock.get_instance().today()
         else:
             self.last_violation_date = None
 
@@ -352,7 +379,7 @@ class Afler():
         """
         violations_count = 0
         if self.last_violation_date is not None:
-            if (self.last_violation_date + timedelta(days=Config.get_config().violations_reset_days)) <= date.today():
+            if (self.last_violation_date + timedelta(days=Config.get_config().violations_reset_days)) <= Clock.get_instance().today():
                 violations_count = self.violations_count
                 self.violations_count = 0
                 self.last_violation_date = None
@@ -360,13 +387,13 @@ class Afler():
 
     def forget_last_week(self) -> None:
         """Rimuove dal conteggio i messaggi risalenti a 7 giorni fa."""
-        self.orator_weekly_buffer[date.today().weekday()] = 0
+        self.orator_weekly_buffer[Clock.get_instance().today().weekday()] = 0
 
     def clean_orator_buffer(self) -> None:
         """Si occupa di controllare il campo orator_last_message_timestamp
         e sistemare di conseguenza il conteggio dei singoli giorni.
         """
-        today = date.today()
+        today = Clock.get_instance().today()
         if (self.orator_last_message_timestamp is None) or (self.orator_last_message_timestamp == today):
             # (None) tecnicamente previsto da add_warn se uno viene warnato senza aver mai scritto
             # (Oggi) vuol dire che il bot è stato riavviato a metà giornata non devo toccare i contatori
@@ -395,7 +422,7 @@ class Afler():
         """
         return (
             sum(self.orator_weekly_buffer)
-            - self.orator_weekly_buffer[date.today().weekday()]
+            - self.orator_weekly_buffer[Clock.get_instance().today().weekday()]
             + self.orator_daily_buffer
         )
 
@@ -1,15 +1,16 @@
 from __future__ import annotations
-from datetime import date
-from discord import Embed
 import json
 from os import rename
-from typing import Any, ClassVar, Dict, List
+from typing import Any, ClassVar, Dict, List, Optional
 
 from utils.afler import Afler
-from utils.bot_logger import BotLogger
+from utils.clock import Clock
 from utils.config import Config
+from utils.counters_report import CountersReport
+from utils.orator_table import OratorTable
 from utils.paths import AFLERS_FILE, DATA_DIR
 from utils.shared_functions import update_json_file
+from utils.role_scheduler import RoleScheduler
 
 from discord.utils import MISSING
 
@@ -78,9 +79,9 @@ class Archive():
         except json.JSONDecodeError:
             print(
                 "L'archivio sembra essere corrotto: backup e creazione di un nuovo archivio...")
-            rename(AFLERS_FILE, DATA_DIR / f'aflers-backup-{date.today()}.json')
+            rename(AFLERS_FILE, DATA_DIR / f'aflers-backup-{Clock.get_instance().today()}.json')
             print(
-                f'Il vecchio archivio è stato salvato nel file aflers-backup-{date.today()}.json.')
+                f'Il vecchio archivio è stato salvato nel file aflers-backup-{Clock.get_instance().today()}.json.')
         finally:
             # Serve creare un'istanza dell'archivio all'avvio.
             # Questo non è il caso invece quando si vuole fare il refresh
@@ -185,57 +186,63 @@ class Archive():
         """
         return any(afler.nick == nick for afler in self.values())
 
-    async def handle_counters(self) -> None:
+    async def handle_counters(self, partition: int = 0, partitions: int = 1, report: Optional[CountersReport] = None) -> None:
         """Esegue il controllo dei contatori degli afler.
 
         Nello specifico si occupa di:
         - consolidare dei messaggi nel buffer oratore se necessario;
         - azzerare dei messaggi conteggiati scaduti;
-        - assegnare/rimuovere i ruoli (i mod sono esclusi);
+        - assegnare/rimuovere il ruolo oratore (i mod sono esclusi);
         - rimuovere strike/violazioni scaduti.
 
-        Di norma, viene chiamato durante la task periodica.
+        Di norma, viene chiamato durante la task periodica, una partizione
+        alla volta. Le modifiche ai ruoli sono applicate dal RoleScheduler
+        con concorrenza limitata, mentre annunci e log sono raccolti nel
+        report e inviati tutti insieme.
+
+        :param partition: la partizione da controllare, tra 0 e partitions - 1
+        :param partitions: il numero di partizioni, un afler appartiene alla
+        partizione id % partitions
+        :param report: il report in cui raccogliere annunci e log, se non
+        specificato ne viene creato uno e inviato al termine
         """
-        logger = BotLogger.get_instance()
         config = Config.get_config()
-        for id, afler in self.archive.items():
-            afler.clean_orator_buffer()
-            count = afler.count_consolidated_messages()
+        scheduler = RoleScheduler.get_instance()
+        digest = report if report is not None else CountersReport()
+        collect = CountersReport.collect
+
+        aflers = [(id, afler) for id, afler in self.archive.items()
+                  if id % partitions == partition]
+        # rotazione dei contatori e controllo della soglia su tutta la
+        # partizione in una volta, vedi OratorTable
+        table = OratorTable.from_aflers(aflers)
+        eligible = set(table.rollover(Clock.get_instance().today(), config.orator_threshold))
+        table.write_back()
+        for id, afler in aflers:
             member = config.guild.get_member(id)
             assert member is not None
             # controllo messaggi per ruolo attivo
-            if (count >= config.orator_threshold and
+            if (id in eligible and
                     not any(role in config.moderation_roles for role in member.roles)):
-                await member.add_roles(config.orator_role)
-                if afler.orator:
-                    msg = f'{member.mention}: rinnovato ruolo {config.orator_role.mention}'
-                else:
-                    msg = f'{member.mention} è diventato {config.orator_role.mention}'
-                await logger.log(msg)
-                await config.main_channel.send(embed=Embed(description=msg))
+                section = digest.renewed_orators if afler.orator else digest.new_orators
+                scheduler.stage(member, add=[config.orator_role],
+                                on_commit=collect(section, member.mention))
                 afler.set_orator()
             # controllo delle violazioni
             violations_count = afler.reset_violations()
             if violations_count > 0:
-                msg = f'rimosse le {violations_count} violazioni di {member.mention}'
-                await logger.log(msg)
+                digest.logs.append(f'rimosse le {violations_count} violazioni di {member.mention}')
                 # rimozione del ruolo sotto sorveglianza
                 if config.surveillance_role in member.roles:
-                    await member.remove_roles(config.surveillance_role)
-                    await logger.log(f'{member.mention} rimosso da {config.surveillance_role.mention}')
-            # rimuovo i messaggi contati 7 giorni fa
-            afler.forget_last_week()
+                    scheduler.stage(
+                        member, remove=[config.surveillance_role],
+                        on_commit=collect(digest.logs, f'{member.mention} rimosso da {config.surveillance_role.mention}'))
             # controllo scadenza ruolo attivo
             if afler.is_orator_expired():
-                await member.remove_roles(config.orator_role)
-                msg = f'{member.mention} non è più un {config.orator_role.mention}'
-                await logger.log(msg)
-                await config.main_channel.send(embed=Embed(description=f'{msg} :('))
+                scheduler.stage(member, remove=[config.orator_role],
+                                on_commit=collect(digest.expired_orators, member.mention))
                 afler.remove_orator()
-            # controllo scadenza ruolo cazzaro
-            if afler.is_dank_expired():
-                await member.remove_roles(config.dank_role)
-                msg = f'{member.mention} non è più un {config.dank_role.mention}'
-                await logger.log(msg)
-                await config.main_channel.send(embed=Embed(description=f'{msg} :)'))
-                afler.remove_dank()
+        # tutte le modifiche ai ruoli di un membro in una sola chiamata
+        await scheduler.commit()
+        if report is None:
+            await digest.announce()
@@ -0,0 +1,339 @@
+"""Indice locale ricercabile degli eventi di moderazione.
+
+Messaggi eliminati e modificati, warn, ban e cambi di nickname vengono,
+oltre che loggati nel canale, salvati in un database sqlite3 con una
+tabella FTS5 per la ricerca testuale. Le scritture sono accumulate in
+memoria e inserite a blocchi da una task in background, in un thread
+separato per non bloccare il bot.
+
+Benchmark con un milione di eventi sintetici in un database temporaneo:
+    python -m utils.audit_index
+"""
+from __future__ import annotations
+import asyncio
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import ClassVar, List, NamedTuple, Optional, Sequence, Tuple
+
+from discord.utils import MISSING
+
+from utils.paths import AUDIT_DB_FILE
+
+_log = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    member_id INTEGER,
+    actor_id INTEGER,
+    channel_id INTEGER,
+    message_id INTEGER,
+    content TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS events_member_ts ON events (member_id, ts);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE UNIQUE INDEX IF NOT EXISTS events_deleted ON events (message_id)
+    WHERE kind = 'eliminato';
+'''
+
+_FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+    content, content='events', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS events_ai AFTER INSERT ON events BEGIN
+    INSERT INTO events_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS events_ad AFTER DELETE ON events BEGIN
+    INSERT INTO events_fts (events_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+'''
+
+Row = Tuple[int, str, Optional[int], Optional[int], Optional[int], Optional[int], str]
+
+
+class AuditEvent(NamedTuple):
+    """Evento registrato nell'indice."""
+    at: datetime
+    kind: str
+    member_id: Optional[int]
+    actor_id: Optional[int]
+    channel_id: Optional[int]
+    message_id: Optional[int]
+    content: str
+
+
+class AuditIndex():
+    """Indice degli eventi di moderazione su sqlite3.
+
+    Gli eventi passati a record() finiscono in un buffer che la task in
+    background scrive ogni flush_interval secondi, o prima se supera
+    batch_size eventi, con un'unica transazione. Un messaggio eliminato può
+    essere segnalato sia dal comando delete che dall'evento di discord: l'id dei
+    messaggi eliminati è unico e i duplicati vengono ignorati.
+    Se sqlite3 non è compilato con FTS5 la ricerca testuale usa LIKE.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `AuditIndex`     attributo di classe, contiene l'istanza
+    flush_interval: `float`     attributo di classe, secondi tra due scritture
+    batch_size: `int`           attributo di classe, eventi oltre cui scrivere subito
+    fts: `bool`                 se è disponibile la ricerca FTS5
+
+    Classmethods
+    -------------
+    open():         apre (o crea) il database
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    record():   accoda un evento da scrivere
+    flush():    coroutine, scrive gli eventi in attesa
+    search():   coroutine, cerca gli eventi per membro, testo e periodo
+    close():    coroutine, scrive gli eventi in attesa e chiude il database
+    """
+    _instance: ClassVar[AuditIndex] = MISSING
+    flush_interval: ClassVar[float] = 2.0
+    batch_size: ClassVar[int] = 500
+
+    def __init__(self) -> None:
+        self.fts: bool
+        self._db: sqlite3.Connection
+        self._lock: threading.Lock
+        self._pending: List[Row]
+        self._wakeup: Optional[asyncio.Event]
+        self._worker: Optional[asyncio.Task]
+        raise RuntimeError(
+            'Usa AuditIndex.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> AuditIndex:
+        """Ritorna l'unica istanza dell'indice."""
+        if cls._instance is MISSING:
+            cls._instance = cls.open(AUDIT_DB_FILE)
+        return cls._instance
+
+    @classmethod
+    def open(cls, path: Path) -> AuditIndex:
+        """Apre il database creando le tabelle mancanti.
+
+        :param path: il file del database
+
+        :returns: l'indice
+        :rtype: AuditIndex
+        """
+        index = cls.__new__(cls)
+        # usato dai thread di asyncio.to_thread, serializzato da _lock
+        index._db = sqlite3.connect(path, check_same_thread=False)
+        index._db.execute('PRAGMA journal_mode=WAL')
+        index._db.execute('PRAGMA synchronous=NORMAL')
+        index._db.executescript(_SCHEMA)
+        try:
+            index._db.executescript(_FTS_SCHEMA)
+            index.fts = True
+        except sqlite3.OperationalError:
+            index.fts = False
+        index._lock = threading.Lock()
+        index._pending = []
+        index._wakeup = None
+        index._worker = None
+        return index
+
+    def record(
+            self,
+            kind: str,
+            content: str,
+            member_id: Optional[int] = None,
+            actor_id: Optional[int] = None,
+            channel_id: Optional[int] = None,
+            message_id: Optional[int] = None,
+            at: Optional[datetime] = None) -> None:
+        """Accoda un evento. La scrittura avviene in background.
+
+        :param kind: il tipo di evento (es. 'eliminato', 'modificato', 'warn')
+        :param content: il testo da indicizzare
+        :param member_id: il membro a cui si riferisce l'evento
+        :param actor_id: chi ha eseguito l'azione (es. il moderatore)
+        :param channel_id: il canale del messaggio
+        :param message_id: l'id del messaggio, se eliminato per ignorare i duplicati
+        :param at: quando è avvenuto, se non specificato adesso
+        """
+        ts = int((at or datetime.now().astimezone()).timestamp() * 1000)
+        self._pending.append((ts, kind, member_id, actor_id, channel_id, message_id, content))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._flush_worker())
+        if len(self._pending) >= self.batch_size:
+            assert self._wakeup is not None
+            self._wakeup.set()
+
+    async def _flush_worker(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # la task deve sopravvivere, gli eventi del blocco sono persi
+                _log.exception('errore nella scrittura dell\'indice di moderazione')
+
+    async def flush(self) -> int:
+        """Scrive gli eventi in attesa in un'unica transazione.
+
+        :returns: il numero di eventi scritti
+        :rtype: int
+        """
+        if not self._pending:
+            return 0
+        rows = self._pending
+        self._pending = []
+        await asyncio.to_thread(self._insert, rows)
+        return len(rows)
+
+    def _insert(self, rows: Sequence[Row]) -> None:
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO events (ts, kind, member_id, actor_id, channel_id, message_id, content) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    async def search(
+            self,
+            member_id: Optional[int] = None,
+            text: Optional[str] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            limit: int = 20) -> List[AuditEvent]:
+        """Cerca gli eventi più recenti che soddisfano tutti i filtri
+        indicati. Gli eventi non ancora scritti vengono scritti prima.
+
+        :param member_id: il membro
+        :param text: il testo da cercare (parole intere, in qualsiasi ordine)
+        :param since: inizio del periodo
+        :param until: fine del periodo
+        :param limit: il numero massimo di risultati
+
+        :returns: gli eventi, dal più recente
+        :rtype: List[AuditEvent]
+        """
+        await self.flush()
+        return await asyncio.to_thread(self._search, member_id, text, since, until, limit)
+
+    def _search(
+            self,
+            member_id: Optional[int],
+            text: Optional[str],
+            since: Optional[datetime],
+            until: Optional[datetime],
+            limit: int) -> List[AuditEvent]:
+        conditions: List[str] = []
+        params: List[object] = []
+        source = 'events e'
+        if text:
+            if self.fts:
+                source = 'events_fts f JOIN events e ON e.id = f.rowid'
+                conditions.append('events_fts MATCH ?')
+                # ogni parola come frase tra virgolette, senza sintassi FTS5
+                params.append(' '.join('"' + w.replace('"', '""') + '"' for w in text.split()))
+            else:
+                conditions.append('e.content LIKE ?')
+                params.append(f'%{text}%')
+        if member_id is not None:
+            conditions.append('e.member_id = ?')
+            params.append(member_id)
+        if since is not None:
+            conditions.append('e.ts >= ?')
+            params.append(int(since.timestamp() * 1000))
+        if until is not None:
+            conditions.append('e.ts < ?')
+            params.append(int(until.timestamp() * 1000))
+        query = ('SELECT e.ts, e.kind, e.member_id, e.actor_id, e.channel_id, e.message_id, e.content '
+                 f'FROM {source}')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        # non si può ordinare per id: i messaggi eliminati in blocco sono
+        # registrati con la data di invio, precedente a quella di inserimento
+        query += ' ORDER BY e.ts DESC, e.id DESC LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [AuditEvent(datetime.fromtimestamp(ts / 1000).astimezone(), *rest)
+                for ts, *rest in rows]
+
+    async def close(self) -> None:
+        """Ferma la task in background, scrive gli eventi in attesa e
+        chiude il database.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        await self.flush()
+        with self._lock:
+            self._db.close()
+        if AuditIndex._instance is self:
+            AuditIndex._instance = MISSING
+
+
+def _benchmark(size: int = 1_000_000) -> None:
+    """Riempie un database temporaneo e misura i tempi di ricerca."""
+    import random
+    import tempfile
+    from datetime import timedelta
+
+    words = ('meme gatto politica calcio insulto spam link video gioco musica '
+             'scuola lavoro film serie anime cibo viaggio foto auto treno').split()
+    kinds = ('eliminato', 'modificato', 'warn', 'ban', 'nickname')
+    random.seed(0)
+
+    async def run() -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            index = AuditIndex.open(Path(directory) / 'audit.db')
+            now = datetime.now().astimezone()
+            start = time.perf_counter()
+            for i in range(size):
+                index._pending.append((
+                    int((now - timedelta(minutes=size - i)).timestamp() * 1000),
+                    random.choice(kinds), random.randrange(1000, 6000), None,
+                    random.randrange(10), i,
+                    ' '.join(random.choices(words, k=8)) + f' parola{i % 5000}'))
+                if len(index._pending) >= 50_000:
+                    await index.flush()
+            await index.flush()
+            print(f'{size} eventi scritti in {time.perf_counter() - start:.1f}s (fts5: {index.fts})')
+            queries = {
+                'membro': dict(member_id=4242),
+                'testo raro': dict(text='parola1234'),
+                'testo comune': dict(text='gatto'),
+                'membro + testo': dict(member_id=4242, text='calcio'),
+                'membro + periodo': dict(member_id=4242, since=now - timedelta(days=30), until=now - timedelta(days=10)),
+                'testo + periodo': dict(text='parola42', since=now - timedelta(days=300)),
+            }
+            for name, query in queries.items():
+                start = time.perf_counter()
+                for _ in range(20):
+                    results = index._search(query.get('member_id'), query.get('text'),
+                                            query.get('since'), query.get('until'), 20)
+                elapsed = (time.perf_counter() - start) / 20 * 1000
+                print(f'{name}: {elapsed:.2f} ms ({len(results)} risultati)')
+            await index.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    _benchmark()
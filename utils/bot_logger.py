@@ -1,8 +1,9 @@
 from __future__ import annotations
 from datetime import datetime, timezone
-from typing import ClassVar, List, Optional
+from typing import ClassVar, Dict, List, Optional
 
 from utils.config import Config
+from utils.evidence_store import EvidenceStore
 
 import discord
 from discord.utils import MISSING
@@ -26,6 +27,7 @@ class BotLogger():
     -------------
     initialize():   coroutine, inizializza il canale su cui viene fatto il logging
     log():          coroutine, compila il messaggio e lo invia nel canale
+    log_evidence(): coroutine, come log() ma deduplica gli allegati tramite EvidenceStore
     """
     _logger: ClassVar[BotLogger] = MISSING
 
@@ -75,6 +77,56 @@ class BotLogger():
         :returns: il messaggio di log
         :rtype: Optional[discord.Message]
         """
+        files: List[discord.File] = [await m.to_file() for m in media] if media else []
+        return await self._send(msg, files)
+
+    async def log_evidence(self, msg: str, media: List[discord.Attachment]) -> Optional[discord.Message]:
+        """Come log(), pensato per i messaggi eliminati. Gli allegati sono
+        salvati nell'archivio locale e caricati solo se non sono già presenti
+        in un log precedente, in tal caso viene riportato il link al log che
+        li contiene. La numerazione segue l'ordine di media, così da
+        corrispondere agli indicatori "[allegato x]" del messaggio: i file
+        caricati hanno il numero come prefisso del nome, mentre gli allegati
+        già caricati, duplicati o non più raggiungibili sono elencati in
+        fondo al messaggio.
+
+        :param msg: il messaggio con l'evento da loggare
+        :param media: gli allegati dei messaggi eliminati
+
+        :returns: il messaggio di log
+        :rtype: Optional[discord.Message]
+        """
+        store = EvidenceStore.get_instance()
+        files: List[discord.File] = []
+        # hash -> numero dell'allegato caricato con questo log
+        uploaded: Dict[str, int] = {}
+        references: List[str] = []
+        missing: List[str] = []
+        for i, attachment in enumerate(media, start=1):
+            digest = await store.store(attachment)
+            if digest is None:
+                # allegato non più raggiungibile, rip
+                missing.append(str(i))
+                continue
+            url = store.uploaded_url(digest)
+            if url is not None:
+                references.append(f'[allegato {i}]({url})')
+            elif digest in uploaded:
+                references.append(f'allegato {i} = allegato {uploaded[digest]}')
+            else:
+                uploaded[digest] = i
+                files.append(store.to_file(digest, attachment.is_spoiler(), f'{i}_'))
+        if references:
+            msg += '\n\n**Allegati già archiviati:** ' + ', '.join(references)
+        if missing:
+            msg += '\n\n**Allegati non più disponibili:** ' + ', '.join(missing)
+        log_message = await self._send(msg, files)
+        if log_message is not None:
+            store.bind(list(uploaded), log_message)
+        return log_message
+
+    async def _send(self, msg: str, files: List[discord.File]) -> Optional[discord.Message]:
+        """Invia nel canale di log l'embed con il messaggio e i file allegati."""
         timestamp = datetime.now()
         if self.channel is None:
             # fallback sul terminale
@@ -87,5 +139,4 @@ class BotLogger():
             # Il timestamp dell'embed è regolato da discord, lo converto in UTC
             timestamp=timestamp.astimezone(timezone.utc)
         )
-        files: List[discord.File] = [await m.to_file() for m in media] if media else []
         return await self.channel.send(embed=log_message, files=files)
@@ -0,0 +1,144 @@
+"""Classificazione precalcolata dei canali del server"""
+from __future__ import annotations
+from enum import Flag, auto
+from typing import TYPE_CHECKING, ClassVar, Dict, Set, Union
+
+import discord
+from discord.utils import MISSING
+
+if TYPE_CHECKING:
+    from utils.config import Config
+
+
+class ChannelRole(Flag):
+    """Ruolo di un canale per il bot. Un canale può averne più di uno
+    (es. un canale della categoria oratore escluso dal filtro).
+    """
+    NONE = 0
+    ORATOR = auto()
+    DANK = auto()
+    EXCEPTIONAL = auto()
+    POLL = auto()
+    PRESENTATION = auto()
+
+    # ruoli che un thread eredita dal canale padre: proposte e
+    # presentazioni riguardano solo il canale stesso
+    INHERITED = ORATOR | DANK | EXCEPTIONAL
+
+
+class ChannelRegistry():
+    """Mappa id canale -> ruolo del canale, così che la gestione dei
+    messaggi non debba risalire a categoria e canale padre e confrontarli
+    con la configurazione a ogni messaggio.
+    Viene ricostruita da Config.load_models e aggiornata dagli eventi di
+    creazione, modifica e cancellazione dei canali.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `ChannelRegistry`        attributo di classe, contiene l'istanza
+    roles: `Dict[int, ChannelRole]`     ruolo dei canali diverso da NONE
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    rebuild():  ricalcola i ruoli di tutti i canali a partire dalla configurazione
+    update():   ricalcola il ruolo di un singolo canale
+    remove():   rimuove un canale eliminato
+    lookup():   ritorna il ruolo del canale, risolvendo i thread sul padre
+    """
+    _instance: ClassVar[ChannelRegistry] = MISSING
+
+    def __init__(self) -> None:
+        self.roles: Dict[int, ChannelRole]
+        self._orator_category_id: int
+        self._dank_category_id: int
+        self._exceptional_ids: Set[int]
+        self._poll_channel_id: int
+        self._presentation_channel_id: int
+        raise RuntimeError(
+            'Usa ChannelRegistry.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> ChannelRegistry:
+        """Ritorna l'unica istanza del registro dei canali."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.roles = {}
+            cls._instance._orator_category_id = 0
+            cls._instance._dank_category_id = 0
+            cls._instance._exceptional_ids = set()
+            cls._instance._poll_channel_id = 0
+            cls._instance._presentation_channel_id = 0
+        return cls._instance
+
+    def rebuild(self, config: Config) -> None:
+        """Ricalcola i ruoli di tutti i canali del server. Da chiamare
+        quando cambia la configurazione.
+
+        :param config: la configurazione con i modelli già caricati
+        """
+        self._orator_category_id = config.orator_category_id
+        self._dank_category_id = config.dank_category_id
+        self._exceptional_ids = set(config.exceptional_channels_id)
+        self._poll_channel_id = config.poll_channel_id
+        self._presentation_channel_id = config.presentation_channel_id
+        self.roles = {}
+        for channel in config.guild.channels:
+            self.update(channel)
+
+    def _classify(self, channel: discord.abc.GuildChannel) -> ChannelRole:
+        role = ChannelRole.NONE
+        category_id = channel.category_id
+        if category_id is not None:
+            if category_id == self._orator_category_id:
+                role |= ChannelRole.ORATOR
+            elif category_id == self._dank_category_id:
+                role |= ChannelRole.DANK
+        if channel.id in self._exceptional_ids:
+            role |= ChannelRole.EXCEPTIONAL
+        if channel.id == self._poll_channel_id:
+            role |= ChannelRole.POLL
+        elif channel.id == self._presentation_channel_id:
+            role |= ChannelRole.PRESENTATION
+        return role
+
+    def update(self, channel: discord.abc.GuildChannel) -> None:
+        """Ricalcola il ruolo del canale, ad esempio dopo uno spostamento
+        di categoria.
+
+        :param channel: il canale creato o modificato
+        """
+        role = self._classify(channel)
+        if role:
+            self.roles[channel.id] = role
+        else:
+            self.roles.pop(channel.id, None)
+
+    def remove(self, channel_id: int) -> None:
+        """Rimuove dal registro un canale eliminato.
+
+        :param channel_id: l'id del canale
+        """
+        self.roles.pop(channel_id, None)
+
+    def lookup(self, channel: Union[discord.abc.GuildChannel, discord.Thread, discord.abc.Messageable]) -> ChannelRole:
+        """Ritorna il ruolo del canale. I thread ereditano dal canale
+        padre solo i ruoli INHERITED.
+
+        :param channel: il canale in cui è stato inviato il messaggio
+
+        :returns: il ruolo del canale, NONE se non rilevante
+        :rtype: ChannelRole
+        """
+        if isinstance(channel, discord.Thread):
+            if channel.parent_id is None:
+                return ChannelRole.NONE
+            parent = self.roles.get(channel.parent_id, ChannelRole.NONE)
+            return parent & ChannelRole.INHERITED
+        return self.roles.get(getattr(channel, 'id', 0), ChannelRole.NONE)
@@ -0,0 +1,96 @@
+"""Sorgente di data e ora usata dalla logica di contatori, ruoli e proposte"""
+from __future__ import annotations
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from typing import ClassVar
+
+from discord.utils import MISSING
+
+
+class Clock():
+    """Fornisce data e ora correnti al posto di date.today() e
+    datetime.now(), così che sia possibile sostituirle (vedi VirtualClock)
+    per simulare settimane di funzionamento in pochi secondi.
+    now() ritorna, come datetime.now(), l'ora locale senza fuso: chi ha
+    bisogno del fuso usa now().astimezone().
+
+    Attributes
+    -------------
+    _instance: `Clock`  attributo di classe, l'orologio in uso
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'orologio in uso, di default quello di sistema
+    install():      sostituisce l'orologio in uso
+
+    Methods
+    -------------
+    now():      ritorna data e ora locali
+    today():    ritorna la data locale
+    sleep():    coroutine, attende un intervallo di tempo
+    """
+    _instance: ClassVar[Clock] = MISSING
+
+    @classmethod
+    def get_instance(cls) -> Clock:
+        """Ritorna l'orologio in uso."""
+        if Clock._instance is MISSING:
+            Clock._instance = Clock()
+        return Clock._instance
+
+    @classmethod
+    def install(cls, clock: Clock) -> None:
+        """Sostituisce l'orologio usato da tutto il bot.
+
+        :param clock: il nuovo orologio
+        """
+        Clock._instance = clock
+
+    def now(self) -> datetime:
+        """Ritorna data e ora locali, senza fuso orario."""
+        return datetime.now()
+
+    def today(self) -> date:
+        """Ritorna la data locale."""
+        return self.now().date()
+
+    async def sleep(self, seconds: float) -> None:
+        """Attende il numero di secondi indicato, come asyncio.sleep."""
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """Orologio che avanza solo quando richiesto. Tiene l'istante in UTC
+    e lo converte nel fuso locale del processo a ogni lettura, per cui
+    avanzando attraverso un cambio di ora legale l'ora locale salta come
+    farebbe quella di sistema (impostare TZ e chiamare time.tzset() per
+    scegliere il fuso).
+
+    Attributes
+    -------------
+    instant: `datetime`     l'istante corrente in UTC
+
+    Methods
+    -------------
+    advance():  sposta in avanti l'orologio
+    sleep():    coroutine, sposta in avanti l'orologio senza attendere
+    """
+
+    def __init__(self, start: datetime) -> None:
+        """:param start: l'istante iniziale, se senza fuso è inteso come ora locale"""
+        self.instant = start.astimezone(timezone.utc)
+
+    def now(self) -> datetime:
+        return self.instant.astimezone().replace(tzinfo=None)
+
+    def advance(self, delta: timedelta) -> None:
+        """Sposta in avanti l'orologio di un intervallo di tempo reale.
+
+        :param delta: l'intervallo
+        """
+        self.instant += delta
+
+    async def sleep(self, seconds: float) -> None:
+        self.advance(timedelta(seconds=seconds))
+        # lascia comunque eseguire le altre task, come asyncio.sleep
+        await asyncio.sleep(0)
@@ -4,6 +4,7 @@ from typing import ClassVar, List, TypedDict
 
 from aflbot import AFLBot
 from utils import shared_functions
+from utils.channel_registry import ChannelRegistry
 
 import discord
 from discord.utils import MISSING
@@ -37,6 +38,7 @@ class ConfigFields(TypedDict):
     violations_reset_days: int
     nick_change_days: int
     bio_length_limit: int
+    shed_backlog: int
 
 
 TextChannelsList = type(List[discord.TextChannel])
@@ -94,6 +96,7 @@ class Config():
     violations_reset_days: `int`      tempo dopo cui si resettano le violazioni in giorni
     nick_change_days: `int`           giorni concessi tra un cambio di nickname e l'altro (0 nessun limite)
     bio_length_limit: `int`           massimo numero di caratteri per la bio
+    shed_backlog: `int`               lavori in coda oltre i quali le risposte non essenziali vengono scartate
 
     Methods
     -------------
@@ -185,6 +188,8 @@ class Config():
         self.violations_reset_days = data['violations_reset_days']
         self.nick_change_days = data['nick_change_days']
         self.bio_length_limit = data['bio_length_limit']
+        # opzionale per compatibilità con le configurazioni precedenti
+        self.shed_backlog = int(data.get('shed_backlog', 50))
 
     def load_models(self):
         """Carica i modelli il cui id è riportato nel file di configurazione.
@@ -251,6 +256,7 @@ class Config():
         self.dank_role = _dank_role
         self.dank_category = _dank_category
         self.surveillance_role = _surveillance_role
+        ChannelRegistry.get_instance().rebuild(self)
 
     def save(self) -> None:
         """Save the current config"""
@@ -0,0 +1,117 @@
+"""Accumulatore in memoria degli incrementi dei contatori dei messaggi"""
+from __future__ import annotations
+from datetime import date
+from typing import ClassVar, Dict, Optional, Set, Tuple
+
+from discord.utils import MISSING
+
+from utils.archive import Archive
+from utils.channel_registry import ChannelRole
+from utils.clock import Clock
+
+
+class CounterBuffer():
+    """Raccoglie gli incrementi dei contatori oratore e cazzaro per autore
+    e ruolo del canale (ORATOR o DANK), così che la gestione di un
+    messaggio sia un semplice incremento in un dizionario. Gli incrementi
+    vengono riportati sugli afler dell'archivio in blocco tramite flush(),
+    chiamata periodicamente
+    e prima di ogni operazione che legge i contatori (cancellazioni,
+    controlli periodici, controllo della soglia cazzaro).
+
+    Il giorno a cui attribuire i messaggi oratore è quello in cui è
+    iniziato l'accumulo: lo scarto rispetto al giorno effettivo è al più
+    l'intervallo tra due flush.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `CounterBuffer`          attributo di classe, contiene l'istanza
+    pending: `Dict[Tuple[int, ChannelRole], int]`   (autore, ruolo) -> messaggi da riportare
+    _day: `Optional[date]`              giorno di inizio dell'accumulo corrente
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    add():      aggiunge un messaggio al conteggio dell'autore
+    count():    ritorna i messaggi in attesa per autore e ruolo
+    flush():    riporta gli incrementi in attesa sugli afler
+    """
+    _instance: ClassVar[CounterBuffer] = MISSING
+
+    def __init__(self) -> None:
+        self.pending: Dict[Tuple[int, ChannelRole], int]
+        self._day: Optional[date]
+        raise RuntimeError(
+            'Usa CounterBuffer.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> CounterBuffer:
+        """Ritorna l'unica istanza dell'accumulatore."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.pending = {}
+            cls._instance._day = None
+        return cls._instance
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, author_id: int, role: ChannelRole) -> int:
+        """Aggiunge un messaggio al conteggio in attesa dell'autore.
+
+        :param author_id: l'id dell'autore del messaggio
+        :param role: ChannelRole.ORATOR o ChannelRole.DANK
+
+        :returns: i messaggi in attesa per autore e ruolo
+        :rtype: int
+        """
+        if not self.pending:
+            self._day = Clock.get_instance().today()
+        key = (author_id, role)
+        count = self.pending.get(key, 0) + 1
+        self.pending[key] = count
+        return count
+
+    def count(self, author_id: int, role: ChannelRole) -> int:
+        """Ritorna i messaggi dell'autore per il ruolo non ancora
+        riportati sull'archivio.
+
+        :param author_id: l'id dell'autore
+        :param role: ChannelRole.ORATOR o ChannelRole.DANK
+        """
+        return self.pending.get((author_id, role), 0)
+
+    def flush(self) -> Set[int]:
+        """Riporta gli incrementi in attesa sugli afler dell'archivio e
+        salva l'archivio una sola volta. Gli autori non più presenti
+        nell'archivio vengono ignorati.
+
+        :returns: gli id degli autori il cui contatore cazzaro è cambiato,
+        su cui controllare la soglia e la scadenza del ruolo
+        :rtype: Set[int]
+        """
+        if not self.pending:
+            return set()
+        archive = Archive.get_instance()
+        day = self._day
+        pending = self.pending
+        self.pending = {}
+        self._day = None
+        dank_authors: Set[int] = set()
+        for (author_id, role), amount in pending.items():
+            if not archive.is_present(author_id):
+                continue
+            afler = archive.get(author_id)
+            if role is ChannelRole.ORATOR:
+                afler.increase_orator_buffer(amount, day)
+            elif role is ChannelRole.DANK:
+                afler.increase_dank_counter(amount)
+                dank_authors.add(author_id)
+        archive.save()
+        return dank_authors
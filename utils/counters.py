@@ -0,0 +1,317 @@
+"""Gestione dei contatori dei messaggi e dei ruoli che ne dipendono"""
+from __future__ import annotations
+import asyncio
+from collections import Counter
+from datetime import date, datetime, timedelta
+from functools import partial
+import logging
+from typing import ClassVar, Iterable, List, Optional, Set, Tuple
+
+import discord
+from discord.utils import MISSING
+
+from utils.afler import Afler
+from utils.archive import Archive
+from utils.bot_logger import BotLogger
+from utils.channel_registry import ChannelRole
+from utils.clock import Clock
+from utils.config import Config
+from utils.counter_buffer import CounterBuffer
+from utils.counters_report import CountersReport
+from utils.dank_timer import DankTimer
+from utils.message_ledger import MessageLedger
+from utils.role_scheduler import RoleScheduler
+
+_log = logging.getLogger(__name__)
+
+
+class Counters():
+    """Logica di contatori oratore e cazzaro condivisa tra EventCog, che
+    la invoca dagli eventi di discord e dalle task periodiche, e la
+    simulazione accelerata (vedi utils/simulation.py), che la invoca con un
+    orologio virtuale: conteggio e cancellazione dei messaggi, commit dei
+    contatori accumulati, assegnazione e scadenza del ruolo cazzaro e
+    controllo giornaliero a partizioni.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `Counters`           attributo di classe, contiene l'istanza
+    maintenance_partitions: `int`   attributo di classe, partizioni del controllo giornaliero
+    maintenance_window: `timedelta` attributo di classe, durata del controllo giornaliero
+    archive: `Archive`              l'archivio degli afler
+    buffer: `CounterBuffer`         gli incrementi non ancora riportati sull'archivio
+    ledger: `MessageLedger`         i messaggi conteggiati di recente
+    roles: `RoleScheduler`          le modifiche ai ruoli in attesa
+    dank_timer: `DankTimer`         le scadenze del ruolo cazzaro
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    count():        conteggia un messaggio
+    commit():       coroutine, riporta i contatori accumulati sull'archivio
+    uncount():      coroutine, decrementa i contatori dei messaggi eliminati
+    set_dank():     assegna o rinnova il ruolo cazzaro
+    remove_dank():  rimuove il ruolo cazzaro
+    expire_dank():  coroutine, rimuove i ruoli cazzaro scaduti
+    maintain():     coroutine, controllo giornaliero di contatori e violazioni
+    """
+    _instance: ClassVar[Counters] = MISSING
+    maintenance_partitions: ClassVar[int] = 12
+    maintenance_window: ClassVar[timedelta] = timedelta(hours=1)
+
+    def __init__(self) -> None:
+        self.archive: Archive
+        self.buffer: CounterBuffer
+        self.ledger: MessageLedger
+        self.roles: RoleScheduler
+        self.dank_timer: DankTimer
+        self._lock: asyncio.Lock
+        self._maintenance_day: Optional[date]
+        self._maintained: Set[int]
+        raise RuntimeError(
+            'Usa Counters.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> Counters:
+        """Ritorna l'unica istanza della gestione dei contatori."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.archive = Archive.get_instance()
+            cls._instance.buffer = CounterBuffer.get_instance()
+            cls._instance.ledger = MessageLedger.get_instance()
+            cls._instance.roles = RoleScheduler.get_instance()
+            cls._instance.dank_timer = DankTimer.get_instance()
+            cls._instance._lock = asyncio.Lock()
+            cls._instance._maintenance_day = None
+            cls._instance._maintained = set()
+        return cls._instance
+
+    def count(self, message_id: int, author: discord.abc.User, role: ChannelRole) -> bool:
+        """Conteggia il messaggio nel contatore corrispondente al ruolo del
+        canale. L'incremento è accumulato in CounterBuffer e riportato
+        sull'archivio da commit().
+
+        :param message_id: l'id del messaggio
+        :param author: l'autore del messaggio
+        :param role: il ruolo del canale del messaggio
+
+        :returns: True se il messaggio potrebbe far superare la soglia del
+        ruolo cazzaro, che va assegnato subito chiamando commit()
+        :rtype: bool
+        """
+        if role & ChannelRole.ORATOR:
+            self.buffer.add(author.id, ChannelRole.ORATOR)
+            self.ledger.record(message_id, author.id, ChannelRole.ORATOR)
+        elif role & ChannelRole.DANK:
+            if author.id in self.archive.keys():
+                afler = self.archive.get(author.id)
+            else:
+                afler = Afler.new_entry(author.display_name)
+                self.archive.add(author.id, afler)
+            pending = self.buffer.add(author.id, ChannelRole.DANK)
+            self.ledger.record(message_id, author.id, ChannelRole.DANK)
+            # stima per eccesso: se la finestra è scaduta il buffer riparte
+            # da zero, quindi non si perde mai il superamento della soglia
+            return afler.dank_messages_buffer + pending >= Config.get_config().dank_threshold
+        return False
+
+    async def commit(self) -> None:
+        """Riporta sull'archivio i contatori accumulati e controlla la
+        soglia del ruolo cazzaro per chi ha scritto nel frattempo. La
+        scadenza del ruolo è gestita da expire_dank. Applica anche le
+        modifiche ai ruoli rimaste in attesa, così che quelle fallite siano
+        ritentate a ogni commit.
+        Le chiamate sono eseguite una alla volta, da qualunque punto
+        provengano, così che le assegnazioni del ruolo cazzaro non si
+        sovrappongano.
+        """
+        async with self._lock:
+            changed = False
+            for id in self.buffer.flush():
+                afler = self.archive.get(id)
+                if afler.is_eligible_for_dank():
+                    self.set_dank(afler, id)
+                    changed = True
+            if changed:
+                self.archive.save()
+            if self.roles.pending:
+                # anche le modifiche fallite in precedenza, da ritentare
+                await self.roles.commit()
+
+    async def uncount(self, message_ids: Iterable[int]) -> str:
+        """Decrementa i contatori incrementati dai messaggi eliminati,
+        se registrati nel MessageLedger. I decrementi sono raggruppati per
+        autore, contatore e periodo di invio (giorno per l'oratore, ora per
+        il cazzaro, che è la granularità della sua finestra) così da
+        modificare ogni afler una volta per gruppo e salvare l'archivio una
+        sola volta anche per cancellazioni in blocco.
+
+        :param message_ids: gli id dei messaggi eliminati
+
+        :returns: la descrizione dei decrementi da aggiungere al log, vuota
+        se non c'era nulla da decrementare
+        :rtype: str
+        """
+        groups: Counter[Tuple[int, ChannelRole, datetime]] = Counter()
+        for message_id in message_ids:
+            entry = self.ledger.pop(message_id)
+            if entry is None:
+                # comando, messaggio non conteggiato o troppo vecchio
+                continue
+            if entry.role is ChannelRole.ORATOR:
+                period = entry.sent_at.replace(hour=0, minute=0, second=0, microsecond=0)
+            else:
+                period = entry.sent_at.replace(minute=0, second=0, microsecond=0)
+            groups[(entry.author_id, entry.role, period)] += 1
+        if not groups:
+            return ''
+        # il decremento deve avvenire dopo gli incrementi ancora in attesa
+        await self.commit()
+        totals: Counter[Tuple[int, ChannelRole]] = Counter()
+        missing: Set[int] = set()
+        for (author_id, role, period), amount in groups.items():
+            if not self.archive.is_present(author_id):
+                missing.add(author_id)
+                continue
+            afler = self.archive.get(author_id)
+            if role is ChannelRole.ORATOR:
+                afler.decrease_orator_buffer(amount, period.date())
+            else:
+                afler.decrease_dank_counter(amount, period)
+            totals[(author_id, role)] += amount
+        self.archive.save()
+        lines = []
+        for (author_id, role), amount in totals.items():
+            kind = 'orator' if role is ChannelRole.ORATOR else 'dank'
+            times = '' if amount == 1 else f' di {amount}'
+            lines.append(f'decrementato contatore {kind} di <@{author_id}>{times}')
+        for author_id in missing:
+            lines.append(f'<@{author_id}> non è più presente nell\'archivio')
+        return '\n'.join(lines)
+
+    def set_dank(self, afler: Afler, id: int) -> None:
+        """Imposta il ruolo cazzaro dall'afler. L'assegnazione del ruolo e
+        l'annuncio avvengono alla commit del RoleScheduler.
+
+        :param afler: l'istanza nell'archivio dell'afler a cui conferire il ruolo
+        :param id: l'id di discord dell'afler
+        """
+        config = Config.get_config()
+        member = config.guild.get_member(id)
+        assert member is not None
+        msg = ''
+        if afler.dank:
+            msg = f'{member.mention}: rinnovato ruolo {config.dank_role.mention}'
+        else:
+            msg = f'{member.mention} è diventato un {config.dank_role.mention}'
+        self.roles.stage(member, add=[config.dank_role],
+                         on_commit=partial(self._announce, msg, msg))
+        afler.set_dank()
+        self.dank_timer.schedule(id, afler.dank_expiration)
+
+    def remove_dank(self, afler: Afler, id: int) -> None:
+        """Rimuove il ruolo cazzaro dall'afler. La rimozione del ruolo e
+        l'annuncio avvengono alla commit del RoleScheduler.
+
+        :param afler: l'istanza nell'archivio dell'afler a cui rimuovere il ruolo
+        :param id: l'id di discord dell'afler
+        """
+        config = Config.get_config()
+        member = config.guild.get_member(id)
+        assert member is not None
+        msg = f'{member.mention} non è più un {config.dank_role.mention}'
+        self.roles.stage(member, remove=[config.dank_role],
+                         on_commit=partial(self._announce, msg, f'{msg} :)'))
+        afler.remove_dank()
+
+    async def expire_dank(self) -> List[Tuple[datetime, int]]:
+        """Rimuove il ruolo cazzaro agli afler la cui scadenza nel
+        DankTimer è stata raggiunta. Le voci superate da un rinnovo, o di
+        afler non più presenti, vengono ignorate.
+
+        :returns: le voci (scadenza, id) dei ruoli rimossi
+        :rtype: List[Tuple[datetime, int]]
+        """
+        guild = Config.get_config().guild
+        expired: List[Tuple[datetime, int]] = []
+        for expiration, id in self.dank_timer.pop_due():
+            if not self.archive.is_present(id):
+                continue
+            afler = self.archive.get(id)
+            if (afler.dank_expiration != expiration or not afler.is_dank_expired()
+                    or guild.get_member(id) is None):
+                continue
+            self.remove_dank(afler, id)
+            expired.append((expiration, id))
+        if expired:
+            self.archive.save()
+            await self.roles.commit()
+        return expired
+
+    async def maintain(self) -> None:
+        """Controllo di contatori e violazioni diviso in maintenance_partitions
+        partizioni (per id dell'afler) distribuite nell'arco di
+        maintenance_window, così da non concentrare a mezzanotte le
+        modifiche ai ruoli e gli annunci di tutti i membri.
+
+        Ogni partizione riporta prima gli incrementi in attesa e usa la data
+        del momento in cui viene elaborata, per cui le rotazioni giornaliere
+        (clean_orator_buffer, forget_last_week) restano corrette. Le
+        partizioni già elaborate in giornata non vengono ripetute se il
+        controllo viene riavviato (es. da on_ready); se nel frattempo è
+        cambiato il giorno il ciclo si interrompe e le partizioni rimaste
+        sono gestite dal ciclo del nuovo giorno.
+        Gli annunci nel canale principale sono inviati in un unico
+        riepilogo al termine del ciclo, anche se interrotto (es. da un nuovo
+        ciclo o dallo scaricamento della cog), così che le modifiche ai
+        ruoli già applicate siano sempre annunciate.
+        """
+        clock = Clock.get_instance()
+        logger = BotLogger.get_instance()
+        day = clock.today()
+        if self._maintenance_day != day:
+            self._maintenance_day = day
+            self._maintained = set()
+        partitions = self.maintenance_partitions
+        pending = [p for p in range(partitions) if p not in self._maintained]
+        if not pending:
+            return
+        interval = self.maintenance_window.total_seconds() / partitions
+        await logger.log(
+            f'controllo conteggio messaggi e violazioni: {len(pending)} '
+            f'partizioni, una ogni {interval / 60:.0f} minuti')
+        # annunci e log di tutte le partizioni in un solo riepilogo
+        report = CountersReport()
+        try:
+            for i, partition in enumerate(pending):
+                if i > 0:
+                    await clock.sleep(interval)
+                if clock.today() != day:
+                    break
+                try:
+                    await self.commit()
+                    await self.archive.handle_counters(partition, partitions, report)
+                    self.archive.save()
+                except Exception as e:
+                    _log.exception('errore nel controllo della partizione %d', partition)
+                    await logger.log(f'errore nel controllo contatori della partizione {partition}: {e!r}')
+                    continue
+                self._maintained.add(partition)
+        finally:
+            # eseguito anche se la task viene cancellata durante l'attesa
+            try:
+                await report.announce()
+            except Exception:
+                _log.exception('errore nell\'annuncio del controllo contatori')
+        await logger.log('controllo conteggio messaggi e violazioni terminato')
+
+    async def _announce(self, msg: str, embed: str) -> None:
+        """Logga il messaggio e lo annuncia nel canale principale."""
+        await BotLogger.get_instance().log(msg)
+        await Config.get_config().main_channel.send(embed=discord.Embed(description=embed))
@@ -0,0 +1,75 @@
+"""Riepilogo delle modifiche ai ruoli fatte dal controllo dei contatori"""
+from typing import Awaitable, Callable, List, Tuple
+
+from discord import Embed
+
+from utils.bot_logger import BotLogger
+from utils.config import Config
+from utils.shared_functions import chunk_lines
+
+
+class CountersReport():
+    """Raccoglie l'esito di una o più chiamate ad Archive.handle_counters,
+    così che gli annunci nel canale principale siano un unico embed
+    riassuntivo e i log un unico messaggio, invece di un embed e un log
+    per ogni membro.
+    I membri vengono aggiunti dalle callback del RoleScheduler, quindi solo
+    dopo che la modifica del ruolo è andata a buon fine.
+
+    Attributes
+    -------------
+    new_orators: `List[str]`        menzioni dei nuovi oratori
+    renewed_orators: `List[str]`    menzioni degli oratori rinnovati
+    expired_orators: `List[str]`    menzioni degli oratori scaduti
+    logs: `List[str]`               altri eventi da loggare (violazioni)
+
+    Methods
+    -------------
+    collect():  ritorna la callback che aggiunge un membro a un elenco
+    announce(): coroutine, invia il riepilogo e svuota il report
+    """
+
+    def __init__(self) -> None:
+        self.new_orators: List[str] = []
+        self.renewed_orators: List[str] = []
+        self.expired_orators: List[str] = []
+        self.logs: List[str] = []
+
+    def __bool__(self) -> bool:
+        return any((self.new_orators, self.renewed_orators, self.expired_orators, self.logs))
+
+    @staticmethod
+    def collect(section: List[str], mention: str) -> Callable[[], Awaitable[None]]:
+        """Ritorna la callback da passare a RoleScheduler.stage per
+        aggiungere il membro all'elenco a modifica avvenuta.
+
+        :param section: l'elenco del report
+        :param mention: la menzione del membro
+        """
+        async def callback() -> None:
+            section.append(mention)
+        return callback
+
+    def _sections(self) -> List[Tuple[str, List[str]]]:
+        config = Config.get_config()
+        orator = config.orator_role.mention
+        return [(f'Nuovi {orator}', self.new_orators),
+                (f'{orator} rinnovati', self.renewed_orators),
+                (f'{orator} scaduti :(', self.expired_orators)]
+
+    async def announce(self) -> None:
+        """Invia nel canale principale un embed con le modifiche ai ruoli e
+        nel canale di log le stesse insieme agli altri eventi, poi svuota il
+        report. Non invia nulla se il report è vuoto.
+        """
+        lines = [f'**{title}**: {", ".join(members)}'
+                 for title, members in self._sections() if members]
+        if lines:
+            main_channel = Config.get_config().main_channel
+            for chunk in chunk_lines(lines):
+                await main_channel.send(embed=Embed(title='Aggiornamento ruoli', description=chunk))
+        logger = BotLogger.get_instance()
+        for chunk in chunk_lines(lines + self.logs):
+            await logger.log(chunk)
+        for section in (self.new_orators, self.renewed_orators, self.expired_orators, self.logs):
+            section.clear()
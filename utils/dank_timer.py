@@ -0,0 +1,117 @@
+"""Scadenze del ruolo cazzaro in ordine di tempo"""
+from __future__ import annotations
+import asyncio
+from datetime import datetime
+import heapq
+from typing import TYPE_CHECKING, ClassVar, List, Optional, Tuple
+
+from discord.utils import MISSING
+
+from utils.clock import Clock
+
+if TYPE_CHECKING:
+    from utils.archive import Archive
+
+
+class DankTimer():
+    """Coda con priorità delle scadenze del ruolo cazzaro, usata da un'unica
+    task in background per rimuovere il ruolo all'ora esatta invece di
+    controllarne la scadenza a ogni messaggio o a mezzanotte.
+    Le scadenze sono già salvate nell'archivio, da cui la coda viene
+    ricostruita all'avvio. Un rinnovo aggiunge una nuova voce senza togliere
+    la precedente: le voci superate vengono scartate da chi le estrae
+    confrontandole con la scadenza attuale dell'afler.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `DankTimer`      attributo di classe, contiene l'istanza
+    heap: `List[Tuple[datetime, int]]`  heap di (scadenza, id dell'afler)
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    rebuild():  ricostruisce la coda dalle scadenze dell'archivio
+    schedule(): aggiunge una scadenza
+    pop_due():  estrae le scadenze raggiunte
+    wait():     coroutine, attende la prossima scadenza o una nuova voce
+    """
+    _instance: ClassVar[DankTimer] = MISSING
+
+    def __init__(self) -> None:
+        self.heap: List[Tuple[datetime, int]]
+        self._wakeup: asyncio.Event
+        raise RuntimeError(
+            'Usa DankTimer.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> DankTimer:
+        """Ritorna l'unica istanza della coda delle scadenze."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.heap = []
+            cls._instance._wakeup = asyncio.Event()
+        return cls._instance
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def rebuild(self, archive: Archive) -> None:
+        """Ricostruisce la coda con le scadenze degli afler cazzari.
+
+        :param archive: l'archivio degli afler
+        """
+        self.heap = [(afler.dank_expiration, id)
+                     for id, afler in archive.archive.items()
+                     if afler.dank and afler.dank_expiration is not None]
+        heapq.heapify(self.heap)
+        self._wakeup.set()
+
+    def schedule(self, afler_id: int, expiration: Optional[datetime]) -> None:
+        """Aggiunge la scadenza del ruolo dell'afler.
+
+        :param afler_id: l'id dell'afler
+        :param expiration: la scadenza del ruolo, ignorata se None
+        """
+        if expiration is None:
+            return
+        heapq.heappush(self.heap, (expiration, afler_id))
+        if self.heap[0][1] == afler_id:
+            # è la prima scadenza, la task deve ricalcolare l'attesa
+            self._wakeup.set()
+
+    def pop_due(self, now: Optional[datetime] = None) -> List[Tuple[datetime, int]]:
+        """Estrae le voci la cui scadenza è stata raggiunta.
+
+        :param now: l'istante di riferimento, se non specificato adesso
+
+        :returns: le voci (scadenza, id) scadute, da confrontare con la
+        scadenza attuale dell'afler
+        :rtype: List[Tuple[datetime, int]]
+        """
+        if now is None:
+            now = Clock.get_instance().now().astimezone()
+        due: List[Tuple[datetime, int]] = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    async def wait(self) -> None:
+        """Attende fino alla prossima scadenza, o finché non viene aggiunta
+        una scadenza precedente o ricostruita la coda.
+        """
+        self._wakeup.clear()
+        timeout = None
+        if self.heap:
+            timeout = (self.heap[0][0] - Clock.get_instance().now().astimezone()).total_seconds()
+            if timeout <= 0:
+                return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,147 @@
+"""Invio in background dei messaggi privati ai membri"""
+from __future__ import annotations
+import asyncio
+from datetime import date, timedelta
+import json
+import logging
+from typing import ClassVar, Dict, List, Optional, Tuple
+
+import discord
+from discord.utils import MISSING
+
+from utils.clock import Clock
+from utils.paths import UNDELIVERABLE_DM_FILE
+from utils.shared_functions import update_json_file
+
+_log = logging.getLogger(__name__)
+
+
+class DMDispatcher():
+    """Invia i messaggi privati da un pool di worker, così che chi li
+    richiede (warn, ban, controlli sui nickname) non debba attendere la
+    consegna né gestire gli errori dei membri con i dm chiusi.
+    I canali dm sono tenuti in cache, gli errori temporanei vengono
+    ritentati con attesa crescente e i membri che non accettano dm sono
+    registrati e saltati per undeliverable_days giorni.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `DMDispatcher`       attributo di classe, contiene l'istanza
+    workers: `int`                  attributo di classe, invii contemporanei
+    max_retries: `int`              attributo di classe, tentativi per gli errori temporanei
+    undeliverable_days: `int`       attributo di classe, giorni per cui saltare un membro
+    undeliverable: `Dict[int, date]`    id membro -> giorno dell'ultimo invio fallito
+
+    Classmethods
+    -------------
+    load():         carica i membri irraggiungibili da file
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    send():         accoda un messaggio privato, ritorna un future con l'esito
+    """
+    _instance: ClassVar[DMDispatcher] = MISSING
+    workers: ClassVar[int] = 2
+    max_retries: ClassVar[int] = 3
+    undeliverable_days: ClassVar[int] = 7
+
+    def __init__(self) -> None:
+        self.undeliverable: Dict[int, date]
+        self._channels: Dict[int, discord.DMChannel]
+        self._queue: Optional[asyncio.Queue[Tuple[discord.abc.User, str, asyncio.Future[bool]]]]
+        self._tasks: List[asyncio.Task]
+        raise RuntimeError(
+            'Usa DMDispatcher.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> DMDispatcher:
+        """Ritorna l'unica istanza del dispatcher."""
+        if cls._instance is MISSING:
+            cls.load()
+        return cls._instance
+
+    @classmethod
+    def load(cls) -> None:
+        """Crea il dispatcher caricando l'elenco dei membri irraggiungibili."""
+        undeliverable: Dict[int, date] = {}
+        try:
+            with open(UNDELIVERABLE_DM_FILE, 'r') as file:
+                data = json.load(file)
+            for key, value in data.items():
+                undeliverable[int(key)] = date.fromisoformat(value)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        cls._instance = cls.__new__(cls)
+        cls._instance.undeliverable = undeliverable
+        cls._instance._channels = {}
+        cls._instance._queue = None
+        cls._instance._tasks = []
+
+    def send(self, user: discord.abc.User, content: str) -> asyncio.Future[bool]:
+        """Accoda un messaggio privato per l'utente. I worker vengono
+        avviati al primo invio.
+
+        :param user: il destinatario
+        :param content: il testo del messaggio
+
+        :returns: un future che vale True se il messaggio è stato consegnato;
+        può essere atteso (ad esempio prima di un ban) oppure ignorato
+        :rtype: asyncio.Future[bool]
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[bool] = loop.create_future()
+        skipped = self.undeliverable.get(user.id)
+        if skipped is not None:
+            if Clock.get_instance().today() - skipped < timedelta(days=self.undeliverable_days):
+                future.set_result(False)
+                return future
+            del self.undeliverable[user.id]
+            self._save()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker(self._queue))
+                           for _ in range(self.workers)]
+        self._queue.put_nowait((user, content, future))
+        return future
+
+    async def _worker(self, queue: asyncio.Queue[Tuple[discord.abc.User, str, asyncio.Future[bool]]]) -> None:
+        while True:
+            user, content, future = await queue.get()
+            try:
+                delivered = await self._deliver(user, content)
+            except Exception:
+                _log.exception('errore nell\'invio del dm a %s', user)
+                delivered = False
+            if not future.done():
+                future.set_result(delivered)
+            queue.task_done()
+
+    async def _deliver(self, user: discord.abc.User, content: str) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                channel = self._channels.get(user.id)
+                if channel is None:
+                    channel = user.dm_channel or await user.create_dm()
+                    self._channels[user.id] = channel
+                await channel.send(content)
+                return True
+            except discord.Forbidden:
+                # dm chiusi o nessun server in comune: inutile riprovare
+                self.undeliverable[user.id] = Clock.get_instance().today()
+                self._save()
+                return False
+            except discord.HTTPException as e:
+                if attempt == self.max_retries or (e.status != 429 and e.status < 500):
+                    raise
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    def _save(self) -> None:
+        """Salva su file l'elenco dei membri irraggiungibili."""
+        update_json_file(
+            {str(k): v.isoformat() for k, v in self.undeliverable.items()},
+            UNDELIVERABLE_DM_FILE)
@@ -0,0 +1,188 @@
+"""Archivio locale degli allegati dei messaggi eliminati.
+
+Gli allegati vengono salvati su disco indicizzati dal loro hash SHA-256,
+così che lo stesso file (es. un meme ripostato più volte) venga caricato
+nel canale di log una volta sola: le occorrenze successive sono riportate
+come riferimento al messaggio di log che lo contiene già.
+"""
+from __future__ import annotations
+import asyncio
+from datetime import datetime, timedelta
+import hashlib
+import json
+from pathlib import Path
+from typing import ClassVar, Dict, List, Optional, TypedDict
+
+import discord
+from discord.utils import MISSING
+
+from utils.paths import EVIDENCE_DIR, EVIDENCE_INDEX_FILE
+from utils.shared_functions import update_json_file
+
+
+class EvidenceEntry(TypedDict):
+    """Struttura di una entry dell'indice degli allegati"""
+    filename: str
+    size: int
+    first_seen: str
+    last_seen: str
+    jump_url: Optional[str]
+
+
+class EvidenceStore():
+    """Archivio content-addressed degli allegati dei messaggi eliminati.
+    Ogni file è salvato in EVIDENCE_DIR/<primi 2 caratteri hash>/<hash>,
+    mentre l'indice tiene traccia del nome originale, della dimensione e
+    del messaggio di log in cui il file è già stato caricato.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `EvidenceStore`  attributo di classe, contiene l'istanza
+    retention_days: `int`       giorni dopo l'ultimo utilizzo oltre i quali
+    un allegato viene rimosso dall'archivio
+    index: `Dict[str, EvidenceEntry]`   indice hash -> dati dell'allegato
+
+    Classmethods
+    -------------
+    load():         carica l'indice da file
+    get_instance(): ritorna l'unica istanza dell'archivio
+
+    Methods
+    -------------
+    store():        coroutine, salva l'allegato e ne ritorna l'hash
+    uploaded_url(): ritorna il link al log che contiene già l'allegato
+    to_file():      crea il discord.File da caricare a partire dall'hash
+    bind():         associa gli allegati al messaggio di log che li contiene
+    purge():        rimuove gli allegati più vecchi del periodo di retention
+    """
+    _instance: ClassVar[EvidenceStore] = MISSING
+    retention_days: ClassVar[int] = 30
+
+    def __init__(self) -> None:
+        self.index: Dict[str, EvidenceEntry]
+        raise RuntimeError(
+            'Usa EvidenceStore.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> EvidenceStore:
+        """Ritorna l'unica istanza dell'archivio degli allegati."""
+        if cls._instance is MISSING:
+            cls.load()
+        return cls._instance
+
+    @classmethod
+    def load(cls) -> None:
+        """Carica l'indice degli allegati, creando la cartella se assente.
+        Un indice corrotto viene scartato: i file su disco restano ma
+        verranno ricaricati nel log alla prossima occorrenza.
+        """
+        EVIDENCE_DIR.mkdir(parents=True, exist_ok=True)
+        index: Dict[str, EvidenceEntry]
+        try:
+            with open(EVIDENCE_INDEX_FILE, 'r') as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        cls._instance = cls.__new__(cls)
+        cls._instance.index = index
+
+    def _path(self, digest: str) -> Path:
+        return EVIDENCE_DIR / digest[:2] / digest
+
+    async def store(self, attachment: discord.Attachment) -> Optional[str]:
+        """Scarica l'allegato e lo salva nell'archivio se non già presente.
+
+        :param attachment: l'allegato da archiviare
+
+        :returns: l'hash SHA-256 dell'allegato, None se non è più scaricabile
+        :rtype: Optional[str]
+        """
+        try:
+            # il proxy_url resta valido più a lungo dopo l'eliminazione
+            data = await attachment.read(use_cached=True)
+        except (discord.Forbidden, discord.HTTPException, discord.NotFound):
+            return None
+        # hash e scrittura su disco fuori dall'event loop, gli allegati
+        # possono essere di decine di MB
+        digest = await asyncio.to_thread(self._write, data)
+        now = datetime.now().isoformat()
+        entry = self.index.get(digest)
+        if entry is None:
+            self.index[digest] = {
+                'filename': attachment.filename,
+                'size': len(data),
+                'first_seen': now,
+                'last_seen': now,
+                'jump_url': None
+            }
+        else:
+            entry['last_seen'] = now
+        return digest
+
+    def _write(self, data: bytes) -> str:
+        """Salva il file se non già presente e ne ritorna l'hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(data)
+        return digest
+
+    def uploaded_url(self, digest: str) -> Optional[str]:
+        """Ritorna il link al messaggio di log in cui l'allegato è già
+        stato caricato, se presente.
+
+        :param digest: l'hash dell'allegato
+        """
+        return self.index[digest]['jump_url']
+
+    def to_file(self, digest: str, spoiler: bool = False, prefix: str = '') -> discord.File:
+        """Crea il file da caricare nel canale di log.
+
+        :param digest: l'hash dell'allegato
+        :param spoiler: se l'allegato originale era sotto spoiler
+        :param prefix: prefisso del nome del file (es. il numero dell'allegato)
+        """
+        return discord.File(
+            self._path(digest),
+            filename=prefix + self.index[digest]['filename'],
+            spoiler=spoiler
+        )
+
+    def bind(self, digests: List[str], log_message: discord.Message) -> None:
+        """Registra il messaggio di log che contiene gli allegati appena
+        caricati, così che le occorrenze successive possano riferirsi a esso.
+        Salva anche l'indice, aggiornato dalle store() precedenti.
+
+        :param digests: gli hash degli allegati caricati
+        :param log_message: il messaggio di log inviato
+        """
+        for digest in digests:
+            self.index[digest]['jump_url'] = log_message.jump_url
+        self._save()
+
+    def purge(self) -> int:
+        """Rimuove dall'archivio gli allegati non più visti da almeno
+        retention_days giorni.
+
+        :returns: il numero di allegati rimossi
+        :rtype: int
+        """
+        limit = datetime.now() - timedelta(days=self.retention_days)
+        expired = [
+            digest for digest, entry in self.index.items()
+            if datetime.fromisoformat(entry['last_seen']) < limit
+        ]
+        for digest in expired:
+            self._path(digest).unlink(missing_ok=True)
+            del self.index[digest]
+        if expired:
+            self._save()
+        return len(expired)
+
+    def _save(self) -> None:
+        """Salva su disco l'indice degli allegati."""
+        update_json_file(self.index, EVIDENCE_INDEX_FILE)
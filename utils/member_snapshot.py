@@ -0,0 +1,143 @@
+"""Istantanea persistente dei membri già verificati dal controllo di coerenza"""
+from __future__ import annotations
+from datetime import datetime
+import json
+from typing import ClassVar, Dict, Iterable, List, Optional
+import zlib
+
+import discord
+from discord.utils import MISSING
+
+from utils.paths import MEMBER_SNAPSHOT_FILE
+from utils.shared_functions import update_json_file
+
+
+class MemberSnapshot():
+    """Ricorda, per ogni membro trovato coerente con l'archivio, un'impronta
+    di nickname, username e presenza del ruolo AFL. Al controllo di
+    coerenza successivo (riavvio o resume del gateway) vanno esaminati solo
+    i membri la cui impronta è cambiata o assente, invece di tutto il server.
+    L'impronta è un crc32, stabile tra un avvio e l'altro a differenza di hash().
+
+    Un membro viene registrato solo dopo che il controllo lo ha trovato
+    coerente o dopo che la correzione (es. ripristino del nick) è andata a
+    buon fine: in caso di errore resta fuori e verrà riesaminato.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `MemberSnapshot`     attributo di classe, contiene l'istanza
+    entries: `Dict[int, int]`       id membro -> impronta
+    seen_at: `Optional[datetime]`   fine dell'ultimo controllo di coerenza
+
+    Classmethods
+    -------------
+    load():         carica l'istantanea da file
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    fingerprint():  calcola l'impronta di un membro
+    changed():      ritorna i membri da esaminare
+    record():       registra un membro coerente
+    discard():      dimentica un membro
+    prune():        dimentica i membri non più nel server
+    save():         salva l'istantanea su file
+    """
+    _instance: ClassVar[MemberSnapshot] = MISSING
+
+    def __init__(self) -> None:
+        self.entries: Dict[int, int]
+        self.seen_at: Optional[datetime]
+        raise RuntimeError(
+            'Usa MemberSnapshot.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> MemberSnapshot:
+        """Ritorna l'unica istanza dell'istantanea dei membri."""
+        if cls._instance is MISSING:
+            cls.load()
+        return cls._instance
+
+    @classmethod
+    def load(cls) -> None:
+        """Carica l'istantanea da file. Se manca o è corrotta si parte da
+        un'istantanea vuota: il primo controllo esaminerà tutti i membri.
+        """
+        entries: Dict[int, int] = {}
+        seen_at = None
+        try:
+            with open(MEMBER_SNAPSHOT_FILE, 'r') as file:
+                data = json.load(file)
+            entries = {int(k): v for k, v in data['members'].items()}
+            if data.get('seen_at') is not None:
+                seen_at = datetime.fromisoformat(data['seen_at'])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+            entries = {}
+        cls._instance = cls.__new__(cls)
+        cls._instance.entries = entries
+        cls._instance.seen_at = seen_at
+
+    @staticmethod
+    def fingerprint(member: discord.Member, afl_role: discord.Role, nick: Optional[str] = MISSING) -> int:
+        """Calcola l'impronta del membro.
+
+        :param member: il membro
+        :param afl_role: il ruolo AFL
+        :param nick: il nickname da usare al posto di quello attuale,
+        ad esempio quello appena impostato dal bot
+
+        :returns: il crc32 di nickname, username e ruolo AFL
+        :rtype: int
+        """
+        if nick is MISSING:
+            nick = member.nick
+        key = f'{nick}\0{member.name}\0{afl_role in member.roles}'
+        return zlib.crc32(key.encode())
+
+    def changed(self, members: Iterable[discord.Member], afl_role: discord.Role) -> List[discord.Member]:
+        """Ritorna i membri la cui impronta è diversa da quella registrata.
+
+        :param members: i membri del server
+        :param afl_role: il ruolo AFL
+
+        :returns: i membri da esaminare
+        :rtype: List[discord.Member]
+        """
+        return [m for m in members
+                if self.entries.get(m.id) != self.fingerprint(m, afl_role)]
+
+    def record(self, member: discord.Member, afl_role: discord.Role, nick: Optional[str] = MISSING) -> None:
+        """Registra il membro come coerente.
+
+        :param member: il membro
+        :param afl_role: il ruolo AFL
+        :param nick: il nickname appena impostato, se diverso da quello
+        ancora in cache
+        """
+        self.entries[member.id] = self.fingerprint(member, afl_role, nick)
+
+    def discard(self, member_id: int) -> None:
+        """Dimentica il membro, che verrà riesaminato al prossimo controllo.
+
+        :param member_id: l'id del membro
+        """
+        self.entries.pop(member_id, None)
+
+    def prune(self, member_ids: Iterable[int]) -> None:
+        """Tiene solo i membri indicati, eliminando quelli usciti.
+
+        :param member_ids: gli id dei membri attuali del server
+        """
+        current = set(member_ids)
+        self.entries = {k: v for k, v in self.entries.items() if k in current}
+
+    def save(self) -> None:
+        """Salva l'istantanea su file aggiornando seen_at."""
+        self.seen_at = datetime.now()
+        update_json_file({
+            'seen_at': self.seen_at.isoformat(),
+            'members': {str(k): v for k, v in self.entries.items()}
+        }, MEMBER_SNAPSHOT_FILE)
@@ -0,0 +1,177 @@
+"""Registro compatto dei messaggi conteggiati di recente"""
+from __future__ import annotations
+from array import array
+from datetime import datetime
+from typing import ClassVar, Dict, NamedTuple, Optional
+
+from discord.utils import MISSING, snowflake_time
+
+from utils.channel_registry import ChannelRole
+from utils.paths import MESSAGE_LEDGER_FILE
+
+
+class LedgerEntry(NamedTuple):
+    """Messaggio conteggiato: autore, contatore incrementato e data di
+    invio nel fuso locale (ricavata dall'id del messaggio).
+    """
+    author_id: int
+    role: ChannelRole
+    sent_at: datetime
+
+
+class MessageLedger():
+    """Tiene traccia degli ultimi messaggi che hanno incrementato un
+    contatore, così da poterlo decrementare alla loro cancellazione anche
+    quando il messaggio non è più nella cache di discord.py (es. dopo un
+    riavvio). Ogni voce occupa 17 byte in tre array paralleli usati come
+    buffer circolare: quando è pieno le voci più vecchie vengono
+    sovrascritte. La data di invio non è salvata perché è già contenuta
+    nell'id del messaggio.
+    Le ultime persisted voci vengono salvate su file in formato binario e
+    ricaricate all'avvio.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `MessageLedger`  attributo di classe, contiene l'istanza
+    capacity: `int`             attributo di classe, numero massimo di voci
+    persisted: `int`            attributo di classe, voci salvate su file
+    ids: `array[int]`           id dei messaggi, 0 se la posizione è libera
+    authors: `array[int]`       id degli autori
+    roles: `array[int]`         valore del ChannelRole del contatore
+    dirty: `bool`               se ci sono modifiche non salvate
+
+    Classmethods
+    -------------
+    empty():        ritorna un registro vuoto
+    load():         carica il registro da file
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    record():   registra un messaggio conteggiato
+    pop():      rimuove un messaggio e ne ritorna i dati, se presente
+    save():     salva su file le voci più recenti
+    """
+    _instance: ClassVar[MessageLedger] = MISSING
+    capacity: ClassVar[int] = 20000
+    persisted: ClassVar[int] = 5000
+
+    def __init__(self) -> None:
+        self.ids: array[int]
+        self.authors: array[int]
+        self.roles: array[int]
+        self.dirty: bool
+        self._next: int
+        self._index: Dict[int, int]
+        raise RuntimeError(
+            'Usa MessageLedger.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> MessageLedger:
+        """Ritorna l'unica istanza del registro dei messaggi."""
+        if cls._instance is MISSING:
+            cls.load()
+        return cls._instance
+
+    @classmethod
+    def empty(cls) -> MessageLedger:
+        """Ritorna un registro vuoto, senza leggere il file né
+        installarlo come istanza (vedi utils/simulation.py).
+        """
+        ledger = cls.__new__(cls)
+        ledger.ids = array('Q', bytes(8 * cls.capacity))
+        ledger.authors = array('Q', bytes(8 * cls.capacity))
+        ledger.roles = array('B', bytes(cls.capacity))
+        ledger.dirty = False
+        ledger._next = 0
+        ledger._index = {}
+        return ledger
+
+    @classmethod
+    def load(cls) -> None:
+        """Crea il registro e carica le voci salvate. Un file mancante o
+        troncato viene ignorato: si perdono solo i decrementi dei messaggi
+        precedenti.
+        """
+        ledger = cls.empty()
+        try:
+            with open(MESSAGE_LEDGER_FILE, 'rb') as file:
+                header = array('Q')
+                header.fromfile(file, 1)
+                count = header[0]
+                ids, authors, roles = array('Q'), array('Q'), array('B')
+                ids.fromfile(file, count)
+                authors.fromfile(file, count)
+                roles.fromfile(file, count)
+        except (FileNotFoundError, EOFError):
+            pass
+        else:
+            for message_id, author_id, role in zip(ids, authors, roles):
+                ledger.record(message_id, author_id, ChannelRole(role))
+            ledger.dirty = False
+        cls._instance = ledger
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._index
+
+    def record(self, message_id: int, author_id: int, role: ChannelRole) -> None:
+        """Registra un messaggio che ha incrementato un contatore.
+
+        :param message_id: l'id del messaggio
+        :param author_id: l'id dell'autore
+        :param role: ChannelRole.ORATOR o ChannelRole.DANK
+        """
+        slot = self._next
+        old = self.ids[slot]
+        if old:
+            del self._index[old]
+        self.ids[slot] = message_id
+        self.authors[slot] = author_id
+        self.roles[slot] = role.value
+        self._index[message_id] = slot
+        self._next = (slot + 1) % self.capacity
+        self.dirty = True
+
+    def pop(self, message_id: int) -> Optional[LedgerEntry]:
+        """Rimuove il messaggio dal registro. Usato sia alla cancellazione
+        del messaggio sia per dimenticare un messaggio che il bot elimina
+        senza volerne decrementare il contatore (es. repost dei link).
+
+        :param message_id: l'id del messaggio
+
+        :returns: i dati del messaggio, None se non era registrato
+        :rtype: Optional[LedgerEntry]
+        """
+        slot = self._index.pop(message_id, None)
+        if slot is None:
+            return None
+        self.ids[slot] = 0
+        self.dirty = True
+        return LedgerEntry(
+            self.authors[slot],
+            ChannelRole(self.roles[slot]),
+            snowflake_time(message_id).astimezone()
+        )
+
+    def save(self) -> None:
+        """Salva su file le ultime persisted voci, dalla più vecchia."""
+        ids, authors, roles = array('Q'), array('Q'), array('B')
+        start = self._next - min(self.persisted, self.capacity)
+        for i in range(start, self._next):
+            slot = i % self.capacity
+            if self.ids[slot]:
+                ids.append(self.ids[slot])
+                authors.append(self.authors[slot])
+                roles.append(self.roles[slot])
+        with open(MESSAGE_LEDGER_FILE, 'wb') as file:
+            array('Q', [len(ids)]).tofile(file)
+            ids.tofile(file)
+            authors.tofile(file)
+            roles.tofile(file)
+        self.dirty = False
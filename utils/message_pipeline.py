@@ -0,0 +1,195 @@
+"""Pipeline unica per l'elaborazione dei messaggi.
+
+Invece di avere un listener on_message per ogni cog, ciascuno dei quali
+ricalcola le stesse informazioni sul messaggio, le cog registrano delle
+fasi (stage) che vengono eseguite in ordine su un unico contesto calcolato
+una sola volta per messaggio.
+"""
+from __future__ import annotations
+import logging
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
+
+import discord
+
+from utils import shared_functions as sf
+from utils.channel_registry import ChannelRegistry, ChannelRole
+
+if TYPE_CHECKING:
+    from aflbot import AFLBot
+
+_log = logging.getLogger(__name__)
+
+
+class MessageContext():
+    """Informazioni sul messaggio condivise tra le fasi della pipeline.
+
+    Attributes
+    -------------
+    message: `discord.Message`          il messaggio (dopo la modifica, se è un edit)
+    before: `Optional[discord.Message]` il messaggio prima della modifica, solo per gli edit
+    relevant: `bool`                    se il messaggio va processato (vedi relevant_message)
+    channel_id: `int`                   id del canale, o del canale padre per i thread
+    channel_role: `ChannelRole`         ruolo del canale (vedi ChannelRegistry)
+    is_command: `bool`                  se il messaggio è un comando testuale
+    content: `str`                      testo del messaggio in minuscolo
+    urls: `List[str]`                   parole del messaggio che contengono un link
+    """
+
+    def __init__(self, message: discord.Message, prefix: str, before: Optional[discord.Message] = None) -> None:
+        self.message = message
+        self.before = before
+        self.relevant = sf.relevant_message(message)
+        if not self.relevant:
+            return
+        channel = message.channel
+        if isinstance(channel, discord.Thread) and channel.parent_id is not None:
+            self.channel_id: int = channel.parent_id
+        else:
+            self.channel_id = channel.id
+        self.channel_role: ChannelRole = ChannelRegistry.get_instance().lookup(channel)
+        self.is_command: bool = sf.is_command(message.content, prefix)
+        self.content: str = message.content.lower()
+        self.urls: List[str] = [
+            word for word in message.content.split() if '//' in word]
+
+    @property
+    def is_edit(self) -> bool:
+        """True se il contesto riguarda la modifica di un messaggio."""
+        return self.before is not None
+
+
+StageCallback = Callable[[MessageContext], Awaitable[bool]]
+
+
+class Stage():
+    """Fase della pipeline. La callback ritorna True se ha gestito
+    completamente il messaggio, interrompendo le fasi successive.
+
+    Attributes
+    -------------
+    name: `str`             nome della fase, usato per le statistiche
+    order: `int`            posizione nella pipeline (crescente)
+    callback: `StageCallback`   coroutine da eseguire
+    on_message: `bool`      se eseguire la fase sui nuovi messaggi
+    on_edit: `bool`         se eseguire la fase sui messaggi modificati
+    calls: `int`            numero di esecuzioni
+    total_ns: `int`         tempo totale di esecuzione in nanosecondi
+    max_ns: `int`           tempo massimo di una singola esecuzione
+    """
+
+    def __init__(self, name: str, order: int, callback: StageCallback, on_message: bool, on_edit: bool) -> None:
+        self.name = name
+        self.order = order
+        self.callback = callback
+        self.on_message = on_message
+        self.on_edit = on_edit
+        self.calls = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+
+class MessagePipeline():
+    """Esegue in ordine le fasi registrate dalle cog su ogni messaggio
+    rilevante (vedi relevant_message), sia nuovo che modificato.
+    Tiene traccia del tempo speso in ogni fase.
+
+    Methods
+    -------------
+    register():     aggiunge una fase alla pipeline
+    unregister():   rimuove una fase dalla pipeline
+    process():      coroutine, elabora un nuovo messaggio
+    process_edit(): coroutine, elabora un messaggio modificato
+    stats():        ritorna un riepilogo dei tempi di ogni fase
+    """
+
+    def __init__(self, bot: AFLBot) -> None:
+        self.bot = bot
+        self.stages: List[Stage] = []
+
+    def register(
+            self,
+            name: str,
+            order: int,
+            callback: StageCallback,
+            *,
+            on_message: bool = True,
+            on_edit: bool = False) -> None:
+        """Aggiunge una fase alla pipeline. Se esiste già una fase con lo
+        stesso nome viene sostituita (es. al reload di una cog).
+
+        :param name: nome della fase
+        :param order: posizione nella pipeline, le fasi sono eseguite in ordine crescente
+        :param callback: la coroutine da eseguire, ritorna True per interrompere la pipeline
+        :param on_message: se eseguire la fase sui nuovi messaggi
+        :param on_edit: se eseguire la fase sui messaggi modificati
+        """
+        self.unregister(name)
+        self.stages.append(Stage(name, order, callback, on_message, on_edit))
+        self.stages.sort(key=lambda s: s.order)
+
+    def unregister(self, name: str) -> None:
+        """Rimuove la fase dalla pipeline, se presente.
+
+        :param name: nome della fase
+        """
+        self.stages = [s for s in self.stages if s.name != name]
+
+    async def process(self, message: discord.Message) -> None:
+        """Listener di on_message: esegue le fasi sul nuovo messaggio."""
+        ctx = MessageContext(message, self._prefix())
+        if ctx.relevant:
+            await self._run(ctx, [s for s in self.stages if s.on_message])
+
+    async def process_edit(self, before: discord.Message, after: discord.Message) -> None:
+        """Listener di on_message_edit: esegue le fasi sul messaggio
+        modificato. Sono considerate solo le modifiche effettive al testo
+        (ad esempio non l'aggiunta di un embed, che discord notifica
+        comunque come modifica).
+        """
+        if before.content == after.content:
+            return
+        ctx = MessageContext(after, self._prefix(), before)
+        if ctx.relevant:
+            await self._run(ctx, [s for s in self.stages if s.on_edit])
+
+    def _prefix(self) -> str:
+        # import circolare: config importa aflbot, che importa questo modulo
+        from utils.config import Config
+        # stessa fonte usata alla cancellazione (vedi EventCog), così che un
+        # messaggio sia un comando sia all'invio sia all'eliminazione
+        return Config.get_config().current_prefix
+
+    async def _run(self, ctx: MessageContext, stages: List[Stage]) -> None:
+        for stage in stages:
+            start = time.perf_counter_ns()
+            try:
+                handled = await stage.callback(ctx)
+            except Exception:
+                # un errore in una fase non deve bloccare le successive,
+                # come accadeva con listener separati
+                _log.exception('errore nella fase %s', stage.name)
+                handled = False
+            elapsed = time.perf_counter_ns() - start
+            stage.calls += 1
+            stage.total_ns += elapsed
+            stage.max_ns = max(stage.max_ns, elapsed)
+            if handled:
+                return
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Ritorna per ogni fase il numero di esecuzioni e i tempi medio e
+        massimo in millisecondi. I tempi includono le attese delle
+        chiamate a discord fatte dalla fase.
+
+        :returns: le statistiche indicizzate per nome della fase
+        :rtype: Dict[str, Dict[str, float]]
+        """
+        return {
+            stage.name: {
+                'calls': stage.calls,
+                'avg_ms': stage.total_ns / stage.calls / 1e6 if stage.calls else 0.0,
+                'max_ms': stage.max_ns / 1e6
+            }
+            for stage in self.stages
+        }
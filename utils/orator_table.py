@@ -0,0 +1,250 @@
+"""Rotazione giornaliera dei contatori oratore su colonne.
+
+I buffer settimanali e giornalieri degli afler vengono copiati in colonne
+(una matrice n x 7 per lo storico settimanale, un vettore per il buffer
+giornaliero e uno per la data dell'ultimo messaggio), così che la rotazione
+giornaliera (clean_orator_buffer + forget_last_week) e il controllo della
+soglia oratore siano operazioni sull'intera tabella invece di chiamate ai
+metodi di ogni afler. Se NumPy è installato le operazioni sono vettoriali,
+altrimenti si usano gli array della libreria standard.
+
+Benchmark con 100k afler sintetici (verifica anche che il risultato coincida
+con i metodi di Afler):
+    python -m utils.orator_table
+"""
+from __future__ import annotations
+from array import array
+from datetime import date
+from typing import TYPE_CHECKING, Any, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if TYPE_CHECKING:
+    from utils.afler import Afler
+
+
+def _weekday(ordinal: int) -> int:
+    # date.fromordinal(1) è un lunedì
+    return (ordinal - 1) % 7
+
+
+class OratorTable():
+    """Tabella a colonne dei contatori oratore di un insieme di afler.
+
+    Attributes
+    -------------
+    ids: `List[int]`            id degli afler, nell'ordine delle righe
+    aflers: `List[Afler]`       gli afler a cui riportare le modifiche
+    use_numpy: `bool`           se la tabella usa NumPy
+    last: colonna con l'ordinale della data dell'ultimo messaggio (0 se assente)
+    daily: colonna con il buffer giornaliero
+    weekly: matrice n x 7 (array piatto senza NumPy) con lo storico settimanale
+
+    Classmethods
+    -------------
+    from_aflers():  crea la tabella a partire dagli afler
+
+    Methods
+    -------------
+    rollover():     esegue la rotazione giornaliera e ritorna chi supera la soglia
+    write_back():   riporta sugli afler le righe modificate
+    """
+
+    def __init__(self, ids: List[int], aflers: List[Afler], last: Sequence[int],
+                 daily: Sequence[int], weekly: Sequence[int], use_numpy: bool) -> None:
+        self.ids = ids
+        self.aflers = aflers
+        self.use_numpy = use_numpy
+        self._changed: Any = None
+        self.last: Any
+        self.daily: Any
+        self.weekly: Any
+        if use_numpy:
+            assert np is not None
+            self.last = np.asarray(last, dtype=np.int64)
+            self.daily = np.asarray(daily, dtype=np.int64)
+            self.weekly = np.asarray(weekly, dtype=np.int64).reshape(-1, 7)
+        else:
+            self.last = array('q', last)
+            self.daily = array('q', daily)
+            self.weekly = array('q', weekly)
+
+    @classmethod
+    def from_aflers(cls, items: Sequence[Tuple[int, Afler]], use_numpy: bool = np is not None) -> OratorTable:
+        """Crea la tabella copiando i contatori oratore degli afler.
+
+        :param items: coppie (id, afler)
+        :param use_numpy: se usare NumPy, di default se è installato
+
+        :returns: la tabella
+        :rtype: OratorTable
+        """
+        ids: List[int] = []
+        aflers: List[Afler] = []
+        last: List[int] = []
+        daily: List[int] = []
+        weekly: List[int] = []
+        for id, afler in items:
+            ids.append(id)
+            aflers.append(afler)
+            timestamp = afler.orator_last_message_timestamp
+            last.append(0 if timestamp is None else timestamp.toordinal())
+            daily.append(afler.orator_daily_buffer)
+            weekly.extend(afler.orator_weekly_buffer)
+        return cls(ids, aflers, last, daily, weekly, use_numpy and np is not None)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rollover(self, today: date, threshold: int) -> List[int]:
+        """Esegue per tutte le righe, nell'ordine usato da handle_counters:
+        - clean_orator_buffer: consolida il buffer giornaliero nel giorno
+          dell'ultimo messaggio e azzera i giorni trascorsi senza messaggi
+        - count_consolidated_messages: confronta lo storico con la soglia
+        - forget_last_week: azzera il giorno della settimana corrente
+
+        :param today: il giorno corrente
+        :param threshold: la soglia per il ruolo oratore
+
+        :returns: gli id degli afler che raggiungono la soglia
+        :rtype: List[int]
+        """
+        if self.use_numpy:
+            return self._rollover_numpy(today.toordinal(), threshold)
+        return self._rollover_array(today.toordinal(), threshold)
+
+    def _rollover_numpy(self, today: int, threshold: int) -> List[int]:
+        assert np is not None
+        weekly = self.weekly
+        before_weekly = weekly.copy()
+        before_daily = self.daily.copy()
+        present = self.last != 0
+        gap = np.where(present, today - self.last, 0)
+        last_wd = (self.last - 1) % 7
+        # giorni tra l'ultimo messaggio (escluso) e oggi (incluso) da azzerare
+        # se l'ultimo messaggio non è di ieri, come in clean_orator_buffer
+        steps = (_weekday(today) - last_wd) % 7
+        offsets = (np.arange(7)[None, :] - last_wd[:, None]) % 7
+        stale = (gap >= 2)[:, None] & (offsets >= 1) & (offsets <= steps[:, None])
+        weekly[stale] = 0
+        # consolidamento del buffer giornaliero nel giorno dell'ultimo messaggio
+        rows = np.nonzero((gap >= 1) & (self.daily != 0))[0]
+        weekly[rows, last_wd[rows]] = self.daily[rows]
+        self.daily[rows] = 0
+        eligible = np.nonzero(weekly.sum(axis=1) >= threshold)[0]
+        weekly[:, _weekday(today)] = 0
+        self._changed = np.nonzero(
+            (weekly != before_weekly).any(axis=1) | (self.daily != before_daily))[0]
+        return [self.ids[i] for i in eligible.tolist()]
+
+    def _rollover_array(self, today: int, threshold: int) -> List[int]:
+        weekly = self.weekly
+        daily = self.daily
+        today_wd = _weekday(today)
+        eligible: List[int] = []
+        changed: List[int] = []
+        for i, last in enumerate(self.last):
+            base = 7 * i
+            modified = False
+            gap = today - last if last else 0
+            if gap >= 1:
+                last_wd = _weekday(last)
+                if gap >= 2:
+                    d = last_wd
+                    while d != today_wd:
+                        d = (d + 1) % 7
+                        if weekly[base + d]:
+                            weekly[base + d] = 0
+                            modified = True
+                if daily[i]:
+                    weekly[base + last_wd] = daily[i]
+                    daily[i] = 0
+                    modified = True
+            if sum(weekly[base:base + 7]) >= threshold:
+                eligible.append(self.ids[i])
+            if weekly[base + today_wd]:
+                weekly[base + today_wd] = 0
+                modified = True
+            if modified:
+                changed.append(i)
+        self._changed = changed
+        return eligible
+
+    def write_back(self) -> int:
+        """Riporta sugli afler le righe modificate dall'ultima rollover().
+
+        :returns: il numero di afler aggiornati
+        :rtype: int
+        """
+        if self._changed is None:
+            return 0
+        changed = self._changed.tolist() if self.use_numpy else self._changed
+        for i in changed:
+            afler = self.aflers[i]
+            if self.use_numpy:
+                afler.orator_weekly_buffer = self.weekly[i].tolist()
+            else:
+                afler.orator_weekly_buffer = self.weekly[7 * i:7 * i + 7].tolist()
+            afler.orator_daily_buffer = int(self.daily[i])
+        self._changed = None
+        return len(changed)
+
+
+def _benchmark(size: int = 100_000) -> None:
+    """Confronta la rotazione per afler con le due modalità della tabella."""
+    import copy
+    import random
+    from datetime import timedelta
+    from time import perf_counter
+
+    from utils.afler import Afler
+
+    random.seed(0)
+    today = date.today()
+    threshold = 100
+    items: List[Tuple[int, Afler]] = []
+    for id in range(size):
+        afler = Afler.new_entry(f'afler{id}')
+        if random.random() < 0.9:
+            afler.orator_last_message_timestamp = today - timedelta(days=random.choice((0, 1, 1, 1, 2, 3, 7, 8, 30)))
+            afler.orator_daily_buffer = random.randint(0, 60)
+            afler.orator_weekly_buffer = [random.randint(0, 40) for _ in range(7)]
+        items.append((id, afler))
+
+    reference = copy.deepcopy(items)
+    start = perf_counter()
+    expected: List[int] = []
+    for id, afler in reference:
+        afler.clean_orator_buffer()
+        if afler.count_consolidated_messages() >= threshold:
+            expected.append(id)
+        afler.forget_last_week()
+    print(f'metodi di Afler:   {perf_counter() - start:.3f}s')
+
+    modes = [False, True] if np is not None else [False]
+    for use_numpy in modes:
+        run = copy.deepcopy(items)
+        start = perf_counter()
+        table = OratorTable.from_aflers(run, use_numpy)
+        built = perf_counter()
+        eligible = table.rollover(today, threshold)
+        rolled = perf_counter()
+        updated = table.write_back()
+        done = perf_counter()
+        name = 'numpy' if use_numpy else 'array'
+        print(f'tabella ({name}):  {done - start:.3f}s (costruzione {built - start:.3f}s, '
+              f'rotazione {rolled - built:.3f}s, scrittura {done - rolled:.3f}s, '
+              f'{updated} afler aggiornati)')
+        assert eligible == expected
+        for (_, a), (_, b) in zip(run, reference):
+            assert a.orator_weekly_buffer == b.orator_weekly_buffer
+            assert a.orator_daily_buffer == b.orator_daily_buffer
+    if np is None:
+        print('NumPy non installato, modalità vettoriale non misurata')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -14,4 +14,12 @@ DATA_DIR =              BASE_DIR / "data"
 AFLERS_FILE =           DATA_DIR / "aflers.json"
 BANNED_WORDS_FILE =     DATA_DIR / "banned_words.json"
 PROPOSALS_FILE =        DATA_DIR / "proposals.json"
+POLL_CHECKPOINT_FILE =  DATA_DIR / "poll_checkpoint.json"
 SUBREDDITS_FILE =       DATA_DIR / "subreddits.json"
+EVIDENCE_DIR =          DATA_DIR / "evidence"
+EVIDENCE_INDEX_FILE =   EVIDENCE_DIR / "index.json"
+MESSAGE_LEDGER_FILE =   DATA_DIR / "message_ledger.bin"
+UNDELIVERABLE_DM_FILE = DATA_DIR / "undeliverable_dm.json"
+MEMBER_SNAPSHOT_FILE =  DATA_DIR / "member_snapshot.json"
+COMMAND_TREE_FILE =     DATA_DIR / "command_tree.json"
+AUDIT_DB_FILE =         DATA_DIR / "audit.db"
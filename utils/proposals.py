@@ -1,16 +1,22 @@
 """Modulo di gestione delle proposte"""
 
 from __future__ import annotations
+import asyncio
 from datetime import datetime, timedelta
 import json
-from typing import ClassVar, Dict, Optional, TypedDict
+import logging
+from typing import ClassVar, Dict, List, Optional, TypedDict
 
 import discord
 from discord.utils import MISSING
 from utils import shared_functions as sf
+from utils.clock import Clock
 from utils.config import Config
 from utils.bot_logger import BotLogger
-from utils.paths import PROPOSALS_FILE
+from utils.paths import POLL_CHECKPOINT_FILE, PROPOSALS_FILE
+from utils.voters import EligibleVoters
+
+_log = logging.getLogger(__name__)
 
 
 class Proposal():
@@ -30,10 +36,16 @@ class Proposal():
     no: `int`           numero di voti contrari
     content: `str`      contenuto della proposta
     author: `int`       l'autore della proposta
+    votes: `Optional[Dict[int, str]]`   registro dei voti, id votante -> emoji;
+    None per le proposte salvate prima dell'introduzione del registro
 
     Methods
     -------------
     adjust_vote_count():    aggiorna i voti di una proposta
+    cast_vote():            registra il voto di un membro
+    retract_vote():         rimuove il voto di un membro
+    recount():              ricalcola i contatori a partire dal registro
+    deadline():             ritorna la scadenza della votazione
     """
 
     def __init__(
@@ -46,7 +58,8 @@ class Proposal():
             passed: bool = False,
             rejected: bool = False,
             yes: int = 0,
-            no: int = 0) -> None:
+            no: int = 0,
+            votes: Optional[Dict[int, str]] = None) -> None:
         self.timestamp = timestamp
         self.total_voters = total_voters
         self.threshold = threshold
@@ -56,6 +69,7 @@ class Proposal():
         self.no = no
         self.content = content
         self.author = author
+        self.votes = votes
 
     def adjust_vote_count(self, vote: str, change: int) -> None:
         """Aggiusta il contatore dei voti in base al parametro passato.
@@ -73,6 +87,63 @@ class Proposal():
             self.no = max(0, self.no + change)
             self.rejected = self.no >= self.threshold
 
+    def cast_vote(self, voter: int, vote: str) -> None:
+        """Registra il voto del membro. Se aveva già votato in modo opposto
+        il voto viene spostato, senza attendere la rimozione della reaction.
+        Senza registro si limita ad aggiornare il contatore.
+
+        :param voter: l'id del votante
+        :param vote: l'emoji del voto
+        """
+        if self.votes is None:
+            self.adjust_vote_count(vote, 1)
+            return
+        previous = self.votes.get(voter)
+        if previous == vote:
+            return
+        if previous is not None:
+            self.adjust_vote_count(previous, -1)
+        self.votes[voter] = vote
+        self.adjust_vote_count(vote, 1)
+
+    def retract_vote(self, voter: int, vote: str) -> None:
+        """Rimuove il voto del membro, se corrisponde a quello registrato.
+        Senza registro si limita ad aggiornare il contatore.
+
+        :param voter: l'id del votante
+        :param vote: l'emoji del voto rimosso
+        """
+        if self.votes is None:
+            self.adjust_vote_count(vote, -1)
+            return
+        if self.votes.get(voter) != vote:
+            # voto già spostato da cast_vote
+            return
+        del self.votes[voter]
+        self.adjust_vote_count(vote, -1)
+
+    def recount(self) -> None:
+        """Ricalcola i contatori dei voti a partire dal registro."""
+        assert self.votes is not None
+        self.yes = self.no = 0
+        for vote in self.votes.values():
+            self.adjust_vote_count(vote, 1)
+        # adjust_vote_count aggiorna solo lo stato del voto modificato
+        self.passed = self.yes >= self.threshold
+        self.rejected = self.no >= self.threshold
+
+    def deadline(self) -> datetime:
+        """Ritorna la scadenza della votazione, ovvero la mezzanotte del
+        giorno della proposta più la durata prevista dalla configurazione.
+
+        :returns: la data di scadenza
+        :rtype: datetime
+        """
+        return sf.next_datetime(
+            datetime.fromisoformat(self.timestamp).replace(hour=0, minute=0),
+            Config.get_config().poll_duration
+        )
+
 
 class ProposalType(TypedDict):
     """Utility per parsare l'archivio delle proposte durante la load()"""
@@ -85,6 +156,7 @@ class ProposalType(TypedDict):
     rejected: bool
     yes: int
     no: int
+    votes: Optional[Dict[str, str]]
 
 
 class Report(TypedDict):
@@ -103,8 +175,12 @@ class Proposals():
     -------------
     _instance: `Proposals`      attributo di classe, contiene l'istanza
     del wrapper
+    save_delay: `float`         secondi di attesa prima di salvare su file
+    le variazioni dei voti, per raggrupparle in un'unica scrittura
     last_timestamp: `Date`      data dell'ultima proposta, usata per il
     controllo di integrità
+    checkpoint: `Optional[int]` id dell'ultimo messaggio del canale proposte
+    esaminato dal controllo di integrità
 
     Classmethods
     -------------
@@ -113,18 +189,37 @@ class Proposals():
 
     Methods
     -------------
+    start():                        programma la chiusura delle proposte aperte
     get_proposal():                 ritorna la proposta richiesta
+    get_message():                  ritorna il messaggio della proposta, dalla cache se possibile
+    may_have_voted():               controlla se un membro potrebbe aver già espresso un certo voto
     add_proposal():                 aggiunge una nuova proposta all'archivio
     remove_proposal():              rimuove la proposta dall'archivio
     adjust_vote_count():            aggiorna i voti di una proposta
     handle_proposals():             controlla lo stato delle proposte
+    close_proposal():               pubblica l'esito della proposta e la rimuove
     check_proposals_integrity():    controlla se le proposte sono coerenti col canale
+    flush():                        salva subito le modifiche in attesa di scrittura
     """
     _instance: ClassVar[Proposals] = MISSING
+    save_delay: ClassVar[float] = 5.0
 
     def __init__(self) -> None:
         self.proposals: Dict[int, Proposal]
         self.timestamp: datetime
+        self.checkpoint: Optional[int]
+        # cache dei messaggi delle proposte aperte
+        self._messages: Dict[int, discord.Message]
+        # richieste in corso, per non richiedere lo stesso messaggio due volte
+        self._pending_fetches: Dict[int, asyncio.Future[discord.Message]]
+        self._save_handle: Optional[asyncio.TimerHandle]
+        # timer di scadenza delle proposte aperte
+        self._timers: Dict[int, asyncio.TimerHandle]
+        # proposte da chiudere, consumate da _closure_worker
+        self._closures: asyncio.Queue[int]
+        self._queued: set[int]
+        self._closing: set[int]
+        self._worker: Optional[asyncio.Task[None]]
         raise RuntimeError(
             'Usa Proposals.get_instance() per ottenere l\'istanza')
 
@@ -159,16 +254,84 @@ class Proposals():
             yes=p['yes'],
             no=p['no'],
             content=p['content'],
-            author=int(p['author'])
+            author=int(p['author']),
+            votes=_load_votes(p.get('votes'))
         ) for i, p in raw_proposals.items()}
         cls._instance = cls.__new__(cls)
         cls._instance.proposals = proposals
+        cls._instance._messages = {}
+        cls._instance._pending_fetches = {}
+        cls._instance._save_handle = None
+        cls._instance._timers = {}
+        cls._instance._closures = asyncio.Queue()
+        cls._instance._queued = set()
+        cls._instance._closing = set()
+        cls._instance._worker = None
+        try:
+            with open(POLL_CHECKPOINT_FILE, 'r') as file:
+                cls._instance.checkpoint = int(json.load(file)['last_message_id'])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+            cls._instance.checkpoint = None
         try:
             cls._instance.timestamp = datetime.fromisoformat(
                 min(proposals.values(), key=lambda x: x.timestamp).timestamp)
         except ValueError:
             # Stima pessimistica di un periodo di down del bot, cambiare se necessario
-            cls._instance.timestamp = datetime.now().astimezone() - timedelta(weeks=1)
+            cls._instance.timestamp = Clock.get_instance().now().astimezone() - timedelta(weeks=1)
+
+    def start(self) -> None:
+        """Programma un timer alla scadenza di ogni proposta aperta e avvia
+        la task che si occupa delle chiusure. Le proposte già scadute o che
+        hanno già raggiunto la soglia vengono chiuse subito. Va chiamato
+        quando il bot è pronto, può essere richiamato a ogni on_ready.
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for key in self.proposals.keys():
+            self._schedule_closure(key)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._closure_worker())
+
+    def _schedule_closure(self, key: int) -> None:
+        """Programma il timer di scadenza della proposta."""
+        proposal = self.proposals[key]
+        if proposal.passed or proposal.rejected:
+            self._request_closure(key)
+            return
+        delay = (proposal.deadline() - Clock.get_instance().now().astimezone()).total_seconds()
+        self._timers[key] = asyncio.get_running_loop().call_later(
+            max(0, delay), self._on_deadline, key)
+
+    def _on_deadline(self, key: int) -> None:
+        """Callback del timer di scadenza della proposta."""
+        self._timers.pop(key, None)
+        self._request_closure(key)
+
+    def _request_closure(self, key: int) -> None:
+        """Mette in coda la proposta per la chiusura, se non lo è già."""
+        if key not in self._queued:
+            self._queued.add(key)
+            self._closures.put_nowait(key)
+
+    async def _closure_worker(self) -> None:
+        """Chiude una alla volta le proposte messe in coda dai timer di
+        scadenza e dal raggiungimento della soglia.
+        """
+        while True:
+            key = await self._closures.get()
+            self._queued.discard(key)
+            try:
+                await self.close_proposal(key)
+            except Exception:
+                # non deve fermare la chiusura delle altre proposte
+                _log.exception('errore nella chiusura della proposta %s', key)
+            proposal = self.get_proposal(key)
+            if (proposal is not None and key not in self._timers
+                    and self._outcome(proposal) is None):
+                # timer scattato in anticipo rispetto all'orologio di sistema;
+                # se invece la chiusura è fallita ci riprova handle_proposals
+                self._schedule_closure(key)
 
     def get_proposal(self, message_id: int) -> Optional[Proposal]:
         """Cerca una proposta dato l'id del messaggio ad essa correlato.
@@ -184,6 +347,49 @@ class Proposals():
         else:
             return proposal
 
+    async def get_message(self, message_id: int) -> discord.Message:
+        """Restituisce il messaggio della proposta. Se non è in cache viene
+        richiesto a discord; richieste contemporanee per lo stesso messaggio
+        condividono un'unica chiamata.
+
+        :param message_id: l'id del messaggio
+        :returns: il messaggio della proposta
+        :rtype: discord.Message
+
+        :raises: discord.NotFound se il messaggio non esiste più
+        """
+        message = self._messages.get(message_id)
+        if message is not None:
+            return message
+        fetch = self._pending_fetches.get(message_id)
+        if fetch is None:
+            fetch = asyncio.ensure_future(
+                Config.get_config().poll_channel.fetch_message(message_id))
+            self._pending_fetches[message_id] = fetch
+            fetch.add_done_callback(
+                lambda _: self._pending_fetches.pop(message_id, None))
+        message = await asyncio.shield(fetch)
+        if message_id in self.proposals:
+            self._messages[message_id] = message
+        return message
+
+    def may_have_voted(self, message_id: int, member_id: int, vote: str) -> bool:
+        """Controlla se il membro potrebbe aver già espresso il voto indicato
+        sulla proposta. Se la proposta non ha ancora un registro dei voti
+        la risposta è sempre affermativa.
+
+        :param message_id: l'id del messaggio della proposta
+        :param member_id: l'id del membro
+        :param vote: l'emoji del voto
+
+        :returns: False solo se è certo che il membro non ha quel voto
+        :rtype: bool
+        """
+        proposal = self.get_proposal(message_id)
+        if proposal is None or proposal.votes is None:
+            return True
+        return proposal.votes.get(member_id) == vote
+
     async def add_proposal(self, message: discord.Message) -> discord.Message:
         """Aggiunge la proposta al file proposals.json e crea un embed con
         la proposta.
@@ -193,17 +399,14 @@ class Proposals():
         :returns: il messaggio con l'embed
         :rtype: discord.Message
         """
-        orator_count = 0
-        for member in Config.get_config().guild.members:
-            if (Config.get_config().orator_role in member.roles or
-                    any(role in Config.get_config().moderation_roles for role in member.roles)):
-                orator_count += 1
+        orator_count = len(EligibleVoters.get_instance())
         proposal = Proposal(
             timestamp=message.created_at.astimezone().isoformat(),
             total_voters=orator_count,
             threshold=(orator_count // 2 + 1),  # maggioranza assoluta
             content=message.content,
-            author=message.author.id
+            author=message.author.id,
+            votes={}
         )
         embed = discord.Embed(
             colour=discord.Colour.orange(),
@@ -221,11 +424,7 @@ class Proposals():
             inline=False
         ).add_field(
             name='Scadenza:',
-            value=discord.utils.format_dt(
-                sf.next_datetime(message.created_at.astimezone().replace(
-                    hour=0, minute=0), Config.get_config().poll_duration),
-                'D'
-            ),
+            value=discord.utils.format_dt(proposal.deadline(), 'D'),
             inline=False
         )
         log = await BotLogger.get_instance().log(f'nuova proposta di {message.author.mention}:\n\n{message.content}', media=message.attachments)
@@ -256,6 +455,9 @@ class Proposals():
             )
         proposal_embed = await Config.get_config().poll_channel.send(embeds=embeds)
         self.proposals[proposal_embed.id] = proposal
+        self._messages[proposal_embed.id] = proposal_embed
+        if self._worker is not None:
+            self._schedule_closure(proposal_embed.id)
         await message.delete()
         if message.created_at.astimezone() > self.timestamp:
             self.timestamp = message.created_at.astimezone()
@@ -264,17 +466,19 @@ class Proposals():
         await proposal_embed.add_reaction('🔴')
         return proposal_embed
 
-    async def remove_proposal(self, message_id: int) -> None:
+    async def remove_proposal(self, message_id: int, message: Optional[discord.Message] = None) -> None:
         """Rimuove dal canale e dal file la proposta.
 
         :param message_id: id del messaggio della proposta
+        :param message: il messaggio della proposta, se già disponibile
         """
         # La funzione viene chiamata dalla task periodica, dall'eliminazione
         # manuale di una proposta e da sé stessa quando elimina una proposta
         # (dovuto al ciclo remove_proposal->on_message_delete->remove_proposal).
         # In quest'ultimo caso non serve fare nulla.
         try:
-            message = await Config.get_config().poll_channel.fetch_message(message_id)
+            if message is None:
+                message = await self.get_message(message_id)
             await message.delete()
         except discord.NotFound:
             # La proposta è stata già rimossa dal canale.
@@ -287,6 +491,10 @@ class Proposals():
         else:
             await BotLogger.get_instance().log(f'proposta rimossa dal file:\n\n{content.content}')
             del self.proposals[message_id]
+            self._messages.pop(message_id, None)
+            timer = self._timers.pop(message_id, None)
+            if timer is not None:
+                timer.cancel()
             self._save()
 
     def adjust_vote_count(self, payload: discord.RawReactionActionEvent, change: int):
@@ -301,40 +509,73 @@ class Proposals():
         if proposal is None:
             print('impossibile trovare la proposta')
             return
-        proposal.adjust_vote_count(payload.emoji.name, change)
-        self._save()
+        if change > 0:
+            proposal.cast_vote(payload.user_id, payload.emoji.name)
+        else:
+            proposal.retract_vote(payload.user_id, payload.emoji.name)
+        if proposal.passed or proposal.rejected:
+            # raggiunta la soglia, la proposta si chiude subito
+            self._request_closure(payload.message_id)
+        # durante le raffiche di voti le scritture su file vengono raggruppate
+        self._schedule_save()
 
     async def handle_proposals(self) -> None:
         """Gestisce le proposte, verificando se il dizionario è coerente
         con il canale e se le proposte hanno raggiunto un termine.
+        Le proposte sono di norma chiuse in tempo reale (vedi start), qui
+        si recuperano quelle eventualmente sfuggite ai timer.
         """
-        await self.check_proposals_integrity()
-        to_delete = set()
-        for key in self.proposals.keys():
-            message = await Config.get_config().poll_channel.fetch_message(key)
-            proposal = self.proposals[key]
-            if proposal.passed:
-                report: Report = {
-                    'result': 'passata',
-                    'description': 'La soglia per la proposta è stata raggiunta.',
-                    'colour': discord.Color.green()
-                }
-            elif proposal.rejected:
-                report: Report = {
-                    'result': 'bocciata',
-                    'description': 'La proposta è stata bocciata dalla maggioranza.',
-                    'colour': discord.Color.red()
-                }
-            elif datetime.now().astimezone() >= sf.next_datetime(
-                    datetime.fromisoformat(proposal.timestamp).replace(hour=0, minute=0), Config.get_config().poll_duration):
-                report: Report = {
-                    'result': 'scaduta',
-                    'description': 'La proposta non ha ricevuto abbastanza voti.',
-                    'colour': discord.Color.gold()
-                }
-            else:
-                # La proposta semplicemente è ancora in corso
-                continue
+        messages = await self.check_proposals_integrity()
+        for key in list(self.proposals.keys()):
+            # le proposte arrivate durante il controllo non sono in messages,
+            # close_proposal recupera da sé il messaggio se serve
+            await self.close_proposal(key, messages.get(key))
+        self._save()
+
+    def _outcome(self, proposal: Proposal) -> Optional[Report]:
+        """Stabilisce l'esito della proposta, None se è ancora in corso."""
+        if proposal.passed:
+            return {
+                'result': 'passata',
+                'description': 'La soglia per la proposta è stata raggiunta.',
+                'colour': discord.Color.green()
+            }
+        elif proposal.rejected:
+            return {
+                'result': 'bocciata',
+                'description': 'La proposta è stata bocciata dalla maggioranza.',
+                'colour': discord.Color.red()
+            }
+        elif Clock.get_instance().now().astimezone() >= proposal.deadline():
+            return {
+                'result': 'scaduta',
+                'description': 'La proposta non ha ricevuto abbastanza voti.',
+                'colour': discord.Color.gold()
+            }
+        # La proposta semplicemente è ancora in corso
+        return None
+
+    async def close_proposal(self, key: int, message: Optional[discord.Message] = None) -> None:
+        """Se la proposta ha raggiunto un termine ne pubblica l'esito nel
+        canale proposte e la rimuove, altrimenti non fa nulla.
+
+        :param key: l'id del messaggio della proposta
+        :param message: il messaggio della proposta, se già disponibile
+        """
+        proposal = self.get_proposal(key)
+        if proposal is None or key in self._closing:
+            return
+        report = self._outcome(proposal)
+        if report is None:
+            return
+        self._closing.add(key)
+        try:
+            if message is None:
+                try:
+                    message = await self.get_message(key)
+                except discord.NotFound:
+                    await self.remove_proposal(key)
+                    return
             author = Config.get_config().guild.get_member(proposal.author)
             assert author is not None
             embed = discord.Embed(
@@ -367,17 +608,46 @@ class Proposals():
             files = [await f.to_file() for f in message.attachments]
             await Config.get_config().poll_channel.send(embeds=embeds, files=files)
             await BotLogger.get_instance().log(f'proposta di <@{proposal.author}> {report["result"]}:\n\n{proposal.content}')
-            to_delete.add(message.id)
-        for key in to_delete:
-            await self.remove_proposal(key)
-        self._save()
+            await self.remove_proposal(key, message)
+        finally:
+            self._closing.discard(key)
 
-    async def check_proposals_integrity(self) -> None:
+    async def check_proposals_integrity(self, full: bool = False) -> Dict[int, discord.Message]:
         """Controlla la corrispondenza tra le proposte nel dizionario e
         le proposte nel canale.
+        Tutti i messaggi delle proposte sono letti con un unico passaggio
+        sulla cronologia del canale e restituiti, così che il chiamante
+        possa riutilizzarli senza doverli richiedere uno per uno.
+
+        Di norma la lettura riparte dall'ultimo messaggio visto nel controllo
+        precedente (vedi checkpoint), estendendosi all'indietro solo per le
+        proposte aperte non presenti in cache (es. dopo un riavvio). Con
+        full=True viene invece riletto il canale a partire dalla proposta
+        aperta più vecchia.
+
+        :param full: se effettuare la scansione completa del canale
+
+        :returns: i messaggi delle proposte aperte, indicizzati per id
+        :rtype: Dict[int, discord.Message]
         """
+        if full or self.checkpoint is None:
+            uncached = list(self.proposals.keys())
+        else:
+            uncached = [i for i in self.proposals.keys() if i not in self._messages]
+        start_id: Optional[int] = None
+        if uncached:
+            # l'id è un timestamp, -1 per includere la proposta stessa
+            start_id = min(uncached) - 1
+            if self.checkpoint is not None and not full:
+                start_id = min(start_id, self.checkpoint)
+        elif self.checkpoint is not None and not full:
+            start_id = self.checkpoint
+        after = (discord.Object(start_id) if start_id is not None
+                 else datetime.combine(self.timestamp, datetime.min.time()))
         existing_proposals: set[discord.Message] = set()
-        async for message in Config.get_config().poll_channel.history(after=datetime.combine(self.timestamp, datetime.min.time())):
+        last_seen = self.checkpoint or 0
+        async for message in Config.get_config().poll_channel.history(limit=None, after=after):
+            last_seen = max(last_seen, message.id)
             # Se il messaggio è di un utente, crea una nuova proposta
             if not message.author.bot:
                 existing_proposals.add(await self.add_proposal(message))
@@ -388,33 +658,114 @@ class Proposals():
             elif len(message.embeds) and message.embeds[0].color == discord.Color.orange():
                 existing_proposals.add(message)
         for message in existing_proposals:
-            proposal = self.proposals[message.id]
-            to_remove: Dict[discord.Reaction, set[discord.Member]] = {}
-            for wrong_react in message.reactions:
-                to_remove[wrong_react] = set()
-                async for member in wrong_react.users():
-                    if member.bot:
-                        continue
-                    assert isinstance(member, discord.Member)
-                    if not (wrong_react.emoji in ('🔴', '🟢') and
-                            (Config.get_config().orator_role in member.roles or
-                            any(role in Config.get_config().moderation_roles for role in member.roles))):
-                        to_remove[wrong_react].add(member)
-            for react, members in to_remove.items():
-                for member in members:
-                    await message.remove_reaction(react, member)
-            votes = {'🟢': proposal.yes, '🔴': proposal.no}
-            for react in message.reactions:
-                # Necessario per questioni di caching delle reaction al messaggio da parte di discord
-                if react.emoji in ('🔴', '🟢'):
-                    proposal.adjust_vote_count(
-                        react.emoji, react.count - votes[react.emoji] - 1)
-        existing_proposals_id = map(lambda x: x.id, existing_proposals)
-        for invalid_proposal in set(self.proposals.keys()).difference(existing_proposals_id):
-            await self.remove_proposal(invalid_proposal)
+            await self._reconcile_votes(message)
+        messages = {message.id: message for message in existing_proposals}
+        # i messaggi appena letti sono i più aggiornati
+        self._messages.update(messages)
+        for key in set(self.proposals.keys()).difference(messages.keys()):
+            if start_id is None or key > start_id:
+                # rientrava nella scansione ma non esiste più
+                await self.remove_proposal(key)
+            else:
+                # precedente alla scansione: il messaggio è in cache
+                messages[key] = self._messages[key]
         self._save()
+        if last_seen != self.checkpoint:
+            self.checkpoint = last_seen
+            self._save_checkpoint()
+        return messages
+
+    async def _reconcile_votes(self, message: discord.Message) -> None:
+        """Allinea il registro dei voti della proposta con le reaction del
+        messaggio. Gli utenti di una reaction vengono scorsi solo se il
+        conteggio riportato da discord differisce da quello del registro
+        (o se la proposta non ha ancora un registro, per costruirlo): per
+        le reaction invariate dall'ultimo controllo non serve alcuna chiamata.
+        A ogni controllo i votanti del registro sono comunque confrontati con
+        EligibleVoters: i voti di chi ha lasciato il server o perso i
+        requisiti vengono scartati e le loro reaction rimosse.
+
+        :param message: il messaggio della proposta, appena letto dal canale
+        """
+        proposal = self.proposals[message.id]
+        voters = EligibleVoters.get_instance()
+        if proposal.votes is None:
+            proposal.votes = {}
+            rebuild = True
+        else:
+            rebuild = False
+        users: Dict[discord.Reaction, List[discord.Member]] = {}
+        for react in message.reactions:
+            if react.emoji in ('🔴', '🟢') and not rebuild:
+                recorded = sum(1 for v in proposal.votes.values() if v == react.emoji)
+                if react.count - int(react.me) == recorded:
+                    continue
+            users[react] = []
+            async for member in react.users():
+                if member.bot:
+                    continue
+                assert isinstance(member, discord.Member)
+                users[react].append(member)
+        # scarta i voti registrati la cui reaction non esiste più
+        checked = {react.emoji for react in users}
+        present = {(member.id, react.emoji)
+                   for react, members in users.items() for member in members}
+        for voter, vote in list(proposal.votes.items()):
+            if vote in checked and (voter, vote) not in present:
+                del proposal.votes[voter]
+            elif not voters.is_eligible(voter):
+                del proposal.votes[voter]
+                if vote not in checked:
+                    # reaction non scorsa, la rimozione richiede solo l'id
+                    try:
+                        await message.remove_reaction(vote, discord.Object(voter))
+                    except discord.NotFound:
+                        pass
+        for react, members in users.items():
+            for member in members:
+                if (react.emoji in ('🔴', '🟢') and voters.is_eligible(member.id)
+                        # se ha entrambi i voti vale quello già registrato
+                        and proposal.votes.get(member.id, react.emoji) == react.emoji):
+                    proposal.votes[member.id] = react.emoji
+                else:
+                    await message.remove_reaction(react, member)
+        proposal.recount()
+
+    def flush(self) -> None:
+        """Salva su disco le modifiche ai voti non ancora scritte, se presenti.
+        Da chiamare prima dello spegnimento del bot.
+        """
+        if self._save_handle is not None:
+            self._save()
+
+    def _schedule_save(self) -> None:
+        """Programma un salvataggio dopo save_delay secondi, se non ce n'è
+        già uno in attesa.
+        """
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(
+                self.save_delay, self._save)
+
+    def _save_checkpoint(self) -> None:
+        """Salva su disco l'id dell'ultimo messaggio esaminato."""
+        sf.update_json_file({'last_message_id': self.checkpoint}, POLL_CHECKPOINT_FILE)
 
     def _save(self) -> None:
         """Salva su disco le modifiche effettuate alle proposte."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
         dict = {i: vars(p) for i, p in self.proposals.items()}
         sf.update_json_file(dict, PROPOSALS_FILE)
+
+
+def _load_votes(raw_votes: Optional[Dict[str, str]]) -> Optional[Dict[int, str]]:
+    """Converte il registro dei voti letto da file (id come stringhe).
+
+    :param raw_votes: il registro letto da file, se presente
+    :returns: il registro con gli id come interi, None se assente
+    :rtype: Optional[Dict[int, str]]
+    """
+    if raw_votes is None:
+        return None
+    return {int(voter): vote for voter, vote in raw_votes.items()}
@@ -0,0 +1,214 @@
+"""Raggruppamento delle modifiche ai ruoli dei membri"""
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Awaitable, Callable, ClassVar, Dict, FrozenSet, Iterable, List, Set, Tuple
+
+import discord
+from discord.utils import MISSING
+
+from utils.voters import EligibleVoters
+
+_log = logging.getLogger(__name__)
+
+Callback = Callable[[], Awaitable[None]]
+
+
+class PendingRoles():
+    """Modifiche in attesa sui ruoli di un membro.
+
+    Attributes
+    -------------
+    member: `discord.Member`    il membro da modificare
+    add: `Set[discord.Role]`    ruoli da aggiungere
+    remove: `Set[discord.Role]` ruoli da rimuovere
+    callbacks: `List[Callback]` azioni da eseguire dopo la modifica (log, annunci)
+    failures: `int`             commit in cui la modifica è fallita
+    """
+
+    def __init__(self, member: discord.Member) -> None:
+        self.member = member
+        self.add: Set[discord.Role] = set()
+        self.remove: Set[discord.Role] = set()
+        self.callbacks: List[Callback] = []
+        self.failures = 0
+
+
+class RoleScheduler():
+    """Raccoglie le modifiche ai ruoli di ogni membro e le applica con una
+    sola chiamata member.edit(roles=...), invece di una add_roles o
+    remove_roles per ruolo. Se un ruolo viene prima aggiunto e poi rimosso
+    (o viceversa) vale l'ultima modifica, e se il risultato coincide con i
+    ruoli attuali non viene fatta alcuna chiamata.
+    I log e gli annunci legati alla modifica sono registrati come callback
+    ed eseguiti solo dopo che la modifica è andata a buon fine.
+
+    Le commit sono eseguite una alla volta e l'elenco dei ruoli inviato a
+    discord è calcolato dal membro in cache al momento della modifica, così
+    che due commit sullo stesso membro non annullino l'una le modifiche
+    dell'altra. Dato che la cache viene aggiornata solo all'arrivo
+    dell'evento di discord, i ruoli appena impostati sono usati al posto di
+    quelli in cache finché questa non cambia.
+    Chi registra una modifica aggiorna subito l'archivio, per cui le
+    modifiche fallite restano in attesa e vengono ritentate alle commit
+    successive, fino a max_failures volte.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `RoleScheduler`      attributo di classe, contiene l'istanza
+    concurrency: `int`              attributo di classe, modifiche contemporanee
+    max_retries: `int`              attributo di classe, tentativi in caso di rate limit
+    max_failures: `int`             attributo di classe, commit fallite prima di
+    scartare una modifica
+    pending: `Dict[int, PendingRoles]`  modifiche in attesa per id del membro
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    stage():    registra una modifica ai ruoli di un membro
+    commit():   coroutine, applica tutte le modifiche in attesa
+    """
+    _instance: ClassVar[RoleScheduler] = MISSING
+    concurrency: ClassVar[int] = 4
+    max_retries: ClassVar[int] = 3
+    max_failures: ClassVar[int] = 5
+
+    def __init__(self) -> None:
+        self.pending: Dict[int, PendingRoles]
+        self._lock: asyncio.Lock
+        self._applied: Dict[int, Tuple[FrozenSet[discord.Role], FrozenSet[discord.Role]]]
+        raise RuntimeError(
+            'Usa RoleScheduler.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> RoleScheduler:
+        """Ritorna l'unica istanza dello scheduler dei ruoli."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.pending = {}
+            cls._instance._lock = asyncio.Lock()
+            cls._instance._applied = {}
+        return cls._instance
+
+    def stage(
+            self,
+            member: discord.Member,
+            add: Iterable[discord.Role] = (),
+            remove: Iterable[discord.Role] = (),
+            on_commit: Callback = MISSING) -> None:
+        """Registra una modifica ai ruoli del membro, applicata alla
+        prossima commit().
+
+        :param member: il membro da modificare
+        :param add: i ruoli da aggiungere
+        :param remove: i ruoli da rimuovere
+        :param on_commit: coroutine da eseguire dopo aver applicato la modifica
+        """
+        pending = self.pending.get(member.id)
+        if pending is None:
+            pending = self.pending[member.id] = PendingRoles(member)
+        for role in add:
+            pending.remove.discard(role)
+            pending.add.add(role)
+        for role in remove:
+            pending.add.discard(role)
+            pending.remove.add(role)
+        if on_commit is not MISSING:
+            pending.callbacks.append(on_commit)
+
+    def _requeue(self, entry: PendingRoles) -> None:
+        """Rimette in attesa una modifica fallita. Le modifiche registrate
+        nel frattempo sullo stesso membro hanno la precedenza.
+        """
+        newer = self.pending.get(entry.member.id)
+        if newer is not None:
+            entry.add.difference_update(newer.remove)
+            entry.remove.difference_update(newer.add)
+            entry.add.update(newer.add)
+            entry.remove.update(newer.remove)
+            entry.callbacks.extend(newer.callbacks)
+        self.pending[entry.member.id] = entry
+
+    async def commit(self) -> None:
+        """Applica le modifiche in attesa, al più concurrency alla volta,
+        ed esegue le callback dei membri modificati con successo.
+        Le modifiche fallite restano in attesa per la commit successiva,
+        tranne quelle di membri non più nel server o fallite max_failures
+        volte, che vengono scartate segnalando l'errore.
+        """
+        async with self._lock:
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+            semaphore = asyncio.Semaphore(self.concurrency)
+            applied: List[PendingRoles] = []
+
+            async def apply(entry: PendingRoles) -> None:
+                async with semaphore:
+                    try:
+                        if await self._edit(entry):
+                            applied.append(entry)
+                    except discord.HTTPException:
+                        entry.failures += 1
+                        if entry.failures < self.max_failures:
+                            _log.warning('modifica dei ruoli di %s fallita, verrà ritentata',
+                                         entry.member, exc_info=True)
+                            self._requeue(entry)
+                        else:
+                            _log.exception('modifica dei ruoli di %s scartata dopo %d tentativi',
+                                           entry.member, entry.failures)
+
+            await asyncio.gather(*(apply(entry) for entry in pending.values()))
+        # le callback (log, annunci) non devono rallentare le altre commit
+        for entry in applied:
+            for callback in entry.callbacks:
+                try:
+                    await callback()
+                except Exception:
+                    # non deve bloccare le callback degli altri membri
+                    _log.exception('errore dopo la modifica dei ruoli di %s', entry.member)
+
+    async def _edit(self, entry: PendingRoles) -> bool:
+        """Applica la modifica a partire dai ruoli attuali del membro.
+
+        :returns: False se il membro non è più nel server
+        :rtype: bool
+        """
+        member = entry.member.guild.get_member(entry.member.id)
+        if member is None:
+            self._applied.pop(entry.member.id, None)
+            _log.warning('modifica dei ruoli di %s scartata: non è più nel server', entry.member)
+            return False
+        entry.member = member
+        cached = frozenset(member.roles)
+        current: Set[discord.Role] = set(cached)
+        applied = self._applied.pop(member.id, None)
+        if applied is not None and applied[0] == cached:
+            # cache non ancora aggiornata dopo la modifica precedente
+            current = set(applied[1])
+            self._applied[member.id] = applied
+        roles = (current - entry.remove) | entry.add
+        if roles != current:
+            # il ruolo @everyone non va passato a discord
+            new_roles = [r for r in roles if not r.is_default()]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    await member.edit(roles=new_roles)
+                    break
+                except discord.HTTPException as e:
+                    # discord.py gestisce già i rate limit, qui si ritenta
+                    # solo quando ha esaurito i suoi tentativi
+                    if attempt == self.max_retries or (e.status != 429 and e.status < 500):
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+            if frozenset(member.roles) == cached:
+                self._applied[member.id] = (cached, frozenset(roles))
+        EligibleVoters.get_instance().update(member, roles)
+        return True
@@ -5,8 +5,10 @@
 - clean_links     "ripulisce" i link
 - evaluate_diff     valuta le differenze tra due messaggi
 - discord_tag       verifica se il testo sia un tag discord
+- is_command        verifica se il messaggio sia un comando testuale
 - relevant_message  stabilisce se analizzare un messaggio o meno
 - next_datetime     restituisce la data corretta
+- chunk_lines       divide un elenco di righe in testi di lunghezza limitata
 """
 from __future__ import annotations
 from datetime import datetime, timedelta
@@ -167,6 +169,23 @@ def discord_tag(content: str) -> bool:
     return content[1] in ('@', '#', ':', 'a', 't', '3')
 
 
+def is_command(content: str, prefix: str) -> bool:
+    """Controlla se il messaggio è un comando testuale.
+    Serve per evitare di contare come messaggio inviato un comando.
+
+    :param content: il testo del messaggio
+    :param prefix: il prefisso corrente del bot
+
+    :returns: True se è un comando, altrimenti False
+    :rtype: bool
+    """
+    # gestisce anche prefissi più lunghi
+    if content.startswith(prefix):
+        if not discord_tag(content):
+            return True
+    return False
+
+
 _guild: discord.Guild = MISSING
 
 
@@ -213,3 +232,37 @@ def next_datetime(start_date: datetime, days: int) -> datetime:
     start_date = start_date.replace(tzinfo=None)
     next_date = start_date + timedelta(days=days)
     return next_date.astimezone()
+
+
+def chunk_lines(lines: List[str], limit: int = 4000) -> List[str]:
+    """Unisce le righe in testi che non superano limit caratteri, così da
+    inviarle in pochi messaggi rispettando i limiti di discord (4096
+    caratteri per la descrizione di un embed). Una riga più lunga del
+    limite viene divisa tra più testi, possibilmente in corrispondenza di
+    uno spazio, senza perderne alcuna parte.
+
+    :param lines: le righe da unire
+    :param limit: la lunghezza massima di ogni testo
+
+    :returns: i testi da inviare
+    :rtype: List[str]
+    """
+    chunks: List[str] = []
+    current = ''
+    for line in lines:
+        while len(line) > limit:
+            cut = line.rfind(' ', 0, limit + 1)
+            if cut <= 0:
+                cut = limit
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:cut])
+            line = line[cut:].lstrip(' ')
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        chunks.append(current)
+    return chunks
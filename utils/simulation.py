@@ -0,0 +1,399 @@
+"""Simulazione accelerata della logica di contatori e ruoli.
+
+Sostituisce l'orologio con un VirtualClock e riproduce ora per ora un
+flusso sintetico di messaggi, e di eliminazioni di messaggi delle ultime
+48 ore, su un server finto, chiamando la stessa logica usata da EventCog
+(vedi Counters): conteggio in CounterBuffer e MessageLedger, commit dei
+contatori e soglia cazzaro, decremento dei messaggi eliminati, scadenze
+tramite DankTimer, controllo giornaliero a partizioni (le attese tra le
+partizioni fanno avanzare l'orologio) e modifiche dei ruoli tramite
+RoleScheduler. Nessun file viene letto o scritto e non serve una
+connessione a discord.
+
+Il periodo simulato attraversa i cambi di ora legale del fuso scelto; al
+termine vengono riportati la velocità della simulazione e gli errori
+rilevati confrontando il risultato con un modello indipendente:
+- ruolo oratore diverso da quello atteso dai messaggi dei 7 giorni precedenti
+- ruoli dei membri non coerenti con lo stato degli afler
+- ruolo cazzaro rimosso in ritardo o con scadenza non alla stessa ora locale
+- storico settimanale dell'oratore diverso dai messaggi non eliminati
+- totale messaggi di un afler diverso da quelli inviati e non eliminati
+- eliminazione dopo la rotazione giornaliera che non decrementa lo storico
+  (controllata anche in un caso isolato all'avvio)
+
+Uso:
+    python -m utils.simulation [--days 300] [--members 300] [--seed 0]
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+from collections import defaultdict, deque
+from datetime import date, datetime, timedelta
+import os
+import random
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+from discord.utils import time_snowflake
+
+from utils.afler import Afler
+from utils.archive import Archive
+from utils.bot_logger import BotLogger
+from utils.channel_registry import ChannelRole
+from utils.clock import Clock, VirtualClock
+from utils.config import Config
+from utils.counters import Counters
+from utils.message_ledger import MessageLedger
+
+
+class FakeRole():
+    """Ruolo del server finto."""
+
+    def __init__(self, id: int, name: str) -> None:
+        self.id = id
+        self.name = name
+
+    @property
+    def mention(self) -> str:
+        return f'<@&{self.id}>'
+
+    def is_default(self) -> bool:
+        return False
+
+
+class FakeMember():
+    """Membro del server finto, edit() aggiorna subito i ruoli."""
+
+    def __init__(self, id: int, roles: List[FakeRole]) -> None:
+        self.id = id
+        self.name = f'afler{id}'
+        self.bot = False
+        self.roles = roles
+        self.edits = 0
+        self.guild: FakeGuild
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+    @property
+    def display_name(self) -> str:
+        return self.name
+
+    async def edit(self, *, roles: List[FakeRole]) -> None:
+        self.roles = list(roles)
+        self.edits += 1
+
+
+class FakeChannel():
+    """Canale del server finto, conta i messaggi inviati."""
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def send(self, *args, **kwargs) -> None:
+        self.sent += 1
+
+
+class FakeGuild():
+    """Server finto con i soli metodi usati dalla logica dei ruoli."""
+
+    def __init__(self, members: List[FakeMember]) -> None:
+        self.members = members
+        self._members = {m.id: m for m in members}
+        for member in members:
+            member.guild = self
+
+    def get_member(self, id: int) -> Optional[FakeMember]:
+        return self._members.get(id)
+
+
+class MemoryArchive(Archive):
+    """Archivio che resta in memoria, save() non scrive su disco."""
+
+    def save(self, filename: str = 'aflers.json') -> None:
+        pass
+
+
+class Simulation():
+    """Stato della simulazione e modello atteso con cui confrontarla.
+
+    Attributes
+    -------------
+    clock: `VirtualClock`   l'orologio simulato
+    guild: `FakeGuild`      il server finto
+    counters: `Counters`    la logica dei contatori, la stessa di EventCog
+    stats: `Dict[str, int]` contatori di eventi ed errori
+    """
+
+    def __init__(self, start: datetime, members: int, seed: int) -> None:
+        self.random = random.Random(seed)
+        self.clock = VirtualClock(start)
+        Clock.install(self.clock)
+        self.orator_role = FakeRole(1, 'oratore')
+        self.dank_role = FakeRole(2, 'cazzaro')
+        self.afl_role = FakeRole(3, 'afl')
+        self.mod_role = FakeRole(4, 'moderatore')
+        self.surveillance_role = FakeRole(5, 'sorvegliato')
+        guild_members: List[FakeMember] = []
+        for id in range(1000, 1000 + members):
+            roles = [self.afl_role]
+            if self.random.random() < 0.03:
+                roles.append(self.mod_role)
+            guild_members.append(FakeMember(id, roles))
+        self.guild = FakeGuild(guild_members)
+        self.main_channel = FakeChannel()
+        self.log_channel = FakeChannel()
+        self.config = self._config()
+        self.archive = MemoryArchive.__new__(MemoryArchive)
+        self.archive.archive = {m.id: Afler.new_entry(m.name) for m in guild_members}
+        Archive._archive_instance = self.archive
+        MessageLedger._instance = MessageLedger.empty()
+        logger = BotLogger.create_instance(None)
+        logger.channel = self.log_channel  # type: ignore
+        self.counters = Counters.get_instance()
+        # attività per membro: pochi membri scrivono molto
+        self.activity = {m.id: self.random.paretovariate(1.5) for m in guild_members}
+        self.weights = list(self.activity.values())
+        self.ids = list(self.activity.keys())
+        # modello atteso per l'oratore
+        self.orator_messages: Dict[int, Dict[date, int]] = defaultdict(lambda: defaultdict(int))
+        self.orator_reset: Dict[int, date] = {}
+        self.orator_expected: Dict[int, date] = {}
+        # messaggi inviati e non eliminati per membro
+        self.totals: Dict[int, int] = defaultdict(int)
+        self.stats: Dict[str, int] = defaultdict(int)
+        self.max_dank_delay = timedelta(0)
+        # messaggi eliminabili, (id, autore, contatore, giorno) per ora di invio
+        self.recent: Deque[List[Tuple[int, int, ChannelRole, date]]] = deque(maxlen=48)
+        self.sequence = 0
+
+    def _config(self) -> Config:
+        config = Config.__new__(Config)
+        config._load_config({
+            'guild_id': 0, 'main_channel_id': 0, 'presentation_channel_id': 0,
+            'welcome_channel_id': 0, 'log_channel_id': 0, 'current_prefix': '<',
+            'moderation_roles_id': [self.mod_role.id], 'afl_role_id': self.afl_role.id,
+            'orator_role_id': self.orator_role.id, 'orator_category_id': 0,
+            'orator_threshold': 100, 'orator_duration': 7,
+            'dank_role_id': self.dank_role.id, 'dank_category_id': 0,
+            'dank_threshold': 20, 'dank_time_window': 7, 'dank_duration': 7,
+            'exceptional_channels_id': [], 'poll_channel_id': 0, 'poll_duration': 2,
+            'under_surveillance_id': self.surveillance_role.id,
+            'violations_reset_days': 7, 'nick_change_days': 7, 'bio_length_limit': 256,
+            'shed_backlog': 50
+        })  # type: ignore
+        config.guild = self.guild  # type: ignore
+        config.main_channel = self.main_channel  # type: ignore
+        config.afl_role = self.afl_role  # type: ignore
+        config.orator_role = self.orator_role  # type: ignore
+        config.dank_role = self.dank_role  # type: ignore
+        config.moderation_roles = [self.mod_role]  # type: ignore
+        config.surveillance_role = self.surveillance_role  # type: ignore
+        Config._instance = config
+        return config
+
+    async def run(self, days: int) -> None:
+        """Simula il numero di giorni indicato, un'ora alla volta."""
+        self._check_delete_after_rollover()
+        end = self.clock.instant + timedelta(days=days)
+        last_offset = self.clock.now().astimezone().utcoffset()
+        while self.clock.instant < end:
+            now = self.clock.now()
+            offset = now.astimezone().utcoffset()
+            if offset != last_offset:
+                self.stats['cambi di ora legale'] += 1
+                last_offset = offset
+            # il controllo giornaliero fa avanzare l'orologio, l'ora
+            # successiva si calcola prima
+            next_hour = self.clock.instant + timedelta(hours=1) - timedelta(
+                minutes=now.minute, seconds=now.second, microseconds=now.microsecond)
+            await self._expire_dank()
+            if now.hour == 0:
+                await self._maintenance(now.date())
+            await self._messages(now, next_hour)
+            await self._deletes()
+            # come la task counters_commit di EventCog
+            await self._commit()
+            if now.hour == 23:
+                self._check_roles()
+            self.clock.advance(next_hour - self.clock.instant)
+
+    async def _messages(self, now: datetime, end: datetime) -> None:
+        # meno messaggi di notte
+        base = len(self.ids) * (0.05 if 2 <= now.hour < 8 else 0.6)
+        count = int(self.random.expovariate(1 / base)) if base else 0
+        today = now.date()
+        span = end - self.clock.instant
+        sent: List[Tuple[int, int, ChannelRole, date]] = []
+        self.recent.append(sent)
+        for i, id in enumerate(self.random.choices(self.ids, self.weights, k=count)):
+            member = self.guild.get_member(id)
+            assert member is not None
+            # l'id del messaggio contiene l'istante di invio, nel resto dell'ora
+            self.sequence = (self.sequence + 1) % (1 << 22)
+            message_id = time_snowflake(self.clock.instant + span * i / count) + self.sequence
+            role = ChannelRole.ORATOR if self.random.random() < 0.7 else ChannelRole.DANK
+            self.stats['messaggi'] += 1
+            self.totals[id] += 1
+            if role is ChannelRole.ORATOR:
+                self.orator_messages[id][today] += 1
+            sent.append((message_id, id, role, today))
+            if self.counters.count(message_id, member, role):  # type: ignore
+                # come EventCog._submit_commit
+                await self._commit()
+
+    async def _commit(self) -> None:
+        # assegnazioni e rinnovi del ruolo cazzaro, con la scadenza attesa
+        before = {id: self.archive.get(id).dank_expiration
+                  for id, role in self.counters.buffer.pending if role is ChannelRole.DANK}
+        await self.counters.commit()
+        granted = self.clock.now().replace(minute=0, second=0, microsecond=0)
+        expected = granted + timedelta(days=self.config.dank_duration)
+        for id, expiration in before.items():
+            afler = self.archive.get(id)
+            if afler.dank_expiration == expiration:
+                continue
+            self.stats['cazzaro assegnato/rinnovato'] += 1
+            assert afler.dank_expiration is not None
+            if afler.dank_expiration.replace(tzinfo=None) != expected:
+                self.stats['errori: scadenza cazzaro non alla stessa ora'] += 1
+
+    async def _deletes(self) -> None:
+        # circa un messaggio su 50 viene eliminato entro 48 ore,
+        # anche dopo la rotazione giornaliera del giorno di invio
+        hours = [h for h in self.recent if h]
+        if not hours:
+            return
+        count = int(self.random.expovariate(50 / sum(len(h) for h in hours) * len(hours)))
+        deleted: List[int] = []
+        for _ in range(count):
+            hour = self.random.choice(hours)
+            if not hour:
+                continue
+            i = self.random.randrange(len(hour))
+            hour[i], hour[-1] = hour[-1], hour[i]
+            message_id, id, role, day = hour.pop()
+            if message_id not in self.counters.ledger:
+                # uscito dal registro: come nel bot resta conteggiato
+                continue
+            deleted.append(message_id)
+            self.totals[id] -= 1
+            if role is ChannelRole.ORATOR:
+                self.orator_messages[id][day] -= 1
+        if not deleted:
+            return
+        self.stats['messaggi eliminati'] += len(deleted)
+        await self._commit()
+        # come EventCog.on_raw_bulk_message_delete
+        await self.counters.uncount(deleted)
+
+    def _check_delete_after_rollover(self) -> None:
+        # caso isolato: messaggi di ieri consolidati dalla rotazione e poi
+        # eliminati devono sparire dallo storico settimanale
+        today = self.clock.today()
+        afler = Afler.new_entry('prova')
+        afler.orator_last_message_timestamp = today - timedelta(days=1)
+        afler.orator_daily_buffer = 5
+        afler.clean_orator_buffer()
+        afler.decrease_orator_buffer(2, today - timedelta(days=1))
+        if afler.count_orator_messages() != 3 or afler.orator_daily_buffer != 0:
+            self.stats['errori: eliminazione dopo la rotazione non decrementata'] += 1
+
+    async def _expire_dank(self) -> None:
+        now = self.clock.now().astimezone()
+        for expiration, id in await self.counters.expire_dank():
+            self.stats['cazzaro scaduto'] += 1
+            delay = now - expiration
+            self.max_dank_delay = max(self.max_dank_delay, delay)
+            if delay >= timedelta(hours=1):
+                self.stats['errori: cazzaro rimosso in ritardo'] += 1
+
+    async def _maintenance(self, today: date) -> None:
+        before = {id: (afler.orator, afler.orator_expiration) for id, afler in self.archive.archive.items()}
+        start = time.perf_counter()
+        await self.counters.maintain()
+        self.stats['tempo controllo giornaliero (ms)'] += int((time.perf_counter() - start) * 1000)
+        for id, (orator, expiration) in before.items():
+            afler = self.archive.get(id)
+            if afler.orator and not orator:
+                self.stats['oratore assegnato'] += 1
+            elif afler.orator and afler.orator_expiration != expiration:
+                self.stats['oratore rinnovato'] += 1
+            elif orator and not afler.orator:
+                self.stats['oratore scaduto'] += 1
+        # modello atteso: messaggi degli ultimi 7 giorni, o dall'ultima
+        # assegnazione se più recente
+        duration = timedelta(days=self.config.orator_duration)
+        for member in self.guild.members:
+            id = member.id
+            start_day = max(today - timedelta(days=7), self.orator_reset.get(id, date.min))
+            messages = self.orator_messages[id]
+            total = sum(messages.get(start_day + timedelta(days=i), 0)
+                        for i in range((today - start_day).days))
+            if total >= self.config.orator_threshold and self.mod_role not in member.roles:
+                self.orator_reset[id] = today
+                self.orator_expected[id] = today + duration
+            expiration = self.orator_expected.get(id)
+            if expiration is not None and expiration <= today:
+                del self.orator_expected[id]
+            afler = self.archive.get(id)
+            if afler.orator != (id in self.orator_expected):
+                self.stats['errori: ruolo oratore non atteso'] += 1
+            # dopo la rotazione lo storico contiene i 6 giorni precedenti,
+            # o quelli dall'ultima assegnazione
+            history_start = max(today - timedelta(days=6), self.orator_reset.get(id, date.min))
+            history = sum(messages.get(history_start + timedelta(days=i), 0)
+                          for i in range((today - history_start).days))
+            if sum(afler.orator_weekly_buffer) != history:
+                self.stats['errori: storico oratore diverso dai messaggi'] += 1
+            # i giorni più vecchi non servono più
+            for day in [d for d in messages if d < today - timedelta(days=8)]:
+                del messages[day]
+
+    def _check_roles(self) -> None:
+        for member in self.guild.members:
+            afler = self.archive.get(member.id)
+            if (self.orator_role in member.roles) != afler.orator:
+                self.stats['errori: ruolo oratore incoerente'] += 1
+            if (self.dank_role in member.roles) != afler.dank:
+                self.stats['errori: ruolo cazzaro incoerente'] += 1
+            if afler.total_messages != self.totals[member.id]:
+                self.stats['errori: totale messaggi diverso dai messaggi non eliminati'] += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Simulazione accelerata di contatori e ruoli')
+    parser.add_argument('--days', type=int, default=300, help='giorni da simulare')
+    parser.add_argument('--members', type=int, default=300, help='membri del server finto')
+    parser.add_argument('--seed', type=int, default=0, help='seme dei numeri casuali')
+    parser.add_argument('--start', default='2024-02-01', help='data di inizio (YYYY-MM-DD)')
+    parser.add_argument('--tz', default='Europe/Rome', help='fuso orario simulato')
+    args = parser.parse_args()
+
+    os.environ['TZ'] = args.tz
+    if hasattr(time, 'tzset'):
+        time.tzset()
+    else:
+        print('time.tzset non disponibile: si usa il fuso di sistema')
+    simulation = Simulation(datetime.fromisoformat(args.start), args.members, args.seed)
+    start = time.perf_counter()
+    asyncio.run(simulation.run(args.days))
+    elapsed = time.perf_counter() - start
+
+    stats = simulation.stats
+    print(f'{args.days} giorni simulati in {elapsed:.2f}s '
+          f'({args.days * 24 / elapsed:.0f} ore simulate/s, '
+          f'{stats["messaggi"] / elapsed:.0f} messaggi/s)')
+    print(f'modifiche ai ruoli: {sum(m.edits for m in simulation.guild.members)}')
+    print(f'ritardo massimo rimozione cazzaro: {simulation.max_dank_delay}')
+    errors = 0
+    for key in sorted(stats):
+        print(f'{key}: {stats[key]}')
+        if key.startswith('errori'):
+            errors += stats[key]
+    print('nessun errore rilevato' if errors == 0 else f'{errors} errori rilevati')
+
+
+if __name__ == '__main__':
+    main()
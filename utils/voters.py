@@ -0,0 +1,104 @@
+"""Insieme dei membri che hanno diritto di voto sulle proposte"""
+from __future__ import annotations
+from typing import ClassVar, Iterable, Optional, Set
+
+import discord
+from discord.utils import MISSING
+
+from utils.config import Config
+
+
+class EligibleVoters():
+    """Mantiene in memoria gli id dei membri che possono votare le proposte,
+    ovvero chi possiede il ruolo oratore o un ruolo di moderazione.
+    L'insieme è ricostruito all'avvio e aggiornato dagli eventi sui membri
+    (cambio ruoli, entrata, uscita) e dalle assegnazioni dei ruoli fatte
+    dal bot, evitando di scorrere tutti i membri del server a ogni proposta.
+
+    NOTA: questa classe è pensata per essere un singleton, ottenere l'istanza
+    tramite get_instance.
+
+    Attributes
+    -------------
+    _instance: `EligibleVoters` attributo di classe, contiene l'istanza
+    voters: `Set[int]`          id dei membri con diritto di voto
+
+    Classmethods
+    -------------
+    get_instance(): ritorna l'unica istanza
+
+    Methods
+    -------------
+    rebuild():      ricalcola l'insieme a partire dai membri del server
+    update():       aggiorna lo stato di un singolo membro
+    discard():      rimuove un membro dall'insieme
+    is_eligible():  controlla se un membro può votare
+    """
+    _instance: ClassVar[EligibleVoters] = MISSING
+
+    def __init__(self) -> None:
+        self.voters: Set[int]
+        raise RuntimeError(
+            'Usa EligibleVoters.get_instance() per ottenere l\'istanza')
+
+    @classmethod
+    def get_instance(cls) -> EligibleVoters:
+        """Ritorna l'unica istanza dell'insieme dei votanti."""
+        if cls._instance is MISSING:
+            cls._instance = cls.__new__(cls)
+            cls._instance.voters = set()
+        return cls._instance
+
+    def __len__(self) -> int:
+        return len(self.voters)
+
+    @staticmethod
+    def _has_voting_role(roles: Iterable[discord.Role]) -> bool:
+        config = Config.get_config()
+        return any(
+            role == config.orator_role or role in config.moderation_roles
+            for role in roles
+        )
+
+    def rebuild(self, members: Iterable[discord.Member]) -> None:
+        """Ricalcola da zero l'insieme dei votanti. Da chiamare quando
+        cambiano i ruoli di riferimento nella configurazione.
+
+        :param members: i membri del server
+        """
+        self.voters = {
+            member.id for member in members
+            if not member.bot and self._has_voting_role(member.roles)
+        }
+
+    def update(self, member: discord.Member, roles: Optional[Iterable[discord.Role]] = None) -> None:
+        """Aggiorna il diritto di voto di un membro.
+
+        :param member: il membro da aggiornare
+        :param roles: i ruoli da considerare al posto di member.roles, utile
+        subito dopo una modifica dei ruoli quando la cache non è ancora
+        aggiornata
+        """
+        if roles is None:
+            roles = member.roles
+        if not member.bot and self._has_voting_role(roles):
+            self.voters.add(member.id)
+        else:
+            self.voters.discard(member.id)
+
+    def discard(self, member_id: int) -> None:
+        """Rimuove il membro dall'insieme, se presente.
+
+        :param member_id: l'id del membro
+        """
+        self.voters.discard(member_id)
+
+    def is_eligible(self, member_id: int) -> bool:
+        """Controlla se il membro ha diritto di voto.
+
+        :param member_id: l'id del membro
+
+        :returns: True se il membro può votare
+        :rtype: bool
+        """
+        return member_id in self.voters
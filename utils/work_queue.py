@@ -0,0 +1,154 @@
+"""Coda di lavoro per le azioni verso discord generate dai messaggi.
+
+Le fasi della pipeline dei messaggi non eseguono direttamente le chiamate
+a discord (risposte, repost, proposte, ruoli...) ma le accodano qui: un
+numero fisso di worker le esegue, così che un picco di messaggi non si
+traduca in centinaia di coroutine concorrenti contro le API.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from discord.utils import MISSING
+
+_log = logging.getLogger(__name__)
+
+JobFactory = Callable[[], Awaitable[Any]]
+
+
+class WorkQueue():
+    """Pool di worker con code limitate. I lavori con la stessa chiave
+    (es. l'id del canale) finiscono sempre nella stessa coda e vengono
+    quindi eseguiti nell'ordine in cui sono stati accodati.
+
+    Quando le code sono piene i lavori essenziali attendono che si liberi
+    posto (rallentando chi li accoda), mentre quelli non essenziali (es.
+    le risposte a 'ping') vengono scartati, così come quando i lavori in
+    attesa superano la soglia shed_backlog della configurazione.
+
+    Attributes
+    -------------
+    workers: `int`          numero di worker
+    max_size: `int`         dimensione massima di ogni coda
+    submitted: `int`        lavori accodati
+    done: `int`             lavori completati
+    failed: `int`           lavori terminati con un errore
+    shed: `int`             lavori non essenziali scartati
+    max_depth: `int`        massimo numero di lavori in attesa registrato
+    wait_ns: `int`          tempo totale di attesa in coda dei lavori eseguiti
+    max_wait_ns: `int`      massimo tempo di attesa in coda
+
+    Methods
+    -------------
+    start():    avvia i worker, da chiamare con l'event loop attivo
+    stop():     ferma i worker, i lavori in attesa vengono persi
+    submit():   coroutine, accoda un lavoro
+    depth:      numero di lavori in attesa
+    stats():    ritorna le metriche della coda
+    """
+
+    def __init__(self, workers: int = 4, max_size: int = 100) -> None:
+        self.workers = workers
+        self.max_size = max_size
+        self._queues: List[asyncio.Queue[Tuple[str, JobFactory, int]]] = []
+        self._tasks: List[asyncio.Task] = []
+        self._config: Any = MISSING
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.shed = 0
+        self.max_depth = 0
+        self.wait_ns = 0
+        self.max_wait_ns = 0
+
+    def start(self) -> None:
+        """Crea le code e avvia i worker."""
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(self.max_size)
+                        for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue))
+                       for queue in self._queues]
+
+    def stop(self) -> None:
+        """Ferma i worker."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        """Numero di lavori in attesa in tutte le code."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def _shed_backlog(self) -> int:
+        if self._config is MISSING:
+            # import ritardato per evitare una dipendenza circolare con
+            # Config, che importa il bot che possiede la coda
+            from utils.config import Config
+            self._config = Config.get_config()
+        return self._config.shed_backlog
+
+    async def submit(self, key: Hashable, job: JobFactory, *, name: str, essential: bool = True) -> bool:
+        """Accoda un lavoro. Se i worker non sono avviati il lavoro viene
+        eseguito subito.
+
+        :param key: chiave di ordinamento, i lavori con la stessa chiave
+        sono eseguiti in ordine di arrivo
+        :param job: funzione che crea la coroutine da eseguire
+        :param name: nome del lavoro, usato nei messaggi di errore
+        :param essential: se False il lavoro può essere scartato in caso di
+        sovraccarico
+
+        :returns: False se il lavoro è stato scartato
+        :rtype: bool
+        """
+        if not self._tasks:
+            await job()
+            return True
+        queue = self._queues[hash(key) % len(self._queues)]
+        if not essential and (queue.full() or self.depth >= self._shed_backlog()):
+            self.shed += 1
+            return False
+        await queue.put((name, job, time.perf_counter_ns()))
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def _worker(self, queue: asyncio.Queue[Tuple[str, JobFactory, int]]) -> None:
+        while True:
+            name, job, enqueued = await queue.get()
+            wait = time.perf_counter_ns() - enqueued
+            self.wait_ns += wait
+            self.max_wait_ns = max(self.max_wait_ns, wait)
+            try:
+                await job()
+                self.done += 1
+            except Exception:
+                # il worker deve sopravvivere a qualsiasi errore del lavoro
+                _log.exception('errore nel lavoro %s', name)
+                self.failed += 1
+            finally:
+                queue.task_done()
+
+    def stats(self) -> Dict[str, float]:
+        """Ritorna le metriche della coda: lavori accodati, completati,
+        falliti e scartati, profondità attuale e massima, tempo medio e
+        massimo di attesa in millisecondi.
+
+        :returns: le metriche della coda
+        :rtype: Dict[str, float]
+        """
+        executed = self.done + self.failed
+        return {
+            'submitted': self.submitted,
+            'done': self.done,
+            'failed': self.failed,
+            'shed': self.shed,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'avg_wait_ms': self.wait_ns / executed / 1e6 if executed else 0.0,
+            'max_wait_ms': self.max_wait_ns / 1e6
+        }